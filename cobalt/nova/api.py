@@ -15,8 +15,13 @@
 
 
 """Handles all requests relating to Cobalt functionality."""
+import collections
 import random
 import sys
+import time
+import uuid
+
+from eventlet import greenthread
 
 from nova import availability_zones
 from nova import context
@@ -36,12 +41,18 @@ from nova.objects import instance as instance_obj
 from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import rpc
+from nova.openstack.common.rpc.common import Timeout
 from nova.openstack.common import timeutils
 from nova.openstack.common.gettextutils import _
 from nova.scheduler import rpcapi as scheduler_rpcapi
 
 from oslo.config import cfg
 
+from . import common
+from .common import CACHED_ARTIFACTS_KEY, POOL_SIZE_KEY, POOL_HOST_KEY, POOLED
+from .common import POOL_REFILL_KEY, POOL_SPAWNING
+from .common import cached_artifact_hosts, pool_size, policy_hash
+from . import dbapi
 from . import image
 
 from nova.openstack.common.gettextutils import _
@@ -58,6 +69,9 @@ CAPABILITIES = ['user-data',
                 'scheduler-hints',
                 'install-policy',
                 'supports-volumes',
+                'metrics',
+                'warm-pool',
+                'lineage',
                 ]
 
 LOG = logging.getLogger('nova.cobalt.api')
@@ -66,13 +80,251 @@ CONF = cfg.CONF
 cobalt_api_opts = [
                cfg.StrOpt('cobalt_topic',
                default='cobalt',
-               help='the topic Cobalt nodes listen on') ]
+               help='the topic Cobalt nodes listen on'),
+
+               cfg.IntOpt('cobalt_policy_install_concurrency',
+               default=32,
+               help='The maximum number of hosts a policy is installed on '
+                    'concurrently.'),
+
+               cfg.IntOpt('cobalt_instance_class_cache_size',
+               default=10000,
+               help='The number of instances whose role (regular instance, '
+                    'live-image or launched instance) is remembered by the '
+                    'API so that its checks do not load them. 0 disables '
+                    'the cache.'),
+
+               cfg.IntOpt('cobalt_policy_install_timeout',
+               default=120,
+               help='The number of seconds allowed to install a policy on '
+                    'all of the cobalt hosts. Hosts that did not answer by '
+                    'then are reported as timed out.'),
+
+               cfg.StrOpt('cobalt_prefetch_hosts',
+               default='',
+               help='The hosts that download the artifacts of a new '
+                    'live-image into their cache right after it is blessed, '
+                    'so that its first launch there does not wait for them. '
+                    'One of zone:<availability zone>, aggregate:<host '
+                    'aggregate name> or top:<k> (the k cobalt hosts with the '
+                    'most free memory). Empty disables prefetching. The '
+                    'hosts are selected by the API and only prefetch when '
+                    'they use cobalt_use_image_service.'),
+
+               cfg.IntOpt('cobalt_pool_refill_interval',
+               default=60,
+               help='The interval (in seconds) at which the API checks the '
+                    'pools of paused clones, replacing the clones that failed '
+                    'and the ones that were claimed or deleted. 0 disables '
+                    'the checks, the pools are then only refilled after a '
+                    'claim or a change of their size.'),
+
+               cfg.IntOpt('cobalt_metrics_timeout',
+               default=10,
+               help='The number of seconds a cobalt host is given to report '
+                    'its metrics. Hosts that did not answer by then are '
+                    'reported as timed out.'),
+
+               cfg.IntOpt('cobalt_metrics_concurrency',
+               default=32,
+               help='The maximum number of hosts whose metrics are collected '
+                    'concurrently.')]
 CONF.register_opts(cobalt_api_opts)
 
+# The launch parameters that can be applied to a pooled clone when it is
+# claimed. Launches with any other parameter do not use the pool: the guest of
+# a pooled clone has already booted, so it would never see a new key or user
+# data.
+POOL_LAUNCH_PARAMS = ['name']
+
+# The instance fields that claiming a pooled clone changes.
+POOL_CLAIM_FIELDS = ['display_name']
+
+# The number of seconds a refill holds the lease of a pool (see _refill_pool).
+# It is renewed before each clone is created, so it only runs out when the
+# process refilling the pool died.
+POOL_REFILL_LEASE = 300
+
+# The instance fields that a lineage query can return, and the ones it returns
+# by default.
+LINEAGE_FIELDS = ['display_name', 'vm_state', 'task_state', 'power_state',
+                  'host', 'availability_zone', 'user_id', 'project_id',
+                  'created_at', 'launched_at']
+DEFAULT_LINEAGE_FIELDS = ['display_name', 'vm_state', 'task_state', 'host']
+
+# The roles of the instances in their lineage.
+ROLE_INSTANCE = 'instance'
+ROLE_BLESSED = 'blessed'
+ROLE_LAUNCHED = 'launched'
+
+class InstanceClass(object):
+    """
+    The role of an instance in its lineage and the instance it was blessed or
+    launched from. Neither changes for as long as the instance exists.
+    """
+
+    def __init__(self, role, parent_uuid, project_id):
+        self.role = role
+        self.parent_uuid = parent_uuid
+        self.project_id = project_id
+
+    @staticmethod
+    def from_metadata(metadata, project_id):
+        """ Classifies the instance with the given metadata ({key: value}). """
+        if dbapi.BLESSED_FROM in metadata:
+            return InstanceClass(ROLE_BLESSED, metadata[dbapi.BLESSED_FROM],
+                                 project_id)
+        elif dbapi.LAUNCHED_FROM in metadata:
+            return InstanceClass(ROLE_LAUNCHED, metadata[dbapi.LAUNCHED_FROM],
+                                 project_id)
+        return InstanceClass(ROLE_INSTANCE, None, project_id)
+
+class InstanceClassCache(object):
+    """
+    The InstanceClass of the instances recently seen by this process, by uuid.
+    The least recently used ones are evicted beyond
+    cobalt_instance_class_cache_size.
+    """
+
+    def __init__(self):
+        # uuid -> (InstanceClass, the tick of its last use).
+        self.classes = {}
+        # The (uuid, tick) of the uses, the oldest first. The uses superseded
+        # by a later one are skipped when evicting.
+        self.uses = collections.deque()
+        self.tick = 0
+
+    def _use(self, instance_uuid, instance_class):
+        self.tick += 1
+        self.classes[instance_uuid] = (instance_class, self.tick)
+        self.uses.append((instance_uuid, self.tick))
+
+        size = max(0, CONF.cobalt_instance_class_cache_size)
+        while len(self.classes) > size:
+            used_uuid, tick = self.uses.popleft()
+            if self.classes.get(used_uuid, (None, None))[1] == tick:
+                del self.classes[used_uuid]
+        if len(self.uses) > 2 * len(self.classes) + 64:
+            self.uses = collections.deque([(used_uuid, tick)
+                            for used_uuid, tick in self.uses
+                            if self.classes.get(used_uuid, (None, None))[1] == tick])
+
+    def get(self, context, instance_uuid):
+        entry = self.classes.get(instance_uuid)
+        if entry is None:
+            return None
+        instance_class = entry[0]
+        self._use(instance_uuid, instance_class)
+        if not context.is_admin and instance_class.project_id != context.project_id:
+            # The database enforces the access to the other projects.
+            return None
+        return instance_class
+
+    def put(self, instance_uuid, instance_class):
+        self._use(instance_uuid, instance_class)
+
+    def invalidate(self, instance_uuid):
+        self.classes.pop(instance_uuid, None)
+
+_instance_classes = InstanceClassCache()
+
+# Whether the instance fix-up has been started in this process.
+_instance_fixup_started = False
+
+# Whether the periodic pool refill has been started in this process.
+_pool_refill_started = False
+
+# The greenthreads refilling the pools of the live-images in this process, by
+# live-image uuid, and the live-images whose pool was asked to be refilled
+# again while it was.
+_pool_refills = {}
+_pool_refills_requested = set()
+
+def fixup_instances(context):
+    """
+    Corrects the instances left in an invalid state by earlier failures. Only
+    the affected rows are read and updated, a batch at a time.
+    """
+    # (dscannell) We need to update the power_state to something valid. Since
+    # these are blessed instances we simply update their state to 'no state'.
+    power_states = dbapi.instance_update_all_matching(context,
+                                        {'power_state': None},
+                                        {'power_state': power_state.NOSTATE})
+    # (rui-lin) Host or nova-gc process failure during bless can cause
+    # source instance to be undeletable and stuck in 'blessing' state,
+    # so we clear state to default and allow it to be deleted if needed
+    blessings = dbapi.instance_update_all_matching(context,
+                                        {'vm_state': vm_states.ACTIVE,
+                                         'task_state': 'blessing'},
+                                        {'disable_terminate': False,
+                                         'task_state': None})
+    if power_states or blessings:
+        LOG.info(_("Fixed the power state of %d instances and cleared the "
+                   "blessing state of %d instances"), power_states, blessings)
+
+def start_instance_fixup():
+    """
+    Runs the instance fix-up in the background, once per process, so that it
+    does not hold up the startup. It is started by the API extension when
+    it is loaded (see cobalt.nova.osapi.cobalt_extension).
+    """
+    global _instance_fixup_started
+    if _instance_fixup_started:
+        return
+    _instance_fixup_started = True
+
+    def _fixup():
+        try:
+            fixup_instances(context.get_admin_context())
+        except:
+            LOG.exception(_("Error during the instance fix-up"))
+    greenthread.spawn_n(_fixup)
+
+def start_pool_refill(cobalt_api):
+    """
+    Refills the pools of all of the live-images through cobalt_api every
+    cobalt_pool_refill_interval seconds in the background, once per
+    process. This retries the refills that failed and replaces the pooled
+    clones that failed to launch or were deleted.
+    """
+    global _pool_refill_started
+    if _pool_refill_started or CONF.cobalt_pool_refill_interval <= 0:
+        return
+    _pool_refill_started = True
+
+    def _refill_pools():
+        while True:
+            greenthread.sleep(CONF.cobalt_pool_refill_interval)
+            try:
+                cobalt_api.refill_pools(context.get_admin_context())
+            except:
+                LOG.exception(_("Error refilling the pools"))
+    greenthread.spawn_n(_refill_pools)
+
+# The install_policy statuses of a host that has the policy.
+POLICY_INSTALL_SUCCESS = ('installed', 'unchanged')
+
+class PolicyInstallFailed(exception.NovaException):
+    """
+    The policy could not be installed on some of the hosts. The report has
+    the outcome on every host, including the ones where it was installed.
+    """
+    message = _("Failed to install policy on %(count)d hosts, faults:\n"
+                "%(faults)s")
+
+    def __init__(self, report):
+        self.report = report
+        faults = sorted([(host, result.get('error', result['status']))
+                         for host, result in report.iteritems()
+                         if result['status'] not in POLICY_INSTALL_SUCCESS])
+        super(PolicyInstallFailed, self).__init__(count=len(faults),
+                faults='\n'.join([host + ": " + str(fault).strip()
+                                   for host, fault in faults]))
+
 class API(base.Base):
     """API for interacting with the cobalt manager."""
 
-    # Allow passing in dummy image_service, but normally use the default
+    # Allow passing in dummy image_service, but normally use the default.
     def __init__(self, image_service=None, **kwargs):
         super(API, self).__init__(**kwargs)
         self.compute_api = compute.API()
@@ -81,26 +333,6 @@ class API(base.Base):
         self.CAPABILITIES = CAPABILITIES
         self.sg_api = sg_driver.get_openstack_security_group_driver()
 
-        # Fixup an power-states related to blessed instances.
-        elevated = context.get_admin_context()
-        instances = self.compute_api.get_all(elevated,
-                                             {'deleted':False})
-        for instance in instances:
-            if instance['power_state'] == None:
-                # (dscannell) We need to update the power_state to something
-                # valid. Since it is a blessed instance we simply update its
-                # state to 'no state'.
-                self.db.instance_update(elevated, instance['uuid'],
-                                        {'power_state':power_state.NOSTATE})
-            # (rui-lin) Host or nova-gc process failure during bless can cause
-            # source instance to be undeletable and stuck in 'blessing' state,
-            # so we clear state to default and allow it to be deleted if needed
-            if instance['vm_state'] == vm_states.ACTIVE:
-                if instance['task_state'] == "blessing":
-                    self.db.instance_update(elevated, instance['uuid'],
-                        {'disable_terminate':False,'task_state':'None'})
-
-
     def get_info(self):
         return {'capabilities': self.CAPABILITIES}
 
@@ -132,6 +364,12 @@ class API(base.Base):
         kwargs = {'method': method, 'args': params}
         rpc.cast(context, queue, kwargs)
 
+    def _cast_cobalt_host_message(self, method, context, host, params):
+        """Casts a message that is not about a single instance to the cobalt
+        service on the given host."""
+        queue = rpc.queue_get_for(context, CONF.cobalt_topic, host)
+        rpc.cast(context, queue, {'method': method, 'args': params})
+
     def _acquire_addition_reservation(self, context, instance, num_requested=1):
         # Check the quota to see if we can launch a new instance.
         instance_type = flavors.extract_flavor(instance)
@@ -186,6 +424,24 @@ class API(base.Base):
     def _copy_instance(self, context, instance, new_name, launch=False,
                        new_user_data=None, security_groups=None, key_name=None,
                        launch_index=0, availability_zone=None):
+        return self._copy_instances(context, instance, new_name, 1,
+                                    launch=launch,
+                                    new_user_data=new_user_data,
+                                    security_groups=security_groups,
+                                    key_name=key_name,
+                                    first_launch_index=launch_index,
+                                    availability_zone=availability_zone)[0]
+
+    def _copy_instances(self, context, instance, new_name, num_instances,
+                        launch=False, new_user_data=None, security_groups=None,
+                        key_name=None, first_launch_index=0,
+                        availability_zone=None):
+        """
+        Creates num_instances copies of instance. The source instance and its
+        block device mappings are only read once, and the copies (with their
+        metadata, info caches and security groups) and their block device
+        mappings are written in bulk.
+        """
         # (OmgLag): Basically we want to copy all of the information from
         # instance with provided instance into a new instance. This is because
         # we are basically "cloning" the vm as far as all the properties are
@@ -200,7 +456,12 @@ class API(base.Base):
         for data in instance.get('system_metadata', []):
             # (dscannell) Do not copy over the system metadata that we setup
             # on an instance. This is important when doing clone-of-clones.
-            if data['key'] not in ['blessed_from', 'launched_from']:
+            # The pool and artifact cache keys only apply to the live-image
+            # itself.
+            if data['key'] not in ['blessed_from', 'launched_from',
+                                   POOL_SIZE_KEY, POOL_HOST_KEY,
+                                   POOL_REFILL_KEY] and \
+               not data['key'].startswith(CACHED_ARTIFACTS_KEY % ''):
                 system_metadata[data['key']] = data['value']
 
         metadata = {}
@@ -226,61 +487,66 @@ class API(base.Base):
         if availability_zone is None:
             availability_zone = instance['availability_zone']
 
-        instance_params = {
-           'reservation_id': utils.generate_uid('r'),
-           'image_ref': image_ref,
-           'ramdisk_id': instance.get('ramdisk_id', ''),
-           'kernel_id': instance.get('kernel_id', ''),
-           'vm_state': vm_states.BUILDING,
-           'user_id': context.user_id,
-           'project_id': context.project_id,
-           'launched_at': None,
-           'instance_type_id': instance['instance_type_id'],
-           'memory_mb': instance['memory_mb'],
-           'vcpus': instance['vcpus'],
-           'root_gb': instance['root_gb'],
-           'ephemeral_gb': instance['ephemeral_gb'],
-           'display_name': new_name,
-           'hostname': utils.sanitize_hostname(new_name),
-           'display_description': instance['display_description'],
-           'user_data': new_user_data or '',
-           'key_name': key_name,
-           'key_data': key_data,
-           'locked': False,
-           'metadata': metadata,
-           'availability_zone': availability_zone,
-           'os_type': instance['os_type'],
-           'host': None,
-           'system_metadata': system_metadata,
-           'launch_index': launch_index,
-           'root_device_name': instance['root_device_name'],
-           'power_state': power_state.NOSTATE,
-           'vm_mode': instance['vm_mode'],
-           'architecture': instance['architecture'],
-           'access_ip_v4': instance['access_ip_v4'],
-           'access_ip_v6': instance['access_ip_v6'],
-           'config_drive': instance['config_drive'],
-           'default_ephemeral_device': instance['default_ephemeral_device'],
-           'default_swap_device': instance['default_swap_device'],
-           'auto_disk_config': instance['auto_disk_config'],
-           # Set disable_terminate on bless so terminate in nova-api barfs on a
-           # blessed instance.
-           'disable_terminate': not launch,
-        }
-
-        new_instance = instance_obj.Instance()
-        new_instance.update(instance_params)
+        security_group_names = []
         if security_groups != None:
-            self.sg_api.populate_security_groups(new_instance,
-                                                 security_groups)
-        new_instance.create(context)
-        nw_info = instance['info_cache'].get('network_info')
-        self.db.instance_info_cache_update(context, new_instance['uuid'],
-                                           {'network_info': nw_info})
+            # nova resolves the security groups once for all of the copies
+            # (e.g. to none with neutron, which handles them itself).
+            sg_instance = instance_obj.Instance()
+            self.sg_api.populate_security_groups(sg_instance, security_groups)
+            if sg_instance.obj_attr_is_set('security_groups'):
+                security_group_names = [group.name for group in
+                                        sg_instance.security_groups]
 
-        # (dscannell) We need to reload the instance reference in order for it to be associated with
-        # the database session of lazy-loading.
-        new_instance = self.db.instance_get(context, new_instance.id)
+        nw_info = instance['info_cache'].get('network_info')
+        instances_values = []
+        for launch_index in xrange(first_launch_index,
+                                   first_launch_index + num_instances):
+            instance_params = {
+               'reservation_id': utils.generate_uid('r'),
+               'image_ref': image_ref,
+               'ramdisk_id': instance.get('ramdisk_id', ''),
+               'kernel_id': instance.get('kernel_id', ''),
+               'vm_state': vm_states.BUILDING,
+               'user_id': context.user_id,
+               'project_id': context.project_id,
+               'launched_at': None,
+               'instance_type_id': instance['instance_type_id'],
+               'memory_mb': instance['memory_mb'],
+               'vcpus': instance['vcpus'],
+               'root_gb': instance['root_gb'],
+               'ephemeral_gb': instance['ephemeral_gb'],
+               'display_name': new_name,
+               'hostname': utils.sanitize_hostname(new_name),
+               'display_description': instance['display_description'],
+               'user_data': new_user_data or '',
+               'key_name': key_name,
+               'key_data': key_data,
+               'locked': False,
+               'metadata': dict(metadata),
+               'availability_zone': availability_zone,
+               'os_type': instance['os_type'],
+               'host': None,
+               'system_metadata': dict(system_metadata),
+               'launch_index': launch_index,
+               'root_device_name': instance['root_device_name'],
+               'power_state': power_state.NOSTATE,
+               'vm_mode': instance['vm_mode'],
+               'architecture': instance['architecture'],
+               'access_ip_v4': instance['access_ip_v4'],
+               'access_ip_v6': instance['access_ip_v6'],
+               'config_drive': instance['config_drive'],
+               'default_ephemeral_device': instance['default_ephemeral_device'],
+               'default_swap_device': instance['default_swap_device'],
+               'auto_disk_config': instance['auto_disk_config'],
+               # Set disable_terminate on bless so terminate in nova-api barfs on a
+               # blessed instance.
+               'disable_terminate': not launch,
+               'security_groups': list(security_group_names),
+               'info_cache': {'network_info': nw_info},
+            }
+            instances_values.append(instance_params)
+        new_instance_uuids = dbapi.instance_create_all(context,
+                                                       instances_values)
 
         elevated = context.elevated()
 
@@ -290,11 +556,22 @@ class API(base.Base):
                                                              instance['uuid'])
         block_device_mappings =\
             self._parse_block_device_mapping(block_device_mappings)
-        for bdev in block_device_mappings:
-            bdev['instance_uuid'] = new_instance['uuid']
-            self.db.block_device_mapping_create(elevated, bdev, legacy=False)
-
-        return new_instance
+        new_block_device_mappings = []
+        for new_instance_uuid in new_instance_uuids:
+            for bdev in block_device_mappings:
+                bdev = dict(bdev)
+                bdev['instance_uuid'] = new_instance_uuid
+                new_block_device_mappings.append(bdev)
+        dbapi.block_device_mapping_create_all(elevated,
+                                              new_block_device_mappings)
+
+        # (dscannell) We need to reload the instance references in order for
+        # them to be associated with the database session of lazy-loading.
+        new_instances = self.db.instance_get_all_by_filters(context,
+                                            {'uuid': new_instance_uuids})
+        new_instances = dict([(new_instance['uuid'], new_instance)
+                              for new_instance in new_instances])
+        return [new_instances[uuid] for uuid in new_instance_uuids]
 
     def _instance_metadata(self, context, instance):
         """ Returns the instance metadata as a {key:value} dict """
@@ -310,30 +587,118 @@ class API(base.Base):
 
         return self.db.instance_metadata_update(context, instance_uuid, metadata, True)
 
-    def _next_clone_num(self, context, instance):
-        """ Returns the next clone number for the instance """
+    def _next_clone_num(self, context, instance, count=1):
+        """
+        Returns the next clone number for the instance. When count is given,
+        that many consecutive numbers are reserved and the first one is
+        returned.
+        """
 
-        metadata = self._instance_metadata(context, instance)
-        clone_num = int(metadata.get('last_clone_num', -1)) + 1
-        metadata['last_clone_num'] = clone_num
-        self._instance_metadata_update(context, instance['uuid'], metadata)
+        clone_num = dbapi.instance_metadata_counter_allocate(context,
+                            instance['uuid'], 'last_clone_num', count=count)
 
         LOG.debug(_("Instance %s has new clone num=%s"), instance['uuid'], clone_num)
         return clone_num
 
+    def _instance_class(self, context, instance_uuid, instance=None):
+        """
+        Returns the InstanceClass of the instance, classifying the instance
+        when given or reading its class from the database otherwise when it
+        is not cached.
+        """
+        instance_class = _instance_classes.get(context, instance_uuid)
+        if instance_class is None:
+            if instance is not None:
+                instance_class = InstanceClass.from_metadata(
+                                    self._instance_metadata(context, instance),
+                                    instance['project_id'])
+                _instance_classes.put(instance_uuid, instance_class)
+            else:
+                instance_class = self._load_instance_class(context,
+                                                           instance_uuid)[0]
+        return instance_class
+
+    def _load_instance_class(self, context, instance_uuid):
+        """
+        Reads the InstanceClass of the instance along with its current vm and
+        task states (which are not cached) from the database, without loading
+        the instance. Raises InstanceNotFound.
+        """
+        state = dbapi.instance_classify(context, instance_uuid)
+        metadata = {}
+        if state['lineage_key'] is not None:
+            metadata[state['lineage_key']] = state['parent_uuid']
+        instance_class = InstanceClass.from_metadata(metadata,
+                                                     state['project_id'])
+        _instance_classes.put(instance_uuid, instance_class)
+        return instance_class, state
+
     def _is_instance_blessed(self, context, instance):
         """ Returns True if this instance is blessed, False otherwise. """
-        metadata = self._instance_metadata(context, instance)
-        return 'blessed_from' in metadata
+        return self._instance_class(context, instance['uuid'],
+                                    instance).role == ROLE_BLESSED
 
     def _is_instance_blessing(self, context, instance):
         """ Returns True if this instance is being blessed, False otherwise. """
-        return instance['task_state'] == 'blessing'
+        return instance.get('task_state') == 'blessing'
 
     def _is_instance_launched(self, context, instance):
         """ Returns True if this instance is launched, False otherwise """
-        metadata = self._instance_metadata(context, instance)
-        return "launched_from" in metadata
+        return self._instance_class(context, instance['uuid'],
+                                    instance).role == ROLE_LAUNCHED
+
+    def _select_prefetch_hosts(self, context, source_host):
+        """
+        Returns the cobalt hosts selected by cobalt_prefetch_hosts, other
+        than source_host.
+        """
+        selector = CONF.cobalt_prefetch_hosts.strip()
+        if not selector:
+            return []
+        kind, _sep, value = selector.partition(':')
+        value = value.strip()
+
+        admin_context = context.elevated()
+        services = self.db.service_get_all_by_topic(admin_context,
+                                                    CONF.cobalt_topic)
+        cobalt_hosts = [service['host'] for service in services
+                        if not service['disabled']]
+
+        if kind == 'zone':
+            hosts = [host for host in cobalt_hosts
+                     if availability_zones.get_host_availability_zone(
+                                            admin_context, host) == value]
+        elif kind == 'aggregate':
+            aggregates = [aggregate for aggregate in
+                            self.db.aggregate_get_all(admin_context)
+                          if aggregate['name'] == value]
+            aggregate_hosts = set()
+            for aggregate in aggregates:
+                aggregate_hosts.update(aggregate['hosts'])
+            hosts = [host for host in cobalt_hosts if host in aggregate_hosts]
+        elif kind == 'top':
+            try:
+                count = int(value)
+                if count < 0:
+                    raise ValueError()
+            except ValueError:
+                LOG.warn(_("Ignoring the invalid cobalt_prefetch_hosts %s"),
+                         selector)
+                return []
+            free_ram = {}
+            for compute_node in self.db.compute_node_get_all(admin_context):
+                host = compute_node['service']['host']
+                free_ram[host] = max(free_ram.get(host, 0),
+                                     compute_node['free_ram_mb'])
+            hosts = sorted([host for host in cobalt_hosts if host in free_ram],
+                           key=lambda host: free_ram[host], reverse=True)
+            hosts = hosts[:count]
+        else:
+            LOG.warn(_("Ignoring the invalid cobalt_prefetch_hosts %s"),
+                     selector)
+            return []
+
+        return [host for host in hosts if host != source_host]
 
     def _list_cobalt_hosts(self, context, availability_zone=None):
         """ Returns a list of all the hosts known to openstack running the cobalt service. """
@@ -368,9 +733,7 @@ class API(base.Base):
         # Setup the DB representation for the new VM.
         instance = self.get(context, instance_uuid)
 
-        is_blessed = self._is_instance_blessed(context, instance)
-        is_launched = self._is_instance_launched(context, instance)
-        if is_blessed:
+        if self._is_instance_blessed(context, instance):
             # The instance is already blessed. We can't rebless it.
             raise exception.NovaException(_(("Instance %s is already a live image.") % instance_uuid))
         elif instance['vm_state'] != vm_states.ACTIVE:
@@ -386,10 +749,20 @@ class API(base.Base):
                 name = "%s-%s" % (instance['display_name'], str(clonenum))
             new_instance = self._copy_instance(context, instance, name,
                                                launch=False)
-
+            _instance_classes.put(new_instance['uuid'],
+                                  InstanceClass(ROLE_BLESSED, instance_uuid,
+                                                new_instance['project_id']))
+
+            # The hosts are picked here as cobalt-compute has no access to
+            # the services, aggregates and compute nodes.
+            bless_params = {}
+            prefetch_hosts = self._select_prefetch_hosts(context,
+                                                         instance['host'])
+            if len(prefetch_hosts) > 0:
+                bless_params['prefetch_hosts'] = prefetch_hosts
             LOG.debug(_("Casting cobalt message for bless_instance") % locals())
             self._cast_cobalt_message('bless_instance', context, new_instance,
-                                       host=instance['host'])
+                                       host=instance['host'], params=bless_params)
             self._commit_reservation(context, reservations)
         except:
             ei = sys.exc_info()
@@ -409,8 +782,10 @@ class API(base.Base):
             # The instance is not blessed. We can't discard it.
             raise exception.NovaException(_(("Instance %s is not a live image. " +
                                      "Cannot discard a regular instance.") % instance_uuid))
-        elif len(self.list_launched_instances(context, instance_uuid)) > 0:
+        elif self.count_launched_instances(context, instance_uuid,
+                                           include_pooled=False) > 0:
             # There are still launched instances based off of this one.
+            # The pooled clones do not count, they are deleted with the pool.
             raise exception.NovaException(_(("Instance %s still has launched instances. " +
                                      "Cannot discard an instance with remaining launched ones.") %
                                      instance_uuid))
@@ -424,19 +799,38 @@ class API(base.Base):
             # otherwise we can skip it.
             reservations = self._acquire_subtraction_reservation(context, instance)
         try:
+            self._drain_pool(context, instance)
             self._cast_cobalt_message('discard_instance', context, instance)
             self._commit_reservation(context, reservations)
+            _instance_classes.invalidate(instance_uuid)
         except:
             ei = sys.exc_info()
             self._rollback_reservation(context, reservations)
             raise ei[0], ei[1], ei[2]
 
+    def _drain_pool(self, context, instance):
+        """
+        Deletes all of the clones in the pool of the live-image, including
+        the ones still launching and the ones that failed to. Nothing would
+        delete them once the live-image is gone.
+        """
+        system_metadata = dict((entry.key, entry.value)
+                               for entry in instance['system_metadata'])
+        if POOL_SIZE_KEY not in system_metadata:
+            return
+        self.db.instance_system_metadata_update(context, instance['uuid'],
+                                                {POOL_SIZE_KEY: '0'}, False)
+        for pooled_instances in \
+                self._pooled_instances(context, instance).itervalues():
+            for pooled in pooled_instances:
+                self._delete_pooled_instance(context, pooled)
+
     def launch_instance(self, context, instance_uuid, params={}):
         pid = context.project_id
         uid = context.user_id
 
         instance = self.get(context, instance_uuid)
-        if not(self._is_instance_blessed(context, instance)):
+        if not self._is_instance_blessed(context, instance):
             # The instance is not blessed. We can't launch new instances from it.
             raise exception.NovaException(
                   _(("Instance %s is not a live image. " +
@@ -456,10 +850,44 @@ class API(base.Base):
                 raise exception.NovaException(_('num_instances must be at least 1'))
         except TypeError:
             raise exception.NovaException(_('num_instances must be an integer'))
+
+        # Paused clones kept ready in the pool of the live-image are handed
+        # over first, only the rest are launched from scratch.
+        pooled = self._claim_pooled_instances(context, instance,
+                                              num_instances, params,
+                                              security_groups)
+        pooled_instances = [claimed for original, claimed in pooled]
+        launch_instances = []
+        if len(pooled) < num_instances:
+            try:
+                launch_instances = self._launch_new_instances(context, instance,
+                                        num_instances - len(pooled), params,
+                                        security_groups)
+            except:
+                # The caller gets an error, so the clones it claimed go back
+                # to the pool instead.
+                ei = sys.exc_info()
+                self._return_pooled_instances(context, pooled)
+                raise ei[0], ei[1], ei[2]
+        self._hand_over_pooled_instances(context, pooled_instances)
+        if pooled:
+            # The claimed clones are replaced in the background so that the
+            # launch does not wait for the new ones to be created.
+            self._refill_pool_async(context.elevated(), instance_uuid)
+
+        return self.get(context, (pooled_instances + launch_instances)[0]['uuid'])
+
+    def _launch_new_instances(self, context, instance, num_instances, params,
+                              security_groups):
+        """
+        Creates num_instances new launched instances of the live-image and
+        casts their launches to the hosts picked by the scheduler. Returns the
+        new instances.
+        """
+        instance_uuid = instance['uuid']
         reservations = self._acquire_addition_reservation(context, instance, num_instances)
 
         try:
-            launch_instances = []
             # We are handling num_instances in this (odd) way because this is how
             # standard nova handles it.
             availability_zone, forced_host, forced_node = \
@@ -472,29 +900,46 @@ class API(base.Base):
                 policy.enforce(context, 'compute:create:forced', {})
                 filter_properties['force_hosts'] = [forced_host]
 
-            for i in xrange(num_instances):
-                instance_params = params.copy()
-                # Create a new launched instance.
-                launch_instances.append(self._copy_instance(context, instance,
-                    instance_params.get('name', "%s-%s" %\
-                                        (instance['display_name'], "clone")),
-                    launch=True,
-                    new_user_data=instance_params.pop('user_data', None),
-                    security_groups=security_groups,
-                    key_name=instance_params.pop('key_name', None),
-                    launch_index=i,
-                    # Note this is after groking by handle_az above
-                    availability_zone=availability_zone))
-
+            instance_params = params.copy()
+            # Create the new launched instances.
+            launch_instances = self._copy_instances(context, instance,
+                instance_params.get('name', "%s-%s" %\
+                                    (instance['display_name'], "clone")),
+                num_instances,
+                launch=True,
+                new_user_data=instance_params.pop('user_data', None),
+                security_groups=security_groups,
+                key_name=instance_params.pop('key_name', None),
+                # Note this is after groking by handle_az above
+                availability_zone=availability_zone)
+            for launch_instance in launch_instances:
+                _instance_classes.put(launch_instance['uuid'],
+                                      InstanceClass(ROLE_LAUNCHED, instance_uuid,
+                                                    launch_instance['project_id']))
+
+            system_metadata = dict((entry.key, entry.value)
+                                   for entry in instance['system_metadata'])
             request_spec = self._create_request_spec(context, launch_instances,
-                                                     security_groups)
+                                security_groups,
+                                cached_hosts=cached_artifact_hosts(system_metadata))
             hosts = self.scheduler_rpcapi.select_hosts(context,request_spec,
                                                        filter_properties)
 
+            # Each host gets a single message with all of the instances that
+            # it was assigned so that it can share the work of launching them.
+            host_instances = {}
             for host, launch_instance in zip(hosts, launch_instances):
-                self._cast_cobalt_message('launch_instance', context,
-                    launch_instance, host,
-                    { "params" : params })
+                host_instances.setdefault(host, []).append(launch_instance)
+            for host, instances in host_instances.iteritems():
+                if len(instances) == 1:
+                    self._cast_cobalt_message('launch_instance', context,
+                        instances[0], host,
+                        { "params" : params })
+                else:
+                    self._cast_cobalt_host_message('launch_instances', context,
+                        host,
+                        { "instance_uuids" : [i['uuid'] for i in instances],
+                          "params" : params })
 
             self._commit_reservation(context, reservations)
         except:
@@ -502,10 +947,295 @@ class API(base.Base):
             self._rollback_reservation(context, reservations)
             raise ei[0], ei[1], ei[2]
 
-        return self.get(context, launch_instances[0]['uuid'])
+        return launch_instances
+
+    def _claim_pooled_instances(self, context, instance, num_instances, params,
+                                security_groups):
+        """
+        Claims up to num_instances of the paused clones in the pool of the
+        live-image for the caller. The pooled clones belong to the owner of
+        the live-image and already count against its quota, so only the owner
+        can claim them. Returns the (original, claimed) instances, which are
+        handed over by _hand_over_pooled_instances.
+        """
+        system_metadata = dict((entry.key, entry.value)
+                               for entry in instance['system_metadata'])
+        if pool_size(system_metadata) == 0:
+            return []
+        # The pooled clones were launched with the default security group and
+        # launch parameters, so a launch setting any other parameter is done
+        # from scratch rather than losing it.
+        launch_params = set([key for key, value in params.iteritems()
+                             if value is not None])
+        if len(launch_params - set(POOL_LAUNCH_PARAMS)) > 0 or \
+           security_groups != ['default']:
+            LOG.debug(_("Not using the pool of %s for a launch with %s"),
+                      instance['uuid'], ', '.join(sorted(launch_params)))
+            return []
+
+        updates = {}
+        name = params.get('name')
+        if name is not None:
+            updates['display_name'] = name
+
+        filters = {'metadata': {'launched_from': instance['uuid']},
+                   'task_state': POOLED,
+                   'project_id': context.project_id,
+                   'user_id': context.user_id,
+                   'deleted': False}
+        claimed = []
+        for pooled in self.db.instance_get_all_by_filters(context, filters):
+            if len(claimed) == num_instances:
+                break
+            values = dict(updates)
+            values['task_state'] = task_states.SPAWNING
+            # The claimed clone leaves the pool.
+            values['system_metadata'] = dict((entry.key, entry.value)
+                                    for entry in pooled['system_metadata']
+                                    if entry.key != POOL_HOST_KEY)
+            # Another launch may be claiming the same clone.
+            values['expected_task_state'] = POOLED
+            try:
+                claimed.append((pooled,
+                                self.db.instance_update(context,
+                                                        pooled['uuid'], values)))
+            except exception.UnexpectedTaskStateError:
+                continue
+        return claimed
+
+    def _hand_over_pooled_instances(self, context, claimed):
+        """ Tells the hosts of the claimed pooled clones to hand them over. """
+        for pooled in claimed:
+            LOG.debug(_("Claimed pooled instance %s"), pooled['uuid'])
+            self._cast_cobalt_message('claim_pooled_instance', context, pooled)
+
+    def _return_pooled_instances(self, context, claimed):
+        """
+        Puts the claimed pooled clones (as returned by _claim_pooled_instances)
+        back in the pool, as they were before they were claimed.
+        """
+        for original, pooled in claimed:
+            values = dict((key, original[key]) for key in POOL_CLAIM_FIELDS)
+            values['system_metadata'] = dict((entry.key, entry.value)
+                                    for entry in original['system_metadata'])
+            values['task_state'] = POOLED
+            values['expected_task_state'] = task_states.SPAWNING
+            try:
+                self.db.instance_update(context, pooled['uuid'], values)
+            except:
+                LOG.exception(_("Failed to return instance %s to the pool"),
+                              pooled['uuid'])
+
+    def set_pool_size(self, context, instance_uuid, size, host=None):
+        """
+        Sets the number of paused clones of the live-image kept ready for its
+        launches on the given host (by default the host of the instance it
+        was blessed from).
+        """
+        instance = self.get(context, instance_uuid)
+        if not self._is_instance_blessed(context, instance):
+            raise exception.NovaException(_(("Instance %s is not a live image. " +
+                                     "Only live images can have a pool.") % instance_uuid))
+        try:
+            size = int(size)
+            if size < 0:
+                raise ValueError()
+        except (TypeError, ValueError):
+            raise exception.NovaException(_('The pool size must be a positive integer'))
+
+        system_metadata = dict((entry.key, entry.value)
+                               for entry in instance['system_metadata'])
+        if host is None:
+            host = system_metadata.get(POOL_HOST_KEY)
+        if host is None:
+            host = self.get(context, system_metadata['blessed_from'])['host']
+        if host not in self._list_cobalt_hosts(context):
+            raise exception.NovaException(_("Cannot keep a pool on host %s because "
+                                            "it is not running the cobalt service.") % host)
+
+        self.db.instance_system_metadata_update(context, instance_uuid,
+                        {POOL_SIZE_KEY: str(size), POOL_HOST_KEY: host}, False)
+        self._refill_pool(context, instance_uuid)
+
+    def _owner_context(self, context, instance):
+        """ Returns an admin context acting for the owner of the instance. """
+        owner_context = context.elevated()
+        owner_context.user_id = instance['user_id']
+        owner_context.project_id = instance['project_id']
+        return owner_context
+
+    def _pooled_instances(self, context, instance):
+        """
+        Returns {host: clones} of the clones in the pool of the live-image
+        (the ones marked with the POOL_HOST_KEY of their host), whatever
+        their state, other than the ones being deleted.
+        """
+        hosts = dbapi.instance_children_system_metadata(context,
+                        instance['uuid'], dbapi.LAUNCHED_FROM, POOL_HOST_KEY)
+        pooled_instances = {}
+        if len(hosts) == 0:
+            return pooled_instances
+        filters = {'uuid': hosts.keys(), 'deleted': False}
+        for pooled in self.compute_api.get_all(context, filters,
+                                               want_objects=True):
+            if pooled['task_state'] != task_states.DELETING:
+                pooled_instances.setdefault(hosts[pooled['uuid']],
+                                            []).append(pooled)
+        return pooled_instances
+
+    def _delete_pooled_instance(self, context, pooled):
+        """
+        Deletes a clone of a pool. It leaves the pool first, with an update
+        conditional on its task state, so that it is not claimed or recorded
+        as pooled by its host meanwhile.
+        """
+        try:
+            self.db.instance_update(context, pooled['uuid'],
+                                    {'task_state': task_states.DELETING,
+                                     'expected_task_state':
+                                                    pooled['task_state']})
+        except exception.UnexpectedTaskStateError:
+            return
+        self.compute_api.delete(context, pooled)
+
+    def refill_pools(self, context):
+        """ Refills the pools of all of the live-images, one at a time. """
+        for instance_uuid in dbapi.instance_uuids_with_system_metadata(
+                                                    context, POOL_SIZE_KEY):
+            self._refill_pool_async(context, instance_uuid).wait()
+
+    def _refill_pool_async(self, context, instance_uuid):
+        """
+        Refills the pool of the live-image in a greenthread, which is
+        returned. A pool is only refilled by one greenthread of the process
+        at a time, the refills asked for meanwhile are done again once it is
+        over (the other processes are kept out by the lease of the pool, see
+        _refill_pool). A failed refill is logged and left to the periodic
+        one.
+        """
+        thread = _pool_refills.get(instance_uuid)
+        if thread is not None:
+            _pool_refills_requested.add(instance_uuid)
+            return thread
+
+        def _refill():
+            try:
+                while True:
+                    _pool_refills_requested.discard(instance_uuid)
+                    self._refill_pool(context, instance_uuid)
+                    if instance_uuid not in _pool_refills_requested:
+                        break
+            except exception.InstanceNotFound:
+                pass
+            except:
+                LOG.exception(_("Failed to refill the pool of %s"),
+                              instance_uuid)
+            finally:
+                del _pool_refills[instance_uuid]
+                _pool_refills_requested.discard(instance_uuid)
+
+        thread = greenthread.spawn(_refill)
+        _pool_refills[instance_uuid] = thread
+        return thread
 
-    def _create_request_spec(self, context, instances, security_groups):
-        """ Creates a scheduler request spec for the launch instances."""
+    def _refill_pool(self, context, instance_uuid):
+        """
+        Refills the pool of the live-image (see _fill_pool) unless another
+        refill holds its lease. Only one refill of a pool runs at a time,
+        whichever API process it runs in, so that they do not each create
+        the missing clones. A refill that finds the lease taken leaves the
+        pool to the one holding it, and the periodic refill catches up on
+        the claims that one missed.
+        """
+        holder = str(uuid.uuid4())
+        if not dbapi.instance_system_metadata_lease(context, instance_uuid,
+                                POOL_REFILL_KEY, holder, POOL_REFILL_LEASE):
+            LOG.debug(_("The pool of %s is already being refilled"),
+                      instance_uuid)
+            return
+        try:
+            # The pool is read once the lease is held, so that it includes
+            # the clones created by the previous refill.
+            self._fill_pool(context, self.get(context, instance_uuid), holder)
+        finally:
+            dbapi.instance_system_metadata_lease(context, instance_uuid,
+                                                 POOL_REFILL_KEY, holder, 0)
+
+    def _fill_pool(self, context, instance, holder):
+        """
+        Brings the number of clones in the pool of the live-image to the size
+        of its pool. The clones are created and reserved here for the owner of
+        the live-image, the pool host only launches and pauses them. The
+        clones that failed to launch, the paused ones left beyond the size
+        and the ones left on a previous pool host are deleted. The lease of
+        the refill (held by holder) is renewed before each clone is created.
+        """
+        system_metadata = dict((entry.key, entry.value)
+                               for entry in instance['system_metadata'])
+        host = system_metadata.get(POOL_HOST_KEY)
+        size = pool_size(system_metadata)
+        owner_context = self._owner_context(context, instance)
+
+        pools = self._pooled_instances(owner_context, instance)
+        pooled_instances = []
+        failed = []
+        for pooled in pools.pop(host, []):
+            if pooled['vm_state'] == vm_states.ERROR:
+                failed.append(pooled)
+            else:
+                pooled_instances.append(pooled)
+        excess = failed + pooled_instances[size:]
+        for other_host_instances in pools.itervalues():
+            excess += other_host_instances
+        for pooled in excess:
+            if pooled['task_state'] == POOL_SPAWNING and \
+               pooled['vm_state'] != vm_states.ERROR:
+                # Still launching, the next refill deletes it if needed.
+                continue
+            self._delete_pooled_instance(owner_context, pooled)
+
+        missing = size - len(pooled_instances)
+        if missing <= 0:
+            return
+        self.compute_api._check_requested_secgroups(owner_context, ['default'])
+        for i in xrange(missing):
+            if not dbapi.instance_system_metadata_lease(context,
+                                instance['uuid'], POOL_REFILL_KEY, holder,
+                                POOL_REFILL_LEASE):
+                LOG.warn(_("Lost the lease of the pool of %s"),
+                         instance['uuid'])
+                return
+            reservations = self._acquire_addition_reservation(owner_context,
+                                                              instance)
+            try:
+                pooled = self._copy_instance(owner_context, instance,
+                                "%s-pool" % instance['display_name'],
+                                launch=True, security_groups=['default'])
+                self.db.instance_system_metadata_update(owner_context,
+                                pooled['uuid'], {POOL_HOST_KEY: host}, False)
+                # The clone is kept out of the launches of the live-image
+                # until its host has paused it.
+                pooled = self.db.instance_update(owner_context, pooled['uuid'],
+                                                 {'host': host,
+                                                  'task_state': POOL_SPAWNING})
+                self._commit_reservation(owner_context, reservations)
+            except:
+                ei = sys.exc_info()
+                self._rollback_reservation(owner_context, reservations)
+                raise ei[0], ei[1], ei[2]
+            _instance_classes.put(pooled['uuid'],
+                                  InstanceClass(ROLE_LAUNCHED, instance['uuid'],
+                                                pooled['project_id']))
+            self._cast_cobalt_message('launch_pooled_instance', owner_context,
+                                      pooled, host=host)
+
+    def _create_request_spec(self, context, instances, security_groups,
+                             cached_hosts=None):
+        """
+        Creates a scheduler request spec for the launch instances. The hosts
+        that already have the artifacts of the live-image are passed along as
+        cobalt_cached_hosts (see cobalt.nova.scheduler).
+        """
         # Use the first instance as a representation for the entire group of
         # instances in the request.
         instance = instances[0]
@@ -537,7 +1267,8 @@ class API(base.Base):
             'instance_type': instance_type,
             'instance_uuids': [i['uuid'] for i in instances],
             'block_device_mapping': bdm,
-            'security_group': security_groups
+            'security_group': security_groups,
+            'cobalt_cached_hosts': cached_hosts or [],
         }
 
     def _find_migration_target(self, context, instance_host, dest):
@@ -581,43 +1312,147 @@ class API(base.Base):
                                        instance, host=instance['host'],
                                        params={"dest" : dest})
 
-    def list_launched_instances(self, context, instance_uuid):
+    def _get_instances(self, context, instance_uuids):
+        """ Returns the instances with the given uuids, in the same order. """
+        if len(instance_uuids) == 0:
+            return []
+        instances = self.compute_api.get_all(context,
+                                             {'uuid': instance_uuids,
+                                              'deleted': False})
+        instances = dict([(instance['uuid'], instance) for instance in instances])
+        return [instances[uuid] for uuid in instance_uuids if uuid in instances]
+
+    def list_launched_instances(self, context, instance_uuid, limit=None,
+                                marker=None):
+        """
+        Returns the instances launched from the live-image, oldest first. A page
+        starts after the marker instance and holds at most limit instances.
+        """
+        # Assert that the instance with the uuid actually exists.
+        self.get(context, instance_uuid)
+        return self._get_instances(context,
+                    dbapi.instance_children_uuids(context, instance_uuid,
+                                                  dbapi.LAUNCHED_FROM,
+                                                  limit=limit, marker=marker))
+
+    def list_blessed_instances(self, context, instance_uuid, limit=None,
+                               marker=None):
+        """
+        Returns the live-images blessed from the instance, oldest first. A page
+        starts after the marker instance and holds at most limit instances.
+        """
         # Assert that the instance with the uuid actually exists.
         self.get(context, instance_uuid)
-        filter = {
-                  'metadata':{'launched_from':'%s' % instance_uuid},
-                  'deleted':False
-                  }
-        launched_instances = self.compute_api.get_all(context, filter)
-        return launched_instances
-
-    def list_blessed_instances(self, context, instance_uuid):
+        return self._get_instances(context,
+                    dbapi.instance_children_uuids(context, instance_uuid,
+                                                  dbapi.BLESSED_FROM,
+                                                  limit=limit, marker=marker))
+
+    def get_lineage(self, context, instance_uuid, depth=None, fields=None):
+        """
+        Returns the lineage of the instance: its ancestors (the instances it was
+        blessed or launched from, the oldest first) and the tree of the
+        instances blessed and launched from it, down to the given depth. Each
+        instance is described by its uuid, how it relates to its parent
+        ('blessed_from' or 'launched_from') and the given fields. The tree is
+        read a level at a time rather than an instance at a time.
+        """
+        if fields is None:
+            fields = DEFAULT_LINEAGE_FIELDS
+        invalid_fields = set(fields) - set(LINEAGE_FIELDS)
+        if len(invalid_fields) > 0:
+            raise exception.NovaException(_("Invalid lineage fields: %s") %
+                                          ', '.join(sorted(invalid_fields)))
+        if depth is not None:
+            try:
+                depth = int(depth)
+                if depth < 0:
+                    raise ValueError()
+            except (TypeError, ValueError):
+                raise exception.NovaException(_('depth must be a positive integer'))
+
         # Assert that the instance with the uuid actually exists.
         self.get(context, instance_uuid)
-        filter = {
-                  'metadata':{'blessed_from':'%s' % instance_uuid},
-                  'deleted':False
-                  }
-        blessed_instances = self.compute_api.get_all(context, filter)
-        return blessed_instances
+
+        # The relation of each ancestor is the key of the next one's link.
+        ancestry = dbapi.instance_ancestors(context, instance_uuid)
+        relations = [key for key, parent_uuid in ancestry] + [None]
+        ancestor_nodes = [{'uuid': parent_uuid, 'relation': relations[i + 1]}
+                          for i, (key, parent_uuid) in enumerate(ancestry)]
+        ancestor_nodes.reverse()
+
+        root = {'uuid': instance_uuid, 'relation': relations[0]}
+        nodes = {instance_uuid: root}
+        frontier = [instance_uuid]
+        level = 0
+        while len(frontier) > 0 and (depth is None or level < depth):
+            next_frontier = []
+            for parent_uuid, key, child_uuid in \
+                    dbapi.instance_children(context, frontier):
+                if child_uuid in nodes:
+                    continue
+                node = {'uuid': child_uuid, 'relation': key}
+                nodes[child_uuid] = node
+                nodes[parent_uuid].setdefault('children', []).append(node)
+                next_frontier.append(child_uuid)
+            frontier = next_frontier
+            level += 1
+
+        all_nodes = nodes.values() + ancestor_nodes
+        if len(fields) > 0:
+            values = dbapi.instance_get_fields(context,
+                            [node['uuid'] for node in all_nodes], fields)
+            for node in all_nodes:
+                # Deleted ancestors only have their uuid.
+                node.update(values.get(node['uuid'], {}))
+
+        return jsonutils.to_primitive({'ancestors': ancestor_nodes,
+                                       'instance': root})
+
+    def count_launched_instances(self, context, instance_uuid,
+                                 include_pooled=True):
+        """
+        Returns the number of instances launched from the live-image. Unless
+        include_pooled is set, the clones of its pool are left out, whatever
+        their state.
+        """
+        return dbapi.instance_children_count(context, instance_uuid,
+                        dbapi.LAUNCHED_FROM,
+                        exclude_system_metadata_key=(not include_pooled and
+                                                     POOL_HOST_KEY or None))
 
     def check_delete(self, context, instance_uuid):
         """ Raises an error if the instance uuid is blessed. """
         try:
-            instance = self.get(context, instance_uuid)
-            if self._is_instance_blessed(context, instance):
+            # Only the instance's class and states are read, not the whole
+            # instance. When its class is cached only its states are read:
+            # they tell whether it is blessing, and whether it still exists
+            # (a live-image may have been discarded through another API
+            # process).
+            instance_class = _instance_classes.get(context, instance_uuid)
+            if instance_class is None:
+                instance_class, state = self._load_instance_class(context,
+                                                              instance_uuid)
+            else:
+                state = dbapi.instance_get_fields(context, [instance_uuid],
+                                    ['vm_state', 'task_state']).get(instance_uuid)
+                if state is None:
+                    raise exception.InstanceNotFound(instance_id=instance_uuid)
+            if instance_class.role == ROLE_BLESSED:
                 raise exception.NovaException("Cannot delete a live image. "
                                               "Please discard it instead.")
-            if self._is_instance_blessing(context, instance):
+            if self._is_instance_blessing(context, state):
                 raise exception.NovaException("Cannot delete while blessing. "
                                               "Please try again later.")
+            # The instance is about to be deleted.
+            _instance_classes.invalidate(instance_uuid)
         except exception.InstanceNotFound:
             # NOTE(dscannell): Ignore this error because this can race with
             #                  actual deletion of the instance. If the instance
             #                  can no longer be found then it is deleted and
             #                  there is no need to alert the user by raising
             #                  an exception.
-            pass
+            _instance_classes.invalidate(instance_uuid)
 
     def export_blessed_instance(self, context, instance_uuid):
         """
@@ -712,34 +1547,116 @@ class API(base.Base):
 
         return self.get(context, instance['uuid'])
 
-    def install_policy(self, context, policy_ini_string, wait):
-        validated = False
-        faults = []
-        for host in self._list_cobalt_hosts(context):
-            queue = rpc.queue_get_for(context, CONF.cobalt_topic, host)
-            args = {
-                "method": "install_policy",
-                "args" : { "policy_ini_string": policy_ini_string },
-            }
+    def _install_policy_message(self, policy_ini_string, expected_hash, force):
+        # The host skips the install when it already has the policy with
+        # expected_hash (unless force is set).
+        args = {"policy_ini_string": policy_ini_string,
+                "policy_hash": expected_hash}
+        if force:
+            args['force'] = True
+        return {"method": "install_policy", "args": args}
+
+    def _install_host_policy(self, context, host, policy_ini_string,
+                             expected_hash, deadline, force=False):
+        """
+        Installs the policy on one host unless it already has it (or force is
+        set). Returns the host's result as {'status', 'latency'[, 'error']}.
+        """
+        start = time.time()
+        queue = rpc.queue_get_for(context, CONF.cobalt_topic, host)
 
-            if (not validated) or wait:
-                try:
-                    rpc.call(context, queue, args)
-                    validated = True
-                except Exception, ex:
-                    faults.append((host, str(ex)))
-                    if not wait:
-                        raise exception.NovaException(
-                            _("Failed to install policy on host %s: %s" % \
-                                (host, str(ex))))
-            else:
-                rpc.cast(context, queue, args)
+        result = {}
+        try:
+            if time.time() >= deadline:
+                result['status'] = 'timeout'
+                return result
+
+            status = rpc.call(context, queue,
+                              self._install_policy_message(policy_ini_string,
+                                                           expected_hash, force),
+                              timeout=max(1, int(deadline - time.time())))
+            # A host that does not report what it did has installed it.
+            result['status'] = status or 'installed'
+        except Timeout:
+            result['status'] = 'timeout'
+        except Exception, ex:
+            result['status'] = 'failed'
+            result['error'] = str(ex)
+        finally:
+            result['latency'] = time.time() - start
+        return result
 
-        if len(faults) > 0:
-            raise exception.NovaException(
-                _("Failed to install policy on %d hosts, faults:\n%s") % \
-                    (len(faults), '\n'.join([ host + ": " + str(fault).strip()
-                        for host, fault in faults ])))
+    def install_policy(self, context, policy_ini_string, wait, force=False):
+        """
+        Installs the policy on all of the cobalt hosts and returns
+        {host: {'status', 'latency'[, 'error']}}. The status is one of
+        'installed', 'unchanged' (the host already had the policy), 'sent'
+        (not waited for), 'failed' or 'timeout'.
+
+        Without wait, the policy is validated by installing it on the first
+        host and sent to the others without waiting. With force, the policy
+        is installed again on the hosts that already have it.
+        """
+        hosts = self._list_cobalt_hosts(context)
+        expected_hash = policy_hash(policy_ini_string)
+        deadline = time.time() + CONF.cobalt_policy_install_timeout
+
+        report = {}
+        if not wait and len(hosts) > 0:
+            first_host = hosts.pop(0)
+            report[first_host] = self._install_host_policy(context, first_host,
+                                        policy_ini_string, expected_hash, deadline,
+                                        force=force)
+            if report[first_host]['status'] not in POLICY_INSTALL_SUCCESS:
+                raise PolicyInstallFailed(report)
+            for host in hosts:
+                queue = rpc.queue_get_for(context, CONF.cobalt_topic, host)
+                rpc.cast(context, queue,
+                         self._install_policy_message(policy_ini_string,
+                                                      expected_hash, force))
+                report[host] = {'status': 'sent', 'latency': 0.0}
+            return report
+
+        results = common.run_concurrently(
+                        lambda host: self._install_host_policy(context, host,
+                                        policy_ini_string, expected_hash, deadline,
+                                        force=force),
+                        [(host,) for host in hosts],
+                        CONF.cobalt_policy_install_concurrency)
+        report = dict(zip(hosts, results))
+        for result in results:
+            if result['status'] not in POLICY_INSTALL_SUCCESS:
+                raise PolicyInstallFailed(report)
+        return report
+
+    def get_metrics(self, context, host=None):
+        """
+        Returns the latency metrics of the cobalt operations as
+        {host: metrics} for the given host or all of the cobalt hosts. The
+        hosts are asked concurrently. A host that could not report its
+        metrics has {'status': 'failed' or 'timeout'[, 'error']} instead.
+        """
+        if host is not None:
+            hosts = [host]
+        else:
+            hosts = self._list_cobalt_hosts(context)
+
+        admin_context = context.elevated()
+        def _get_host_metrics(host):
+            queue = rpc.queue_get_for(admin_context, CONF.cobalt_topic, host)
+            try:
+                return rpc.call(admin_context, queue,
+                                {"method": "get_metrics", "args": {}},
+                                timeout=CONF.cobalt_metrics_timeout)
+            except Timeout:
+                return {'status': 'timeout'}
+            except Exception, ex:
+                return {'status': 'failed', 'error': str(ex)}
+
+        results = common.run_concurrently(_get_host_metrics,
+                                          [(host,) for host in hosts],
+                                          CONF.cobalt_metrics_concurrency)
+        return dict(zip(hosts, results))
 
     def _find_boot_host(self, context, metadata):
 
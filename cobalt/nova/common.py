@@ -0,0 +1,91 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Helpers shared by the cobalt API, the cobalt manager and the vms connection.
+This module must stay free of imports from the rest of cobalt so that any of
+them can use it.
+"""
+
+import hashlib
+import sys
+
+from eventlet import greenpool
+
+# The system metadata key recording on a live-image that all of its artifacts
+# are in the local cache of a host (see cached_artifact_hosts).
+CACHED_ARTIFACTS_KEY = 'cobalt_cached_on:%s'
+
+def cached_artifact_hosts(system_metadata):
+    """
+    Returns the hosts that hold all of the artifacts of the live-image with
+    the given system metadata ({key: value}) in their local cache.
+    """
+    prefix = CACHED_ARTIFACTS_KEY % ''
+    return sorted([key[len(prefix):] for key, value in system_metadata.iteritems()
+                   if key.startswith(prefix) and value == '1'])
+
+# The system metadata keys recording on a live-image how many paused clones
+# are kept ready for its launches and on which host (see pool_size). The
+# clones in the pool are marked with the POOL_HOST_KEY of their host until
+# they are claimed.
+POOL_SIZE_KEY = 'cobalt_pool_size'
+POOL_HOST_KEY = 'cobalt_pool_host'
+
+# The system metadata key of the lease taken on a live-image by the refill of
+# its pool, so that a single API process refills it at a time.
+POOL_REFILL_KEY = 'cobalt_pool_refill'
+
+# The task state of the pooled clones that are ready to be claimed.
+POOLED = 'pooled'
+
+# The task state of the pooled clones while their host launches them.
+POOL_SPAWNING = 'pool_spawning'
+
+def pool_size(system_metadata):
+    """
+    Returns the number of paused clones kept ready for the launches of the
+    live-image with the given system metadata ({key: value}).
+    """
+    try:
+        return max(0, int(system_metadata.get(POOL_SIZE_KEY, 0)))
+    except ValueError:
+        return 0
+
+def policy_hash(policy_ini_string):
+    """ Returns the hash identifying the contents of a policy. """
+    return hashlib.sha1(policy_ini_string or '').hexdigest()
+
+def run_concurrently(fn, args_list, concurrency):
+    """
+    Calls fn with each tuple of arguments in args_list, at most concurrency
+    calls at a time, and returns the results in order. Every call is allowed
+    to finish before the first failure (if any) is raised.
+    """
+    pool = greenpool.GreenPool(max(1, concurrency))
+    threads = [pool.spawn(fn, *args) for args in args_list]
+
+    results = []
+    failure = None
+    for thread in threads:
+        try:
+            results.append(thread.wait())
+        except Exception:
+            if failure is None:
+                failure = sys.exc_info()
+            results.append(None)
+    if failure is not None:
+        raise failure[0], failure[1], failure[2]
+    return results
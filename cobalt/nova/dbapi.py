@@ -0,0 +1,533 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Bulk database operations used by the cobalt API. The nova db api only works
+on one row at a time, which makes launching many instances at once cost a
+round trip per row (or several, for an instance and its related rows).
+
+The counters (and leases) kept in the instance metadata are moved forward
+with a conditional update of their row. The lineage queries look instances up
+by their parent (see LINEAGE_KEYS) without loading every matching instance,
+through the LINEAGE_INDEX created at install time by cobalt-lineage-index
+(see ensure_lineage_index).
+"""
+
+import time
+import uuid
+
+from eventlet import greenthread
+from sqlalchemy import and_
+from sqlalchemy import Index
+from sqlalchemy.sql import exists
+from sqlalchemy.engine import reflection
+from sqlalchemy.orm import aliased
+
+from nova import exception
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
+from nova.openstack.common.gettextutils import _
+from oslo.config import cfg
+
+CONF = cfg.CONF
+CONF.import_opt('osapi_compute_unique_server_name_scope',
+                'nova.db.sqlalchemy.api')
+
+# The number of rows updated per transaction by the batched updates.
+UPDATE_BATCH_SIZE = 500
+
+# The number of times a counter allocation is retried when it loses a race
+# with a concurrent one.
+COUNTER_MAX_RETRIES = 20
+
+# The instance metadata keys recording the parent of the blessed and launched
+# instances.
+BLESSED_FROM = 'blessed_from'
+LAUNCHED_FROM = 'launched_from'
+LINEAGE_KEYS = (BLESSED_FROM, LAUNCHED_FROM)
+
+# The number of generations of ancestors read by each query of
+# instance_ancestors.
+ANCESTOR_LEVELS = 8
+
+# The index of the instance metadata by key and value, which the lineage
+# queries use to find the children of a parent. nova only indexes the
+# metadata by instance.
+LINEAGE_INDEX = 'cobalt_instance_metadata_lineage_idx'
+
+# The number of characters of the key and value columns that LINEAGE_INDEX
+# covers on MySQL, whose InnoDB indexes are limited to 767 bytes (255
+# characters of each column in utf8 are not). The lineage keys and the uuids
+# they hold are shorter.
+LINEAGE_INDEX_KEY_LENGTH = 32
+LINEAGE_INDEX_VALUE_LENGTH = 64
+
+def ensure_lineage_index():
+    """
+    Creates LINEAGE_INDEX unless the instance metadata table already has it.
+    Returns True if it was created. This changes nova's schema, so it is only
+    run by an administrator at install time (see bin/cobalt-lineage-index).
+    """
+    engine = db_api.get_engine()
+    table = models.InstanceMetadata.__table__
+    inspector = reflection.Inspector.from_engine(engine)
+    if LINEAGE_INDEX in [index['name'] for index in
+                         inspector.get_indexes(table.name)]:
+        return False
+    if engine.name == 'mysql':
+        engine.execute("CREATE INDEX %s ON %s (`key`(%d), `value`(%d))" %
+                       (LINEAGE_INDEX, table.name, LINEAGE_INDEX_KEY_LENGTH,
+                        LINEAGE_INDEX_VALUE_LENGTH))
+    else:
+        Index(LINEAGE_INDEX, table.c.key, table.c.value).create(engine)
+    return True
+
+def _children_query(context, session, parent_uuid, key):
+    query = db_api.model_query(context, models.Instance.uuid,
+                               base_model=models.Instance,
+                               session=session, read_deleted="no").\
+        join(models.InstanceMetadata,
+             models.InstanceMetadata.instance_uuid == models.Instance.uuid).\
+        filter(models.InstanceMetadata.key == key).\
+        filter(models.InstanceMetadata.value == parent_uuid).\
+        filter(models.InstanceMetadata.deleted == 0)
+    if not context.is_admin:
+        query = query.filter(models.Instance.project_id == context.project_id)
+    return query
+
+def _batches(items, size=UPDATE_BATCH_SIZE):
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+def instance_ancestors(context, instance_uuid):
+    """
+    Returns the (lineage key, parent uuid) of the instance, of its parent and
+    so on, the closest first. The lineage metadata is joined to itself to read
+    ANCESTOR_LEVELS generations per query. The ancestry stops at the first
+    parent that is deleted or, for a non-admin context, in another project.
+    """
+    ancestors = []
+    seen = set([instance_uuid])
+    session = db_api.get_session()
+    current_uuid = instance_uuid
+    while current_uuid is not None:
+        # The first link is the metadata model itself, which model_query
+        # filters on deleted.
+        links = [models.InstanceMetadata] + \
+                [aliased(models.InstanceMetadata)
+                 for i in range(ANCESTOR_LEVELS - 1)]
+        parents = [aliased(models.Instance) for i in range(ANCESTOR_LEVELS)]
+        columns = []
+        for link, parent in zip(links, parents):
+            columns.extend([link.key, link.value, parent.uuid])
+        query = db_api.model_query(context, *columns,
+                                   base_model=models.InstanceMetadata,
+                                   session=session, read_deleted="no").\
+            filter(links[0].instance_uuid == current_uuid).\
+            filter(links[0].key.in_(LINEAGE_KEYS))
+        for i, (link, parent) in enumerate(zip(links, parents)):
+            if i > 0:
+                # Only the parents the caller can see are followed.
+                query = query.outerjoin(link,
+                            and_(link.instance_uuid == parents[i - 1].uuid,
+                                 link.key.in_(LINEAGE_KEYS),
+                                 link.deleted == 0))
+            visible = [parent.uuid == link.value, parent.deleted == 0]
+            if not context.is_admin:
+                visible.append(parent.project_id == context.project_id)
+            query = query.outerjoin(parent, and_(*visible))
+        row = query.first()
+
+        current_uuid = None
+        if row is None:
+            break
+        for key, parent_uuid, visible_uuid in \
+                zip(row[0::3], row[1::3], row[2::3]):
+            if visible_uuid is None or parent_uuid in seen:
+                current_uuid = None
+                break
+            ancestors.append((key, parent_uuid))
+            seen.add(parent_uuid)
+            current_uuid = parent_uuid
+    return ancestors
+
+def instance_children(context, parent_uuids):
+    """
+    Returns the (parent uuid, lineage key, child uuid) of all of the instances
+    blessed or launched from the given ones, in creation order.
+    """
+    children = []
+    session = db_api.get_session()
+    for batch in _batches(parent_uuids):
+        query = db_api.model_query(context, models.InstanceMetadata.value,
+                                   models.InstanceMetadata.key,
+                                   models.Instance.uuid,
+                                   base_model=models.Instance,
+                                   session=session, read_deleted="no").\
+            join(models.InstanceMetadata,
+                 models.InstanceMetadata.instance_uuid == models.Instance.uuid).\
+            filter(models.InstanceMetadata.key.in_(LINEAGE_KEYS)).\
+            filter(models.InstanceMetadata.value.in_(batch)).\
+            filter(models.InstanceMetadata.deleted == 0)
+        if not context.is_admin:
+            query = query.filter(models.Instance.project_id == context.project_id)
+        children.extend(query.order_by(models.Instance.id).all())
+    return children
+
+def instance_classify(context, instance_uuid):
+    """
+    Returns the project, vm and task states, lineage key and parent uuid (both
+    None when the instance was neither blessed nor launched) of the instance
+    as a dict, without loading its joined rows. Raises InstanceNotFound.
+    """
+    query = db_api.model_query(context, models.Instance.project_id,
+                               models.Instance.vm_state,
+                               models.Instance.task_state,
+                               models.InstanceMetadata.key,
+                               models.InstanceMetadata.value,
+                               base_model=models.Instance, read_deleted="no").\
+        outerjoin(models.InstanceMetadata,
+                  and_(models.InstanceMetadata.instance_uuid == models.Instance.uuid,
+                       models.InstanceMetadata.key.in_(LINEAGE_KEYS),
+                       models.InstanceMetadata.deleted == 0)).\
+        filter(models.Instance.uuid == instance_uuid)
+    if not context.is_admin:
+        query = query.filter(models.Instance.project_id == context.project_id)
+    row = query.first()
+    if row is None:
+        raise exception.InstanceNotFound(instance_id=instance_uuid)
+    return dict(zip(('project_id', 'vm_state', 'task_state', 'lineage_key',
+                     'parent_uuid'), row))
+
+def instance_get_fields(context, instance_uuids, fields):
+    """
+    Returns {uuid: {field: value}} with the given columns of the (non deleted)
+    instances.
+    """
+    columns = [getattr(models.Instance, field) for field in fields]
+    instances = {}
+    session = db_api.get_session()
+    for batch in _batches(instance_uuids):
+        query = db_api.model_query(context, models.Instance.uuid, *columns,
+                                   base_model=models.Instance,
+                                   session=session, read_deleted="no").\
+            filter(models.Instance.uuid.in_(batch))
+        if not context.is_admin:
+            query = query.filter(models.Instance.project_id == context.project_id)
+        for row in query.all():
+            instances[row[0]] = dict(zip(fields, row[1:]))
+    return instances
+
+def instance_uuids_with_system_metadata(context, key):
+    """
+    Returns the uuids of the (non deleted) instances that have the given key
+    in their system metadata, whatever its value.
+    """
+    query = db_api.model_query(context, models.Instance.uuid,
+                               base_model=models.Instance,
+                               read_deleted="no").\
+        join(models.InstanceSystemMetadata,
+             models.InstanceSystemMetadata.instance_uuid == models.Instance.uuid).\
+        filter(models.InstanceSystemMetadata.key == key).\
+        filter(models.InstanceSystemMetadata.deleted == 0)
+    return [row[0] for row in query.all()]
+
+def instance_children_uuids(context, parent_uuid, key, limit=None,
+                            marker=None):
+    """
+    Returns the uuids of the instances blessed or launched (according to the
+    lineage key) from parent_uuid, in creation order. When given a marker (the
+    last uuid of the previous page), only the instances created after it are
+    returned, at most limit of them.
+    """
+    session = db_api.get_session()
+    query = _children_query(context, session, parent_uuid, key).\
+                order_by(models.Instance.id)
+    if marker is not None:
+        marker_id = session.query(models.Instance.id).\
+                        filter_by(uuid=marker).scalar()
+        if marker_id is None:
+            raise exception.MarkerNotFound(marker=marker)
+        query = query.filter(models.Instance.id > marker_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return [row[0] for row in query.all()]
+
+def _system_metadata_marked(key):
+    return exists().where(and_(
+        models.InstanceSystemMetadata.instance_uuid == models.Instance.uuid,
+        models.InstanceSystemMetadata.key == key,
+        models.InstanceSystemMetadata.deleted == 0))
+
+def instance_children_count(context, parent_uuid, key,
+                            exclude_system_metadata_key=None):
+    """
+    Returns the number of instances blessed or launched (according to the
+    lineage key) from parent_uuid, not counting the ones that have
+    exclude_system_metadata_key in their system metadata.
+    """
+    session = db_api.get_session()
+    query = _children_query(context, session, parent_uuid, key)
+    if exclude_system_metadata_key is not None:
+        query = query.filter(
+                    ~_system_metadata_marked(exclude_system_metadata_key))
+    return query.count()
+
+def instance_children_system_metadata(context, parent_uuid, key,
+                                      system_metadata_key):
+    """
+    Returns {uuid: value} of system_metadata_key for the instances blessed or
+    launched (according to the lineage key) from parent_uuid that have it in
+    their system metadata.
+    """
+    session = db_api.get_session()
+    query = _children_query(context, session, parent_uuid, key).\
+        join(models.InstanceSystemMetadata,
+             models.InstanceSystemMetadata.instance_uuid == models.Instance.uuid).\
+        filter(models.InstanceSystemMetadata.key == system_metadata_key).\
+        filter(models.InstanceSystemMetadata.deleted == 0).\
+        add_columns(models.InstanceSystemMetadata.value)
+    return dict(query.all())
+
+def _counter_query(context, session, instance_uuid, key):
+    return db_api.model_query(context, models.InstanceMetadata,
+                              session=session, read_deleted="no").\
+        filter_by(instance_uuid=instance_uuid, key=key)
+
+def instance_metadata_counter_allocate(context, instance_uuid, key, count=1):
+    """
+    Allocates count consecutive numbers (starting at 0) from the counter kept
+    under key in the instance metadata and returns the first one. Only the
+    counter row is touched: it is moved forward with an update conditional on
+    its previous value, retried when a concurrent allocation got there first.
+    """
+    if count < 1:
+        raise exception.InvalidInput(reason=_("count must be at least 1"))
+
+    for attempt in xrange(COUNTER_MAX_RETRIES):
+        session = db_api.get_session()
+        counter = _counter_query(context, session, instance_uuid, key).\
+            order_by(models.InstanceMetadata.id).first()
+        if counter is None:
+            row = models.InstanceMetadata()
+            row.update({'instance_uuid': instance_uuid,
+                        'key': key,
+                        'value': str(count - 1)})
+            with session.begin():
+                session.add(row)
+            # Concurrent allocations may both create the counter. The oldest
+            # row is the counter, the others are dropped and retried.
+            counter = _counter_query(context, session, instance_uuid, key).\
+                order_by(models.InstanceMetadata.id).first()
+            if counter.id == row.id:
+                return 0
+            _counter_query(context, session, instance_uuid, key).\
+                filter_by(id=row.id).soft_delete(synchronize_session=False)
+            continue
+
+        last = int(counter.value)
+        with session.begin():
+            updated = _counter_query(context, session, instance_uuid, key).\
+                filter_by(id=counter.id, value=counter.value).\
+                update({'value': str(last + count)}, synchronize_session=False)
+        if updated == 1:
+            return last + 1
+        greenthread.sleep(0)
+
+    raise exception.NovaException(_("Failed to allocate from counter %s of "
+                                    "instance %s") % (key, instance_uuid))
+
+def _system_metadata_query(context, session, instance_uuid, key):
+    return db_api.model_query(context, models.InstanceSystemMetadata,
+                              session=session, read_deleted="no").\
+        filter_by(instance_uuid=instance_uuid, key=key)
+
+def _parse_lease(value):
+    # A lease is recorded as "<expiry time> <holder>".
+    try:
+        expiry, holder = value.split(' ', 1)
+        return float(expiry), holder
+    except (AttributeError, ValueError):
+        return 0, None
+
+def instance_system_metadata_lease(context, instance_uuid, key, holder,
+                                   duration):
+    """
+    Takes the lease kept under key in the system metadata of the instance for
+    holder, for duration seconds, or renews it if holder already has it. A
+    duration of 0 releases the lease. Returns False if another holder has a
+    lease that has not expired yet. Like the counters, the lease row is only
+    changed with an update conditional on its previous value.
+    """
+    for attempt in xrange(COUNTER_MAX_RETRIES):
+        now = time.time()
+        value = '%.3f %s' % (now + duration, holder)
+        session = db_api.get_session()
+        lease = _system_metadata_query(context, session, instance_uuid, key).\
+            order_by(models.InstanceSystemMetadata.id).first()
+        if lease is None:
+            row = models.InstanceSystemMetadata()
+            row.update({'instance_uuid': instance_uuid,
+                        'key': key,
+                        'value': value})
+            with session.begin():
+                session.add(row)
+            # Concurrent holders may both create the lease. The oldest row is
+            # the lease, the others are dropped and retried.
+            lease = _system_metadata_query(context, session, instance_uuid,
+                                           key).\
+                order_by(models.InstanceSystemMetadata.id).first()
+            if lease.id == row.id:
+                return True
+            _system_metadata_query(context, session, instance_uuid, key).\
+                filter_by(id=row.id).soft_delete(synchronize_session=False)
+            continue
+
+        expiry, current_holder = _parse_lease(lease.value)
+        if current_holder != holder and expiry > now:
+            return False
+        with session.begin():
+            updated = _system_metadata_query(context, session, instance_uuid,
+                                             key).\
+                filter_by(id=lease.id, value=lease.value).\
+                update({'value': value}, synchronize_session=False)
+        if updated == 1:
+            return True
+        greenthread.sleep(0)
+    return False
+
+def _insert_all(session, model, rows):
+    # A single executemany insert of all of the rows.
+    if len(rows) > 0:
+        session.execute(model.__table__.insert(), rows)
+
+def instance_create_all(context, values_list):
+    """
+    Creates all of the instances in a single transaction and returns their
+    uuids. Like instance_create, the values may hold the metadata and system
+    metadata as dicts, the names of the security groups and the values of the
+    info cache; the rows of each kind are inserted with one statement. All of
+    the values must have the same keys.
+    """
+    if len(values_list) == 0:
+        return []
+    instances = []
+    metadata = []
+    system_metadata = []
+    info_caches = []
+    security_group_names = set()
+    for values in values_list:
+        values = values.copy()
+        values.setdefault('uuid', str(uuid.uuid4()))
+        for key, value in values.pop('metadata', {}).iteritems():
+            metadata.append({'instance_uuid': values['uuid'],
+                             'key': key, 'value': value})
+        for key, value in values.pop('system_metadata', {}).iteritems():
+            system_metadata.append({'instance_uuid': values['uuid'],
+                                    'key': key, 'value': value})
+        info_cache = dict(values.pop('info_cache', None) or {})
+        info_cache['instance_uuid'] = values['uuid']
+        info_caches.append(info_cache)
+        values['security_groups'] = values.get('security_groups') or []
+        security_group_names.update(values['security_groups'])
+        instances.append(values)
+
+    session = db_api.get_session()
+    with session.begin():
+        hostnames = set([values['hostname'] for values in instances
+                         if values.get('hostname')])
+        for hostname in hostnames:
+            db_api._validate_unique_server_name(context, session, hostname)
+        # The copies share their hostname, so there can only be one of them
+        # when the names are unique.
+        if len(hostnames) > 0 and len(hostnames) < len(instances) and \
+           CONF.osapi_compute_unique_server_name_scope:
+            raise exception.InstanceExists(name=sorted(hostnames)[0].lower())
+
+        # Same as instance_create: the default group is created on demand.
+        security_groups = {}
+        if 'default' in security_group_names:
+            security_groups['default'] = \
+                db_api.security_group_ensure_default(context)
+        others = list(security_group_names - set(['default']))
+        if len(others) > 0:
+            for group in db_api._security_group_get_by_names(context, session,
+                                                context.project_id, others):
+                security_groups[group['name']] = group
+        associations = []
+        for values in instances:
+            for name in values.pop('security_groups'):
+                associations.append({'instance_uuid': values['uuid'],
+                                     'security_group_id':
+                                        security_groups[name]['id']})
+
+        _insert_all(session, models.Instance, instances)
+        _insert_all(session, models.InstanceMetadata, metadata)
+        _insert_all(session, models.InstanceSystemMetadata, system_metadata)
+        _insert_all(session, models.InstanceInfoCache, info_caches)
+        _insert_all(session, models.SecurityGroupInstanceAssociation,
+                    associations)
+        # The uuid to ec2 id mappings, which instance_create adds as well.
+        _insert_all(session, models.InstanceIdMapping,
+                    [{'uuid': values['uuid']} for values in instances])
+    return [values['uuid'] for values in instances]
+
+def instance_update_all_matching(context, conditions, values,
+                                 batch_size=UPDATE_BATCH_SIZE):
+    """
+    Updates the (non deleted) instances whose columns match the conditions
+    ({column: value}) with values, batch_size rows per transaction. The values
+    must not match the conditions anymore. Returns the number of instances
+    updated.
+    """
+    updated = 0
+    while True:
+        session = db_api.get_session()
+        with session.begin():
+            query = db_api.model_query(context, models.Instance.id,
+                                       base_model=models.Instance,
+                                       session=session, read_deleted="no")
+            for column, value in conditions.iteritems():
+                query = query.filter(getattr(models.Instance, column) == value)
+            ids = [row[0] for row in query.limit(batch_size).all()]
+            if len(ids) > 0:
+                db_api.model_query(context, models.Instance,
+                                   session=session, read_deleted="no").\
+                    filter(models.Instance.id.in_(ids)).\
+                    update(values, synchronize_session=False)
+        updated += len(ids)
+        if len(ids) < batch_size:
+            return updated
+        # Let the other greenthreads run between the batches.
+        greenthread.sleep(0)
+
+def block_device_mapping_create_all(context, values_list):
+    """
+    Creates all of the block device mappings (in the new, non-legacy,
+    format) in a single transaction.
+    """
+    if len(values_list) == 0:
+        return
+    session = db_api.get_session()
+    with session.begin():
+        for values in values_list:
+            values = values.copy()
+            # Same as block_device_mapping_create: an empty size means none.
+            if values.get('volume_size') == '':
+                values['volume_size'] = None
+            bdm_ref = models.BlockDeviceMapping()
+            bdm_ref.update(values)
+            session.add(bdm_ref)
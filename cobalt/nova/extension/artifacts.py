@@ -0,0 +1,306 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A local cache for the live-image artifacts (descriptors, disks and memory)
+downloaded from the image service.
+
+The artifacts live in the base directory under the file name vms expects. An
+index stored next to them records the image id, checksum, size and last use
+of every artifact so that a cached copy is only used if it matches what is
+in the image service, and so that the least recently used artifacts can be
+evicted once the cache is over its byte budget.
+"""
+
+import copy
+import errno
+import json
+import os
+import tempfile
+import time
+
+from nova import utils
+from nova.openstack.common import log as logging
+from oslo.config import cfg
+
+from nova.openstack.common.gettextutils import _
+
+from .. import image as co_image
+
+LOG = logging.getLogger('nova.cobalt.artifacts')
+CONF = cfg.CONF
+
+artifacts_opts = [
+               cfg.IntOpt('cobalt_artifact_cache_max_bytes',
+               default=0,
+               help='The number of bytes of live-image artifacts kept in the '
+                    'local cache. The least recently used artifacts that are '
+                    'not used by running instances are evicted once the cache '
+                    'grows past this size. 0 means the cache is unbounded.')]
+CONF.register_opts(artifacts_opts)
+
+INDEX_NAME = '.cobalt-artifacts.json'
+
+# The last use of a cached artifact is recorded at most once per this many
+# seconds, so that every cache hit does not rewrite the index.
+LAST_USED_RESOLUTION = 60
+
+class ArtifactCache(object):
+
+    def __init__(self, base_path, uid, gid, lock_path=None, max_bytes=None):
+        self.base_path = base_path
+        self.index_path = os.path.join(base_path, INDEX_NAME)
+        self.uid = uid
+        self.gid = gid
+        self.lock_path = lock_path if lock_path is not None else \
+                                    os.path.join(CONF.instances_path, 'locks')
+        self.max_bytes = max_bytes if max_bytes is not None else \
+                                    CONF.cobalt_artifact_cache_max_bytes
+
+        # Image ids of the artifacts backing running instances. These are
+        # never evicted. It is None until set_in_use() is first called and
+        # nothing is evicted before then, as the artifacts of the instances
+        # that kept running across a restart are not known yet.
+        self.in_use = None
+        # image id -> number of launches in this process using the artifact.
+        self.pinned = {}
+
+        self.stats = {'hits': 0,
+                      'misses': 0,
+                      'evictions': 0,
+                      'evicted_bytes': 0}
+
+    def _lock(self, name):
+        return utils.synchronized('cobalt-artifact-%s' % name, external=True,
+                                  lock_path=self.lock_path)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            LOG.warn(_("The artifact cache index %s is corrupt, discarding it."),
+                     self.index_path)
+        return {}
+
+    def _write_index(self, index):
+        fd, temp_path = tempfile.mkstemp(dir=self.base_path)
+        try:
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(index, index_file)
+            os.rename(temp_path, self.index_path)
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def _update_index(self, update_fn):
+        """
+        Applies update_fn to the index, under the index lock, and writes it
+        back if update_fn changed it. Returns whatever update_fn returns.
+        """
+        @self._lock('index')
+        def _do_update():
+            index = self._read_index()
+            original = copy.deepcopy(index)
+            result = update_fn(index)
+            if index != original:
+                self._write_index(index)
+            return result
+        return _do_update()
+
+    def _is_cached(self, image_id, checksum, file_name, target):
+        if not os.path.exists(target):
+            return False
+
+        entry = self._read_index().get(file_name)
+        if entry is not None:
+            return entry['image_id'] == image_id and \
+                   (checksum is None or entry['checksum'] == checksum)
+
+        # The artifact was downloaded before the cache kept an index. Adopt
+        # it if its contents are what the image service has.
+        if checksum is not None and \
+           co_image.file_checksum(target) == checksum:
+            LOG.debug(_("Adopting existing artifact %s into the cache"), target)
+            self._record(image_id, checksum, file_name, target)
+            return True
+        return False
+
+    def _record(self, image_id, checksum, file_name, target):
+        entry = {'image_id': image_id,
+                 'checksum': checksum,
+                 'size': os.path.getsize(target),
+                 'last_used': time.time()}
+        def _add_entry(index):
+            index[file_name] = entry
+        self._update_index(_add_entry)
+
+    def _is_stale(self, entry):
+        return entry is not None and \
+               time.time() - entry['last_used'] >= LAST_USED_RESOLUTION
+
+    def _touch(self, file_name):
+        # The index lock is only taken when the last use is stale.
+        if not self._is_stale(self._read_index().get(file_name)):
+            return
+        def _touch_entry(index):
+            if self._is_stale(index.get(file_name)):
+                index[file_name]['last_used'] = time.time()
+        self._update_index(_touch_entry)
+
+    def _download(self, context, image_service, image_id, checksum, target):
+        # We download to a temporary location so we can make the file appear
+        # atomically from the right user.
+        fd, temp_target = tempfile.mkstemp(dir=self.base_path)
+        try:
+            os.close(fd)
+            image_service.download(context, image_id, temp_target,
+                                   checksum=checksum)
+            os.chown(temp_target, self.uid, self.gid)
+            os.chmod(temp_target, 0644)
+            os.rename(temp_target, target)
+        except:
+            if os.path.exists(temp_target):
+                os.unlink(temp_target)
+            raise
+
+    def fetch(self, context, image_service, image_id, force=False):
+        """
+        Ensures the artifact of image_id is in the cache and returns its path.
+        Callers pin() the artifact first so that it cannot be evicted before
+        they are done with it. If force is True the artifact is always
+        downloaded.
+        """
+        image = image_service.show(context, image_id)
+        # In previous versions name was the filename (*.gc, *.disk) so
+        # there was no file_name property. Now that name is more descriptive
+        # when uploaded to glance, file_name property is set; use if possible
+        file_name = image['properties'].get('file_name', image['name'])
+        checksum = image.get('checksum')
+        target = os.path.join(self.base_path, file_name)
+
+        # The artifact lock is shared by all processes on the host, so an
+        # artifact is only downloaded once even if it is launched
+        # concurrently.
+        @self._lock(file_name)
+        def _fetch():
+            if not(force) and self._is_cached(image_id, checksum,
+                                              file_name, target):
+                self.stats['hits'] += 1
+                self._touch(file_name)
+                return
+
+            self.stats['misses'] += 1
+            LOG.debug(_("Downloading image %s to %s"), image_id, target)
+            self._download(context, image_service, image_id, checksum,
+                           target)
+            self._record(image_id, checksum, file_name, target)
+        _fetch()
+
+        self.evict()
+        return target
+
+    def image_ids(self):
+        """ Returns the image ids of all of the cached artifacts. """
+        return set([entry['image_id'] for entry in self._read_index().values()])
+
+    def pin(self, image_ids):
+        """ Prevents the artifacts of image_ids from being evicted. """
+        for image_id in image_ids:
+            self.pinned[image_id] = self.pinned.get(image_id, 0) + 1
+
+    def release(self, image_ids, running=False):
+        """
+        Unpins artifacts pinned with pin(). If running is True the artifacts
+        now back a running instance and will not be evicted until the next
+        call to set_in_use().
+        """
+        for image_id in image_ids:
+            count = self.pinned.get(image_id, 0) - 1
+            if count > 0:
+                self.pinned[image_id] = count
+            else:
+                self.pinned.pop(image_id, None)
+            if running and self.in_use is not None:
+                self.in_use.add(image_id)
+
+    def set_in_use(self, image_ids):
+        """ Sets the image ids of all the artifacts used by running instances. """
+        self.in_use = set(image_ids)
+
+    def _is_evictable(self, entry):
+        return entry['image_id'] not in self.in_use and \
+               entry['image_id'] not in self.pinned
+
+    def evict(self):
+        """
+        Evicts the least recently used artifacts until the cache fits in its
+        budget. Returns the file names that were evicted.
+        """
+        if self.max_bytes <= 0:
+            return []
+        if self.in_use is None:
+            LOG.debug(_("Not evicting artifacts until the artifacts used by "
+                        "the running instances are known."))
+            return []
+
+        def _select_victims(index):
+            total = sum([entry['size'] for entry in index.values()])
+            victims = []
+            for file_name, entry in sorted(index.items(),
+                                           key=lambda item: item[1]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if self._is_evictable(entry):
+                    victims.append((file_name, entry))
+                    total -= entry['size']
+            if total > self.max_bytes:
+                LOG.warn(_("The artifact cache is over its budget of %d bytes "
+                           "but all remaining artifacts are in use."),
+                         self.max_bytes)
+            return victims
+        victims = self._update_index(_select_victims)
+
+        evicted = []
+        for file_name, entry in victims:
+            # NOTE: The artifact lock is always taken before the index lock,
+            # so the victims are removed one at a time outside of it.
+            @self._lock(file_name)
+            def _evict():
+                def _remove_entry(index):
+                    current = index.get(file_name)
+                    if current != entry or not(self._is_evictable(current)):
+                        # It was downloaded again or used in the meantime.
+                        return False
+                    del index[file_name]
+                    return True
+                if not self._update_index(_remove_entry):
+                    return
+                try:
+                    os.unlink(os.path.join(self.base_path, file_name))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                self.stats['evictions'] += 1
+                self.stats['evicted_bytes'] += entry['size']
+                evicted.append(file_name)
+            _evict()
+
+        if evicted:
+            LOG.info(_("Evicted artifacts %s from the cache"), evicted)
+        return evicted
@@ -26,10 +26,13 @@ import os
 import re
 import socket
 import subprocess
+import sys
 
 import greenlet
 from eventlet.green import threading as gthreading
+from eventlet import greenpool
 from eventlet import greenthread
+from eventlet import semaphore
 
 from nova import conductor
 from nova import context as nova_context
@@ -67,8 +70,40 @@ cobalt_opts = [
                      'mutliple launches on the same host will be processed synchronously. '
                      'This timeout can be raised to ensure that launch waits long enough '
                      'for nova-compute to process its request. By default this is set to '
-                     'one hour.')]
+                     'one hour.'),
+
+                cfg.IntOpt('cobalt_refresh_host_concurrency',
+                default=8,
+                help='The maximum number of instances whose database state is '
+                     'corrected concurrently by the periodic host refresh.'),
+
+                cfg.IntOpt('cobalt_launch_concurrency',
+                default=8,
+                help='The maximum number of instances of a batched launch that '
+                     'are set up (networking, vms launch) concurrently.'),
+
+                cfg.IntOpt('cobalt_metrics_log_interval',
+                default=600,
+                help='The interval (in seconds) at which the latency of the '
+                     'cobalt operations and their phases is logged. 0 disables '
+                     'the logging.'),
+
+                cfg.IntOpt('cobalt_prefetch_concurrency',
+                default=1,
+                help='The number of live-images prefetched at the same time '
+                     'on a host. Prefetched artifacts are downloaded one at a '
+                     'time to leave the bandwidth to launches.'),
+
+                cfg.IntOpt('cobalt_volume_create_timeout',
+                default=600,
+                help='The number of seconds allowed to create the volumes of '
+                     'a launched instance from their snapshots.')]
 CONF.register_opts(cobalt_opts)
+
+# The bounds (in seconds) of the interval between two checks of the volumes
+# being created. The interval doubles after every check.
+VOLUME_POLL_MIN_INTERVAL = 0.25
+VOLUME_POLL_MAX_INTERVAL = 5.0
 CONF.import_opt('cobalt_topic', 'cobalt.nova.api')
 
 from nova import manager
@@ -91,6 +126,8 @@ from nova.openstack.common import periodic_task
 from nova.openstack.common.notifier import api as notifier
 from nova import notifications
 
+import cobalt.nova.common as co_common
+import cobalt.nova.extension.metrics as metrics
 import cobalt.nova.extension.vmsconn as vmsconn
 
 def _lock_call(fn):
@@ -119,13 +156,19 @@ def _lock_call(fn):
             # Cover for the case where we don't have a proper object.
             instance_ref['name'] = CONF.instance_name_template % instance_ref['id']
 
-        LOG.debug("Locking instance %s (fn:%s)" % (instance_uuid, fn.__name__))
-        self._lock_instance(instance_uuid)
+        # Every locked call is an operation whose latency we track.
+        metrics.start(fn.__name__)
         try:
-            return fn(self, context, **kwargs)
+            LOG.debug("Locking instance %s (fn:%s)" % (instance_uuid, fn.__name__))
+            with metrics.phase('lock_wait'):
+                self._lock_instance(instance_uuid)
+            try:
+                return fn(self, context, **kwargs)
+            finally:
+                self._unlock_instance(instance_uuid)
+                LOG.debug(_("Unlocked instance %s (fn: %s)" % (instance_uuid, fn.__name__)))
         finally:
-            self._unlock_instance(instance_uuid)
-            LOG.debug(_("Unlocked instance %s (fn: %s)" % (instance_uuid, fn.__name__)))
+            metrics.finish()
 
     wrapped_fn.__name__ = fn.__name__
     wrapped_fn.__doc__ = fn.__doc__
@@ -188,12 +231,23 @@ class CobaltManager(manager.SchedulerDependentManager):
         self._init_vms()
         self.nodename = self.vms_conn.get_hypervisor_hostname()
 
-        # Use an eventlet green thread condition lock instead of the regular threading module. This
+        # Use an eventlet green thread lock instead of the regular threading module. This
         # is required for eventlet threads because they essentially run on a single system thread.
         # All of the green threads will share the same base lock, defeating the point of using the
         # it. Since the main threading module is not monkey patched we cannot use it directly.
-        self.cond = gthreading.Condition()
+        #
+        # The lock only guards the lock table below. Threads waiting on a
+        # locked instance wait on a condition specific to that instance, so
+        # releasing an instance only wakes up the threads waiting for it.
+        self.lock = gthreading.Lock()
+        # instance_uuid -> (locking thread, refcount)
         self.locked_instances = {}
+        # instance_uuid -> [condition, number of waiting threads]
+        self.instance_waiters = {}
+        # Bounds the prefetches running in the background on this host.
+        self.prefetch_semaphore = semaphore.Semaphore(
+                                    max(1, CONF.cobalt_prefetch_concurrency))
+        self.metrics_logged_at = time.time()
         super(CobaltManager, self).__init__(service_name="cobalt", *args, **kwargs)
 
     def _init_vms(self):
@@ -205,7 +259,7 @@ class CobaltManager(manager.SchedulerDependentManager):
                     compute_manager.ComputeVirtAPI(self.compute_manager))
 
     def _lock_instance(self, instance_uuid):
-        self.cond.acquire()
+        self.lock.acquire()
         try:
             LOG.debug(_("Acquiring lock for instance %s" % (instance_uuid)))
             current_thread = id(greenlet.getcurrent())
@@ -216,7 +270,7 @@ class CobaltManager(manager.SchedulerDependentManager):
                 if locking_thread != current_thread:
                     LOG.debug(_("Lock for instance %s already acquired by %s (me: %s)" \
                             % (instance_uuid, locking_thread, current_thread)))
-                    self.cond.wait()
+                    self._wait_for_instance(instance_uuid)
                 else:
                     break
 
@@ -224,24 +278,72 @@ class CobaltManager(manager.SchedulerDependentManager):
                         % (instance_uuid, current_thread, refcount + 1)))
             self.locked_instances[instance_uuid] = (locking_thread, refcount + 1)
         finally:
-            self.cond.release()
+            self.lock.release()
+
+    def _try_lock_instance(self, instance_uuid):
+        """
+        Locks the instance only if no other thread holds it. Returns True if the
+        lock was taken, in which case it must be released with _unlock_instance.
+        """
+        self.lock.acquire()
+        try:
+            current_thread = id(greenlet.getcurrent())
+            (locking_thread, refcount) = self.locked_instances.get(instance_uuid,
+                                                                   (current_thread, 0))
+            if locking_thread != current_thread:
+                return False
+            self.locked_instances[instance_uuid] = (locking_thread, refcount + 1)
+            return True
+        finally:
+            self.lock.release()
+
+    def _wait_for_instance(self, instance_uuid):
+        """ Waits for the instance to be released. Must be called with self.lock held. """
+        waiter = self.instance_waiters.get(instance_uuid)
+        if waiter is None:
+            waiter = [gthreading.Condition(self.lock), 0]
+            self.instance_waiters[instance_uuid] = waiter
+        waiter[1] += 1
+        try:
+            waiter[0].wait()
+        finally:
+            waiter[1] -= 1
+            if waiter[1] == 0:
+                del self.instance_waiters[instance_uuid]
 
     def _unlock_instance(self, instance_uuid):
-        self.cond.acquire()
+        self.lock.acquire()
         try:
             if instance_uuid in self.locked_instances:
                 (locking_thread, refcount) = self.locked_instances[instance_uuid]
                 if refcount == 1:
                     del self.locked_instances[instance_uuid]
-                    # The lock is now available for other threads to take so wake them up.
-                    self.cond.notifyAll()
+                    # The lock is now available. All of the threads waiting on
+                    # this instance are woken up: one of them takes it and the
+                    # others wait again. Waking up a single one would leave
+                    # the others waiting for good if it is killed first.
+                    waiter = self.instance_waiters.get(instance_uuid)
+                    if waiter is not None:
+                        waiter[0].notifyAll()
                 else:
                     self.locked_instances[instance_uuid] = (locking_thread, refcount - 1)
         finally:
-            self.cond.release()
+            self.lock.release()
+
+    def get_metrics(self, context):
+        """
+        Returns the latency histograms of the operations (and their phases)
+        run on this host. The time an operation spent waiting on its instance
+        lock is its lock_wait phase.
+        """
+        return {'operations': metrics.REGISTRY.summary()}
 
     def _instance_update(self, context, instance_uuid, **kwargs):
-        """Update an instance in the database using kwargs as value."""
+        """
+        Update an instance in the database using kwargs as value. An update
+        given an expected_task_state that does not match (or of an instance
+        that no longer exists) fails right away.
+        """
         retries = 0
         while True:
             try:
@@ -250,6 +352,9 @@ class CobaltManager(manager.SchedulerDependentManager):
                 return self.conductor_api.instance_update(context,
                                                           instance_uuid,
                                                           **kwargs)
+            except (exception.UnexpectedTaskStateError,
+                    exception.InstanceNotFound):
+                raise
             except:
                 # We retry the database update up to 60 seconds. This gives
                 # us a decent window for avoiding database restarts, etc.
@@ -266,76 +371,311 @@ class CobaltManager(manager.SchedulerDependentManager):
     @periodic_task.periodic_task
     def _clean(self, context):
         self.vms_conn.periodic_clean()
+        if CONF.cobalt_use_image_service:
+            self.vms_conn.update_artifact_usage(
+                                        self._running_image_refs(context))
+            self._refresh_cached_artifacts(context)
+            self.vms_conn.reap_released_images(context,
+                    lambda lineage: self._lineage_image_refs(context, lineage))
+
+    def _lineage_image_refs(self, context, lineage):
+        """
+        Returns the image refs recorded by the live-images blessed from the
+        lineage instance, and by that instance itself (a migration records
+        its images on the migrating instance).
+        """
+        if not lineage:
+            return set()
+        filters = {'system_metadata': {'blessed_from': lineage},
+                   'deleted': False}
+        instances = list(instance_obj.InstanceList.get_by_filters(context,
+                                filters, expected_attrs=['system_metadata']))
+        try:
+            instances.append(instance_obj.Instance.get_by_uuid(context,
+                                lineage, expected_attrs=['system_metadata']))
+        except exception.InstanceNotFound:
+            pass
+        image_refs = set()
+        for instance in instances:
+            image_refs.update(self._extract_image_refs(instance))
+        return image_refs
+
+    def _report_cached_artifacts(self, context, source_instance_ref):
+        """
+        Records on the live-image that this host holds all of its artifacts
+        so that the scheduler favours this host for its launches.
+        """
+        key = co_common.CACHED_ARTIFACTS_KEY % self.host
+        system_metadata = self._system_metadata_get(source_instance_ref)
+        if system_metadata.get(key) == '1':
+            return
+        image_refs = self._extract_image_refs(source_instance_ref)
+        cached = self.vms_conn.cached_image_refs()
+        if cached is None or len(image_refs) == 0 or \
+           not set(image_refs).issubset(cached):
+            return
+        self._system_metadata_mark(context, source_instance_ref, key, '1')
+
+    def _system_metadata_mark(self, context, instance, key, value):
+        """
+        Sets a single key of the system metadata of an instance owned by
+        another host. The service has no direct database access, so this
+        goes through the conductor. Only that key is written: saving the
+        whole instance would write back a stale copy of the other keys, such
+        as the marks of the other hosts.
+        """
+        self.conductor_api.instance_system_metadata_update(context, instance,
+                                                           {key: value}, False)
+
+    def _cast_prefetch(self, context, instance_ref, hosts):
+        """
+        Asks the given hosts (chosen by the API, see cobalt_prefetch_hosts)
+        to download the artifacts of the new live-image into their cache.
+        """
+        if not CONF.cobalt_use_image_service or \
+           len(self._extract_image_refs(instance_ref)) == 0:
+            return
+        for host in hosts:
+            rpc.cast(context,
+                     rpc.queue_get_for(context, CONF.cobalt_topic, host),
+                     {"method": "prefetch_live_image",
+                      "args": {"instance_uuid": instance_ref['uuid']}})
+
+    def prefetch_live_image(self, context, instance_uuid=None):
+        """
+        Downloads the artifacts of the live-image into the local cache ahead
+        of its first launch on this host. Prefetches run in the background
+        and yield to launches: only cobalt_prefetch_concurrency of them run at
+        a time and their artifacts are downloaded one at a time. A launch that
+        needs an artifact being prefetched waits for that download instead
+        of starting another.
+        """
+        context = context.elevated()
+        with self.prefetch_semaphore:
+            try:
+                instance_ref = instance_obj.Instance.get_by_uuid(context,
+                                    instance_uuid, expected_attrs=['system_metadata'])
+            except exception.InstanceNotFound:
+                LOG.debug(_("Not prefetching %s, it no longer exists."),
+                          instance_uuid)
+                return
+
+            started = time.time()
+            with metrics.phase('prefetch'):
+                image_refs = self.vms_conn.fetch_artifacts(context,
+                                        self._extract_image_refs(instance_ref),
+                                        concurrency=1)
+                self.vms_conn.release_artifacts(image_refs)
+            LOG.info(_("Prefetched the artifacts of %s in %.1fs"),
+                     instance_uuid, time.time() - started)
+            self._report_cached_artifacts(context, instance_ref)
+
+    def launch_pooled_instance(self, context, instance_uuid=None):
+        """
+        Launches a clone created by the API for the pool of its live-image on
+        this host and pauses it so that a launch can claim it. The clone stays
+        in the POOL_SPAWNING task state until then and every update expects
+        it, so that a delete started meanwhile (e.g. when the pool is drained)
+        is not overwritten. A clone that cannot be launched is left in the
+        error state.
+        """
+        context = context.elevated()
+        try:
+            self.launch_instance(context, instance_uuid=instance_uuid,
+                                 pooled=True)
+            instance_ref = instance_obj.Instance.get_by_uuid(context,
+                                                             instance_uuid)
+            self.vms_conn.pause_instance(instance_ref)
+            self._instance_update(context, instance_uuid,
+                                  vm_state=vm_states.PAUSED,
+                                  power_state=power_state.PAUSED,
+                                  host=self.host,
+                                  node=self.nodename,
+                                  task_state=co_common.POOLED,
+                                  expected_task_state=co_common.POOL_SPAWNING)
+        except (exception.UnexpectedTaskStateError,
+                exception.InstanceNotFound):
+            LOG.info(_("Pooled instance %s was deleted while it was "
+                       "launched"), instance_uuid)
+            self._destroy_deleted_instance(context, instance_uuid)
+        except:
+            _log_error("launch of pooled instance %s" % instance_uuid)
+            try:
+                self._instance_update(context, instance_uuid,
+                                      vm_state=vm_states.ERROR,
+                                      task_state=None,
+                                      expected_task_state=co_common.POOL_SPAWNING)
+            except (exception.UnexpectedTaskStateError,
+                    exception.InstanceNotFound):
+                # Already in the error state, or deleted.
+                pass
+
+    def _destroy_deleted_instance(self, context, instance_uuid):
+        """
+        Destroys the vm, and releases the networks, of an instance that was
+        deleted while it was launched here. The delete may have been done
+        before there was anything to clean up.
+        """
+        try:
+            instance_ref = instance_obj.Instance.get_by_uuid(
+                                context.elevated(read_deleted='yes'),
+                                instance_uuid)
+            self.compute_manager.driver.destroy(instance_ref, [])
+            self.network_api.deallocate_for_instance(context, instance_ref)
+        except:
+            _log_error("clean up of deleted instance %s" % instance_uuid)
+
+    def _refresh_cached_artifacts(self, context):
+        """
+        Clears the cached mark of the live-images whose artifacts have been
+        evicted from the cache on this host.
+        """
+        cached = self.vms_conn.cached_image_refs()
+        if cached is None:
+            return
+        key = co_common.CACHED_ARTIFACTS_KEY % self.host
+        filters = {'system_metadata': {key: '1'}, 'deleted': False}
+        instances = instance_obj.InstanceList.get_by_filters(context, filters,
+                                                expected_attrs=['system_metadata'])
+        for instance in instances:
+            if not set(self._extract_image_refs(instance)).issubset(cached):
+                LOG.debug(_("The artifacts of %s are no longer cached."),
+                          instance['uuid'])
+                self._system_metadata_mark(context, instance, key, '0')
 
     @periodic_task.periodic_task
-    def _refresh_host(self, context):
+    def _log_metrics(self, context):
+        interval = CONF.cobalt_metrics_log_interval
+        if interval <= 0 or time.time() - self.metrics_logged_at < interval:
+            return
+        self.metrics_logged_at = time.time()
+        LOG.info(_("Cobalt operation latencies: %s"),
+                 jsonutils.dumps(self.get_metrics(context)))
+
+    def _running_image_refs(self, context):
+        """
+        Returns the image refs of the live-images that the instances on this
+        host have been launched from.
+        """
+        filters = {'host': self.host, 'deleted': False}
+        instances = instance_obj.InstanceList.get_by_filters(context, filters,
+                                                expected_attrs=['system_metadata'])
+        source_uuids = set()
+        for instance in instances:
+            source_uuid = self._system_metadata_get(instance).get('launched_from')
+            if source_uuid:
+                source_uuids.add(source_uuid)
+
+        image_refs = set()
+        for source_uuid in source_uuids:
+            try:
+                source_instance = instance_obj.Instance.get_by_uuid(context,
+                                    source_uuid, expected_attrs=['system_metadata'])
+            except exception.InstanceNotFound:
+                continue
+            image_refs.update(self._extract_image_refs(source_instance))
+        return image_refs
 
-        # Grab the global lock and fetch all instances.
-        self.cond.acquire()
+    @periodic_task.periodic_task
+    def _refresh_host(self, context):
 
+        # Only instances left in the MIGRATING state can be stalled, so we
+        # only fetch those.
+        filters = {'host': self.host,
+                   'task_state': task_states.MIGRATING,
+                   'deleted': False}
+        db_instances = instance_obj.InstanceList.get_by_filters(context, filters,
+                                                expected_attrs=['system_metadata'])
+        if len(db_instances) == 0:
+            return
+
+        # If the instance is locked, then there is some active tasks working
+        # with this instance (and the MIGRATING state is completely fine). We
+        # only hold the lock long enough to take a snapshot of the lock table.
+        self.lock.acquire()
         try:
-            # Scan all instances and check for stalled operations.
-            db_instances = instance_obj.InstanceList.get_by_host(context,
-                                                                 self.host)
-            local_instances = self.compute_manager.driver.list_instances()
-            for instance in db_instances:
-
-                # If the instance is locked, then there is some active
-                # tasks working with this instance (and the BUILDING state
-                # and/or MIGRATING state) is completely fine.
-                if instance['uuid'] in self.locked_instances:
-                    continue
+            locked_instances = set(self.locked_instances.keys())
+        finally:
+            self.lock.release()
 
-                if instance['task_state'] == task_states.MIGRATING:
-
-                    # Set defaults.
-                    state = None
-                    host = self.host
-
-                    # Grab metadata.
-                    system_metadata = self._system_metadata_get(instance)
-                    src_host = system_metadata.get('gc_src_host', None)
-                    dst_host = system_metadata.get('gc_dst_host', None)
-
-                    if instance['name'] in local_instances:
-                        if self.host == src_host:
-                            # This is a rollback, it's here and no migration is
-                            # going on.  We simply update the database to
-                            # reflect this reality.
-                            state = vm_states.ACTIVE
-                            task = None
-
-                        elif self.host == dst_host:
-                            # This shouldn't really happen. The only case in which
-                            # it could happen is below, where we've been punted this
-                            # VM from the source host.
-                            state = vm_states.ACTIVE
-                            task = None
-
-                            # Try to ensure the networks are configured correctly.
-                            self.network_api.setup_networks_on_host(context, instance)
-                    else:
-                        if self.host == src_host:
-                            # The VM may have been moved, but the host did not change.
-                            # We update the host and let the destination take care of
-                            # the status.
-                            state = instance['vm_state']
-                            task = instance['task_state']
-                            host = dst_host
-
-
-                        elif self.host == dst_host:
-                            # This VM is not here, and there's no way it could be back
-                            # at its origin. We must mark this as an error.
-                            state = vm_states.ERROR
-                            task = None
-
-                    if state:
-                        self._instance_update(context, instance['uuid'], vm_state=state,
-                                              task_state=task, host=host)
+        instance_uuids = [instance['uuid'] for instance in db_instances
+                          if instance['uuid'] not in locked_instances]
+        if len(instance_uuids) == 0:
+            return
 
+        local_instances = self.compute_manager.driver.list_instances()
+        pool = greenpool.GreenPool(CONF.cobalt_refresh_host_concurrency)
+        for instance_uuid in instance_uuids:
+            pool.spawn_n(self._reconcile_instance, context, instance_uuid,
+                         local_instances)
+        pool.waitall()
+
+    def _reconcile_instance(self, context, instance_uuid, local_instances):
+        """ Corrects the database state of an instance stalled in MIGRATING. """
+
+        # An operation may have started on this instance since the snapshot
+        # was taken in _refresh_host. It owns the instance, so leave it be.
+        if not self._try_lock_instance(instance_uuid):
+            return
+
+        try:
+            # Reload the instance now that we hold its lock. An operation may
+            # have completed since it was fetched.
+            instance = instance_obj.Instance.get_by_uuid(context, instance_uuid,
+                                                expected_attrs=['system_metadata'])
+            if instance['host'] != self.host or \
+               instance['task_state'] != task_states.MIGRATING:
+                return
+
+            # Set defaults.
+            state = None
+            host = self.host
+
+            # Grab metadata.
+            system_metadata = self._system_metadata_get(instance)
+            src_host = system_metadata.get('gc_src_host', None)
+            dst_host = system_metadata.get('gc_dst_host', None)
+
+            if instance['name'] in local_instances:
+                if self.host == src_host:
+                    # This is a rollback, it's here and no migration is
+                    # going on.  We simply update the database to
+                    # reflect this reality.
+                    state = vm_states.ACTIVE
+                    task = None
+
+                elif self.host == dst_host:
+                    # This shouldn't really happen. The only case in which
+                    # it could happen is below, where we've been punted this
+                    # VM from the source host.
+                    state = vm_states.ACTIVE
+                    task = None
+
+                    # Try to ensure the networks are configured correctly.
+                    self.network_api.setup_networks_on_host(context, instance)
+            else:
+                if self.host == src_host:
+                    # The VM may have been moved, but the host did not change.
+                    # We update the host and let the destination take care of
+                    # the status.
+                    state = instance['vm_state']
+                    task = instance['task_state']
+                    host = dst_host
+
+
+                elif self.host == dst_host:
+                    # This VM is not here, and there's no way it could be back
+                    # at its origin. We must mark this as an error.
+                    state = vm_states.ERROR
+                    task = None
+
+            if state:
+                self._instance_update(context, instance['uuid'], vm_state=state,
+                                      task_state=task, host=host)
+        except:
+            _log_error("refresh of instance %s" % instance_uuid)
         finally:
-            self.cond.release()
+            self._unlock_instance(instance_uuid)
 
     def _get_migration_address(self, dest):
         if CONF.cobalt_outgoing_migration_address != None:
@@ -434,6 +774,12 @@ class CobaltManager(manager.SchedulerDependentManager):
             usage_info = notifications.info_from_instance(context, instance_ref,
                                                           network_info=network_info,
                                                           system_metadata=None)
+            if operation.endswith('.end'):
+                # Include how long the operation took, in total and in each of
+                # its phases.
+                timings = metrics.current_timings()
+                if timings is not None:
+                    usage_info['cobalt_timings'] = timings
             notifier.notify(context, 'cobalt.%s' % self.host,
                             'cobalt.instance.%s' % operation,
                             notifier.INFO, usage_info)
@@ -449,41 +795,70 @@ class CobaltManager(manager.SchedulerDependentManager):
     def _snapshot_attached_volumes(self, context,  source_instance, instance,
                                    is_paused=False):
         """
-        Creates a snaptshot of all of the attached volumes.
+        Creates a snaptshot of all of the attached volumes. The source
+        instance stays paused until it is blessed, so the volumes are looked up
+        before pausing it and all of the snapshots are requested at once.
+        Returns the time at which the source instance was paused, or None if
+        it was not paused here. If any of it fails, the snapshots that were
+        created are deleted.
         """
 
-        block_device_mappings = self.conductor_api.\
+        block_device_mappings = [bdm for bdm in self.conductor_api.\
                 block_device_mapping_get_all_by_instance(context, instance)
-        root_device_name = source_instance['root_device_name']
-        snapshots = []
-
-        paused = is_paused
-        for bdm in block_device_mappings:
-            if bdm['no_device']:
-                continue
-
-            if not paused:
-                self.vms_conn.pause_instance(source_instance)
-                paused = True
+                                 if not bdm['no_device']]
+        if len(block_device_mappings) == 0:
+            return None
 
-            volume_id = bdm.get('volume_id')
-            if volume_id:
-                # create snapshot based on volume_id
-                volume = self.volume_api.get(context, volume_id)
+        volume_bdms = [bdm for bdm in block_device_mappings
+                       if bdm.get('volume_id')]
+        pool = greenpool.GreenPool(max(1, len(volume_bdms)))
+        volumes = list(pool.imap(
+                    lambda bdm: self.volume_api.get(context, bdm['volume_id']),
+                    volume_bdms))
 
-                name = _('snapshot for %s') % instance['display_name']
-                snapshot = self.volume_api.create_snapshot_force(
-                    context, volume, name, volume['display_description'])
+        paused_at = None
+        if not is_paused:
+            self.vms_conn.pause_instance(source_instance)
+            paused_at = time.time()
 
-                # Update the blessed device mapping to include the snapshot id.
-                # We also mark it for deletion and this will cascade to the
-                # volume booted when launching.
-                self.conductor_api.\
-                    block_device_mapping_update(context.elevated(),
-                                                bdm['id'],
-                                                {'snapshot_id': snapshot['id'],
-                                                 'delete_on_termination': True,
-                                                 'volume_id': None})
+        name = _('snapshot for %s') % instance['display_name']
+        creates = []
+        try:
+            creates = [pool.spawn(self.volume_api.create_snapshot_force,
+                                  context, volume, name,
+                                  volume['display_description'])
+                       for volume in volumes]
+            snapshots = [create.wait() for create in creates]
+
+            # Update the blessed device mappings to include the snapshot ids.
+            # We also mark them for deletion and this will cascade to the
+            # volumes booted when launching.
+            updates = [pool.spawn(self.conductor_api.block_device_mapping_update,
+                                  context.elevated(), bdm['id'],
+                                  {'snapshot_id': snapshot['id'],
+                                   'delete_on_termination': True,
+                                   'volume_id': None})
+                       for bdm, snapshot in zip(volume_bdms, snapshots)]
+            for update in updates:
+                update.wait()
+        except:
+            ei = sys.exc_info()
+            # The snapshot requests still running are waited for so that
+            # none of their snapshots is left behind.
+            pool.waitall()
+            for create in creates:
+                try:
+                    snapshot = create.wait()
+                except:
+                    continue
+                try:
+                    self.volume_api.delete_snapshot(context, snapshot)
+                except:
+                    _log_error("delete of snapshot %s" % snapshot['id'])
+            if paused_at is not None:
+                self.vms_conn.unpause_instance(source_instance)
+            raise ei[0], ei[1], ei[2]
+        return paused_at
 
     def _detach_volumes(self, context, instance):
         block_device_mappings = self.conductor_api.\
@@ -519,10 +894,12 @@ class CobaltManager(manager.SchedulerDependentManager):
 
     @_lock_call
     def bless_instance(self, context, instance_uuid=None, instance_ref=None,
-                       migration_url=None, migration_network_info=None):
+                       migration_url=None, migration_network_info=None,
+                       prefetch_hosts=None):
         """
         Construct the blessed instance, with the uuid instance_uuid. If migration_url is specified then
         bless will ensure a memory server is available at the given migration url.
+        The new live-image is prefetched on the prefetch_hosts.
         """
         context = context.elevated()
         if migration_url:
@@ -540,12 +917,14 @@ class CobaltManager(manager.SchedulerDependentManager):
         instance_info = self.vms_conn.get_instance_info(source_instance_ref)
         is_paused = instance_info['state'] == power_state.PAUSED
 
+        paused_at = None
         if not(migration):
             try:
-                self._snapshot_attached_volumes(context,
-                                                source_instance_ref,
-                                                instance_ref,
-                                                is_paused=is_paused)
+                with metrics.phase('snapshot_volumes'):
+                    paused_at = self._snapshot_attached_volumes(context,
+                                                    source_instance_ref,
+                                                    instance_ref,
+                                                    is_paused=is_paused)
             except:
                 _log_error("snapshot volumes")
                 raise
@@ -561,10 +940,17 @@ class CobaltManager(manager.SchedulerDependentManager):
             # NOTE: If this is a migration, then a successful bless will mean that
             # the VM no longer exists. This requires us to *relaunch* it below in
             # the case of a rollback later on.
-            name, migration_url, blessed_files, lvms = self.vms_conn.bless(context,
-                                                source_instance_ref['name'],
-                                                instance_ref,
-                                                migration_url=migration_url)
+            if paused_at is None:
+                paused_at = time.time()
+            with metrics.phase('vms_bless'):
+                name, migration_url, blessed_files, lvms = self.vms_conn.bless(context,
+                                                    source_instance_ref['name'],
+                                                    instance_ref,
+                                                    migration_url=migration_url)
+            if not(migration) and not(is_paused):
+                # The guest was paused from the volume snapshots (or the
+                # start of the bless) until now.
+                metrics.record_phase('guest_paused', time.time() - paused_at)
         except Exception, e:
             _log_error("bless")
             if not is_paused:
@@ -591,10 +977,11 @@ class CobaltManager(manager.SchedulerDependentManager):
             image_refs = []
             vms_policy_template = self._generate_vms_policy_template(context,
                                                             instance_ref)
-            image_refs = self.vms_conn.post_bless(context,
-                                    instance_ref,
-                                    blessed_files,
-                                    vms_policy_template=vms_policy_template)
+            with metrics.phase('post_bless'):
+                image_refs = self.vms_conn.post_bless(context,
+                                        instance_ref,
+                                        blessed_files,
+                                        vms_policy_template=vms_policy_template)
             LOG.debug("image_refs = %s" % image_refs)
 
             # Mark this new instance as being 'blessed'. If this fails,
@@ -621,6 +1008,11 @@ class CobaltManager(manager.SchedulerDependentManager):
                                             task_state=None,
                                             launched_at=timeutils.utcnow(),
                                             system_metadata=system_metadata)
+                try:
+                    self._cast_prefetch(context, instance_ref,
+                                        prefetch_hosts or [])
+                except:
+                    _log_error("prefetch of the live-image")
             else:
                 instance_ref = self._instance_update(
                                             context, instance_uuid,
@@ -739,20 +1131,22 @@ class CobaltManager(manager.SchedulerDependentManager):
         # source after this call. Also note, that this does not update the database so
         # no other processes should be affected.
         instance_ref['host'] = dest
-        rpc.call(context, compute_dest_queue,
-                 {"method": "pre_live_migration",
-                  "version": "2.2",
-                  "args": {'instance': instance_ref,
-                           'block_migration': False,
-                           'disk': None}},
-                 timeout=CONF.cobalt_compute_timeout)
+        with metrics.phase('pre_live_migration'):
+            rpc.call(context, compute_dest_queue,
+                     {"method": "pre_live_migration",
+                      "version": "2.2",
+                      "args": {'instance': instance_ref,
+                               'block_migration': False,
+                               'disk': None}},
+                     timeout=CONF.cobalt_compute_timeout)
         instance_ref['host'] = self.host
 
         # Bless this instance for migration.
-        migration_url, instance_ref = self.bless_instance(context,
-                                            instance_ref=instance_ref,
-                                            migration_url="mcdist://%s" % migration_address,
-                                            migration_network_info=network_info)
+        with metrics.phase('bless'):
+            migration_url, instance_ref = self.bless_instance(context,
+                                                instance_ref=instance_ref,
+                                                migration_url="mcdist://%s" % migration_address,
+                                                migration_network_info=network_info)
 
         # Run our premigration hook.
         self.vms_conn.pre_migration(context, instance_ref, network_info, migration_url)
@@ -774,12 +1168,13 @@ class CobaltManager(manager.SchedulerDependentManager):
             # disk size or some other parameter. But we will get a response if an
             # exception occurs in the remote thread, so the worse case here is
             # really just the machine dying or the service dying unexpectedly.
-            rpc.call(context, co_dest_queue,
-                    {"method": "launch_instance",
-                     "args": {'instance_ref': instance_ref,
-                              'migration_url': migration_url,
-                              'migration_network_info': network_info}},
-                    timeout=1800)
+            with metrics.phase('remote_launch'):
+                rpc.call(context, co_dest_queue,
+                        {"method": "launch_instance",
+                         "args": {'instance_ref': instance_ref,
+                                  'migration_url': migration_url,
+                                  'migration_network_info': network_info}},
+                        timeout=1800)
             changed_hosts = True
 
         except:
@@ -840,7 +1235,8 @@ class CobaltManager(manager.SchedulerDependentManager):
         # an error -- just not one that should kill the VM).
         image_refs = self._extract_image_refs(instance_ref)
 
-        self.vms_conn.discard(context, instance_ref["name"], image_refs=image_refs)
+        with metrics.phase('discard'):
+            self.vms_conn.discard(context, instance_ref["name"], image_refs=image_refs)
 
     @_lock_call
     def discard_instance(self, context, instance_uuid=None, instance_ref=None):
@@ -850,18 +1246,21 @@ class CobaltManager(manager.SchedulerDependentManager):
         self._notify(context, instance_ref, "discard.start")
 
         # Try to discard the created snapshots
-        self._discard_blessed_snapshots(context, instance_ref)
+        with metrics.phase('discard_snapshots'):
+            self._discard_blessed_snapshots(context, instance_ref)
         # Call discard in the backend.
-        self.vms_conn.discard(context, instance_ref['name'],
-                              image_refs=self._extract_image_refs(instance_ref))
+        with metrics.phase('vms_discard'):
+            self.vms_conn.discard(context, instance_ref['name'],
+                                  image_refs=self._extract_image_refs(instance_ref))
 
         # Remove the instance.
-        self._instance_update(context,
-                              instance_uuid,
-                              vm_state=vm_states.DELETED,
-                              task_state=None,
-                              terminated_at=timeutils.utcnow())
-        self.conductor_api.instance_destroy(context, instance_ref)
+        with metrics.phase('db_update'):
+            self._instance_update(context,
+                                  instance_uuid,
+                                  vm_state=vm_states.DELETED,
+                                  task_state=None,
+                                  terminated_at=timeutils.utcnow())
+            self.conductor_api.instance_destroy(context, instance_ref)
         self._notify(context, instance_ref, "discard.end")
 
     @_retry_rpc
@@ -927,17 +1326,115 @@ class CobaltManager(manager.SchedulerDependentManager):
                         for (key, value) in policy_attrs])
 
 
-    def _generate_vms_policy_name(self, context, instance, source_instance):
-        template = self._generate_vms_policy_template(context, source_instance)
+    def _generate_vms_policy_name(self, context, instance, source_instance,
+                                  template=None):
+        if template is None:
+            template = self._generate_vms_policy_template(context,
+                                                          source_instance)
         return template %({'uuid': instance['uuid'],
                            'tenant':instance['project_id']})
 
 
+    def _create_snapshot_volume(self, context, bdm):
+        """ Starts creating the volume of the snapshot of bdm. """
+        snapshot = self.volume_api.get_snapshot(context, bdm['snapshot_id'])
+
+        from_vol = self.volume_api.get(context, snapshot['volume_id'])
+        new_volume_name = (_('%s@%s') % \
+            (from_vol['display_name'], bdm['snapshot_id']))
+        new_volume_description = from_vol.get('display_description', '')
+
+        return self.volume_api.create(context,
+                                      bdm['volume_size'],
+                                      new_volume_name,
+                                      new_volume_description,
+                                      snapshot)
+
+    def _wait_for_volumes(self, context, volume_ids):
+        """
+        Waits until none of the volumes is being created. Only the volumes
+        still pending are looked up, concurrently, often at first and then less
+        and less so. Raises an exception if they are still being created after
+        cobalt_volume_create_timeout seconds (or if one no longer exists).
+        """
+        pending = set(volume_ids)
+        deadline = time.time() + CONF.cobalt_volume_create_timeout
+        interval = VOLUME_POLL_MIN_INTERVAL
+        pool = greenpool.GreenPool(len(pending) or 1)
+        while True:
+            volumes = pool.imap(lambda volume_id:
+                                    self.volume_api.get(context, volume_id),
+                                list(pending))
+            for volume in volumes:
+                if volume['status'] != 'creating':
+                    pending.discard(volume['id'])
+            if len(pending) == 0:
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise exception.NovaException(
+                        _("Volumes %s were not created after %d seconds") %
+                        (', '.join(sorted(pending)),
+                         CONF.cobalt_volume_create_timeout))
+            LOG.debug(_("Waiting %.2fs for volumes %s"), min(interval, remaining),
+                      ', '.join(sorted(pending)))
+            greenthread.sleep(min(interval, remaining))
+            interval = min(interval * 2, VOLUME_POLL_MAX_INTERVAL)
+
+    def _create_snapshot_volumes(self, context, bdms):
+        """
+        Creates the volumes of the snapshots in the block device mappings
+        that do not have one yet. They are all created at the same time and
+        waited for together, and the mappings (in the database and in bdms)
+        are then pointed at them. Returns the mappings whose volumes were
+        created. If any of it fails, the volumes that were created are deleted.
+        """
+        snapshot_bdms = [bdm for bdm in bdms
+                         if not bdm.get('no_device') and
+                            not bdm.get('virtual_name') and
+                            bdm.get('snapshot_id') is not None and
+                            bdm.get('volume_id') is None]
+        if len(snapshot_bdms) == 0:
+            return []
+        pool = greenpool.GreenPool(len(snapshot_bdms))
+        creates = [pool.spawn(self._create_snapshot_volume, context, bdm)
+                   for bdm in snapshot_bdms]
+        try:
+            volumes = [create.wait() for create in creates]
+            self._wait_for_volumes(context, [vol['id'] for vol in volumes])
+            updates = [pool.spawn(self.conductor_api.block_device_mapping_update,
+                                  context, bdm['id'], {'volume_id': vol['id']})
+                       for bdm, vol in zip(snapshot_bdms, volumes)]
+            for update in updates:
+                update.wait()
+        except:
+            ei = sys.exc_info()
+            # The creates still running are waited for so that none of
+            # their volumes is left behind.
+            pool.waitall()
+            for create in creates:
+                try:
+                    volume = create.wait()
+                except:
+                    continue
+                try:
+                    self.volume_api.delete(context, volume)
+                except:
+                    _log_error("delete of volume %s" % volume['id'])
+            raise ei[0], ei[1], ei[2]
+        for bdm, vol in zip(snapshot_bdms, volumes):
+            bdm['volume_id'] = vol['id']
+        return snapshot_bdms
+
     def _setup_block_device_mapping(self, context, instance, bdms):
         """setup volumes for block device mapping."""
         block_device_mapping = []
         swap = None
         ephemerals = []
+
+        self._create_snapshot_volumes(context, bdms)
+
         for bdm in bdms:
             LOG.debug(_('Setting up bdm %s'), bdm, instance=instance)
 
@@ -958,35 +1455,6 @@ class CobaltManager(manager.SchedulerDependentManager):
                     ephemerals.append(eph)
                 continue
 
-            if ((bdm['snapshot_id'] is not None) and
-                (bdm['volume_id'] is None)):
-                snapshot = self.volume_api.get_snapshot(context,
-                                                        bdm['snapshot_id'])
-
-                from_vol = self.volume_api.get(context,
-                                               snapshot['volume_id'])
-                new_volume_name = (_('%s@%s') % \
-                    (from_vol['display_name'], bdm['snapshot_id']))
-                new_volume_description = from_vol.get('display_description', '')
-
-                vol = self.volume_api.create(context,
-                                             bdm['volume_size'],
-                                             new_volume_name,
-                                             new_volume_description,
-                                             snapshot)
-
-                # TODO(yamahata): creating volume simultaneously
-                #                 reduces creation time?
-                # TODO(yamahata): eliminate dumb polling
-                while True:
-                    volume = self.volume_api.get(context, vol['id'])
-                    if volume['status'] != 'creating':
-                        break
-                    greenthread.sleep(1)
-                self.conductor_api.block_device_mapping_update(
-                    context, bdm['id'], {'volume_id': vol['id']})
-                bdm['volume_id'] = vol['id']
-
             if bdm['volume_id'] is not None:
                 volume = self.volume_api.get(context, bdm['volume_id'])
                 self.volume_api.check_attach(context, volume,
@@ -1014,17 +1482,174 @@ class CobaltManager(manager.SchedulerDependentManager):
 
         return block_device_info
 
+    def launch_instances(self, context, instance_uuids=None, params=None):
+        """
+        Construct several launched instances of the same live-image on this
+        host. The work they have in common (the source instance lookup, the
+        vms policy template and the artifact downloads) is done once and the
+        instances are then launched with bounded concurrency. The artifacts
+        are handed to every launch, so none of them fetches them again.
+        """
+        context = context.elevated()
+        instances = instance_obj.InstanceList.get_by_filters(context,
+                        {'uuid': instance_uuids, 'deleted': False},
+                        expected_attrs=['info_cache', 'security_groups',
+                                        'system_metadata'])
+        if len(instances) < len(instance_uuids):
+            missing = set(instance_uuids) - set([i['uuid'] for i in instances])
+            LOG.warn(_("Not launching instances %s, they no longer exist."),
+                     list(missing))
+        if len(instances) == 0:
+            return
+
+        try:
+            source_instance_ref = self._get_source_instance(context,
+                                                            instances[0])
+            vms_policy_template = self._generate_vms_policy_template(context,
+                                                        source_instance_ref)
+
+            image_refs = self.vms_conn.fetch_artifacts(context,
+                                    self._extract_image_refs(source_instance_ref))
+        except:
+            # None of the instances can be launched without these.
+            _log_error("preparing the launch of instances %s" %
+                       [instance_ref['uuid'] for instance_ref in instances])
+            for instance_ref in instances:
+                self._instance_update(context, instance_ref['uuid'],
+                                      vm_state=vm_states.ERROR,
+                                      host=self.host,
+                                      node=self.nodename,
+                                      task_state=None)
+            raise
+
+        launched = []
+        try:
+            def _launch(instance_ref):
+                try:
+                    self.launch_instance(context,
+                                         instance_ref=instance_ref,
+                                         params=params,
+                                         source_instance_ref=source_instance_ref,
+                                         vms_policy_template=vms_policy_template,
+                                         fetched_refs=image_refs)
+                    launched.append(instance_ref['uuid'])
+                except:
+                    # The instance has already been put in the error state and
+                    # this must not stop the rest of the batch.
+                    LOG.exception(_("Failed to launch instance %s"),
+                                  instance_ref['uuid'])
+
+            pool = greenpool.GreenPool(CONF.cobalt_launch_concurrency)
+            for instance_ref in instances:
+                pool.spawn_n(_launch, instance_ref)
+            pool.waitall()
+        finally:
+            self.vms_conn.release_artifacts(image_refs,
+                                            running=len(launched) > 0)
+
+    def _prep_launch_block_device(self, context, instance_ref, created_bdms):
+        """
+        Returns the block_device_info of the launched instance. The mappings
+        whose volumes are created for the launch are added to created_bdms,
+        so that the launch can undo them if it fails later on. If this fails
+        (or is killed), the volumes it created are undone before it returns.
+        """
+        try:
+            # NOTE(dscannell): This will construct the block_device_info object
+            # that gets passed to build/attached the volumes to the launched
+            # instance. The volumes of the snapshots referenced by the
+            # instance's block_device_mapping are created here first, all at
+            # the same time, so that nova only has to attach them.
+            bdms = self.conductor_api.\
+                block_device_mapping_get_all_by_instance(context, instance_ref)
+            with metrics.phase('snapshot_volumes'):
+                created_bdms.extend(self._create_snapshot_volumes(context,
+                                                                  bdms))
+            return self.compute_manager._prep_block_device(context,
+                                                           instance_ref,
+                                                           bdms)
+        except:
+            # Since this creates volumes there are host of issues that can go wrong
+            # (e.g. cinder is down, quotas have been reached, snapshot deleted, etc).
+            ei = sys.exc_info()
+            _log_error("setting up block device mapping")
+            self._undo_launch_block_device(context, instance_ref, created_bdms)
+            raise ei[0], ei[1], ei[2]
+
+    def _undo_launch_block_device(self, context, instance_ref, created_bdms):
+        """
+        Detaches the volumes created for a launch from the instance, deletes
+        them and points their mappings back at their snapshots only. The
+        mappings are removed from created_bdms once they are undone, the
+        ones that could not be are left in it.
+        """
+        connector = None
+        for bdm in list(created_bdms):
+            volume_id = bdm['volume_id']
+            try:
+                volume = self.volume_api.get(context, volume_id)
+                if volume.get('instance_uuid') == instance_ref['uuid']:
+                    if connector is None:
+                        connector = self.compute_manager.driver.\
+                                        get_volume_connector(instance_ref)
+                    self.volume_api.terminate_connection(context, volume_id,
+                                                         connector)
+                    self.volume_api.detach(context, volume_id)
+                self.volume_api.delete(context, volume)
+                self.conductor_api.block_device_mapping_update(context,
+                                        bdm['id'], {'volume_id': None})
+                bdm['volume_id'] = None
+                created_bdms.remove(bdm)
+            except:
+                _log_error("undo of volume %s" % volume_id)
+
+    def _finish_stage(self, stage):
+        """
+        Waits for a launch stage and returns its result, or None if it
+        failed. The failures are handled where the results are needed.
+        """
+        try:
+            return stage.wait()
+        except:
+            return None
+
+    def _rollback_launch(self, context, instance_ref, block_device_stage,
+                         created_bdms, deallocate_network):
+        """
+        Undoes the stages of a failed launch. The block device stage is
+        killed and waited for first, so that it is no longer creating or
+        attaching volumes when they are undone. The networks are released if
+        deallocate_network is set (i.e. they were allocated for the launch).
+        """
+        block_device_stage.kill()
+        self._finish_stage(block_device_stage)
+        self._undo_launch_block_device(context, instance_ref, created_bdms)
+        if deallocate_network:
+            try:
+                self.network_api.deallocate_for_instance(context, instance_ref)
+            except:
+                _log_error("network deallocation")
+
     @_lock_call
     def launch_instance(self, context, instance_uuid=None, instance_ref=None,
-                        params=None, migration_url=None, migration_network_info=None):
+                        params=None, migration_url=None, migration_network_info=None,
+                        source_instance_ref=None, vms_policy_template=None,
+                        pooled=False, fetched_refs=None):
         """
         Construct the launched instance, with uuid instance_uuid. If migration_url is not none then
-        the instance will be launched using the memory server at the migration_url
+        the instance will be launched using the memory server at the migration_url.
+        A pooled launch (see launch_pooled_instance) keeps the POOL_SPAWNING task state,
+        which its updates expect, and leaves the final update to its caller.
+        The artifacts already fetched by the caller (fetched_refs, see launch_instances)
+        are not fetched again, and the caller releases them.
         """
 
         context = context.elevated()
         if params == None:
             params = {}
+        expected = {}
+        if pooled:
+            expected['expected_task_state'] = co_common.POOL_SPAWNING
 
         # note(dscannell): The target is in pages so we need to convert the value
         # If target is set as None, or not defined, then we default to "0".
@@ -1046,119 +1671,157 @@ class CobaltManager(manager.SchedulerDependentManager):
             self._notify(context, instance_ref, "launch.start")
 
             # Create a new launched instance.
-            source_instance_ref = self._get_source_instance(context,
-                                                            instance_ref)
-
-        try:
-            # NOTE(dscannell): This will construct the block_device_info object
-            # that gets passed to build/attached the volumes to the launched
-            # instance. Note that this method will also create full volumes our
-            # of any snapshot referenced by the instance's block_device_mapping.
-            bdms = self.conductor_api.\
-                block_device_mapping_get_all_by_instance(context, instance_ref)
-            block_device_info = self.compute_manager._prep_block_device(context,
-                                                                        instance_ref,
-                                                                        bdms)
-        except:
-            # Since this creates volumes there are host of issues that can go wrong
-            # (e.g. cinder is down, quotas have been reached, snapshot deleted, etc).
-            _log_error("setting up block device mapping")
-            if not(migration_url):
-                self._instance_update(context, instance_ref['uuid'],
-                                      vm_state=vm_states.ERROR,
-                                      task_state=None)
-            raise
+            if source_instance_ref is None:
+                source_instance_ref = self._get_source_instance(context,
+                                                                instance_ref)
 
         # Extract the image ids from the source instance.
         image_refs = self._extract_image_refs(source_instance_ref)
         lvm_info = self._extract_lvm_info(source_instance_ref)
         requested_networks = self._extract_requested_networks(source_instance_ref)
 
-        if migration_network_info != None:
-            # (dscannell): Since this migration_network_info came over the wire we need
-            # to hydrate it back into a full NetworkInfo object.
-            network_info = network_model.NetworkInfo.hydrate(migration_network_info)
-        else:
-            network_info = self._instance_network_info(context, instance_ref,
-                                                       migration_url != None,
-                                                       requested_networks=requested_networks)
-            if network_info == None:
-                # An error would have occured acquiring the instance network info. We should
-                # mark the instances as error and return because there is nothing else we can do.
-                self._instance_update(context, instance_ref['uuid'],
-                                      vm_state=vm_states.ERROR,
-                                      task_state=None)
-                return
-
-            # Update the task state to spawning from networking.
-            self._instance_update(context, instance_ref['uuid'],
-                                  task_state=task_states.SPAWNING)
-
+        # The block devices, the networks and the artifacts of the launch do
+        # not depend on each other, so they are set up concurrently. Of the
+        # steps below only the pre_live_migration call needs the networks.
+        # If the launch fails, what they did is undone by _rollback_launch.
+        created_bdms = []
+        block_device_stage = metrics.spawn('block_device',
+                                           self._prep_launch_block_device,
+                                           context, instance_ref, created_bdms)
+        artifact_stage = None
+        if not(migration_url) and fetched_refs is None:
+            # NOTE: A migration always fetches the descriptor again, which the
+            # launch itself takes care of.
+            artifact_stage = metrics.spawn('artifact_prefetch',
+                                           self.vms_conn.fetch_artifacts,
+                                           context, image_refs)
+        # The networks are only allocated here for a new launch, a migration
+        # keeps the ones of the instance.
+        allocate_network = not(migration_url) and migration_network_info is None
+        launched = False
         try:
-            # The main goal is to have the nova-compute process take ownership of setting up
-            # the networking for the launched instance. This ensures that later changes to the
-            # iptables can be handled directly by nova-compute. The method "pre_live_migration"
-            # essentially sets up the networking for the instance on the destination host. We
-            # simply send this message to nova-compute running on the same host (self.host)
-            # and pass in block_migration:false and disk:none so that no disk operations are
-            # performed.
-            #
-            # TODO(dscannell): How this behaves with volumes attached is an unknown. We currently
-            # do not support having volumes attached at launch time, so we should be safe in
-            # this regard.
-            #
-            # NOTE(amscanne): This will happen prior to launching in the migration code, so
-            # we don't need to bother with this call in that case.
-            if not(migration_url):
-                rpc.call(context,
-                    rpc.queue_get_for(context, CONF.compute_topic, self.host),
-                    {"method": "pre_live_migration",
-                     "version": "2.2",
-                     "args": {'instance': instance_ref,
-                              'block_migration': False,
-                              'disk': None}},
-                    timeout=CONF.cobalt_compute_timeout)
-
-            vms_policy = self._generate_vms_policy_name(context, instance_ref,
-                                                        source_instance_ref)
-            self.vms_conn.launch(context,
-                                 source_instance_ref['name'],
-                                 instance_ref,
-                                 network_info,
-                                 target=target,
-                                 migration_url=migration_url,
-                                 image_refs=image_refs,
-                                 params=params,
-                                 vms_policy=vms_policy,
-                                 block_device_info=block_device_info,
-                                 lvm_info=lvm_info)
-
-            if not(migration_url):
-                self._notify(context, instance_ref, "launch.end", network_info=network_info)
-        except Exception, e:
-            _log_error("launch")
-            if not(migration_url):
-                self._instance_update(context,
-                                      instance_uuid,
-                                      vm_state=vm_states.ERROR,
-                                      host=self.host,
-                                      node=self.nodename,
-                                      task_state=None)
-            raise e
+            try:
+                if migration_network_info != None:
+                    # (dscannell): Since this migration_network_info came over the wire we need
+                    # to hydrate it back into a full NetworkInfo object.
+                    network_info = network_model.NetworkInfo.hydrate(migration_network_info)
+                else:
+                    with metrics.phase('network'):
+                        network_info = self._instance_network_info(context, instance_ref,
+                                                                   migration_url != None,
+                                                                   requested_networks=requested_networks)
+                    if network_info == None:
+                        # An error would have occured acquiring the instance network info. We should
+                        # mark the instances as error and return because there is nothing else we can do.
+                        self._rollback_launch(context, instance_ref,
+                                              block_device_stage, created_bdms,
+                                              allocate_network)
+                        self._instance_update(context, instance_ref['uuid'],
+                                              vm_state=vm_states.ERROR,
+                                              task_state=None,
+                                              **expected)
+                        return
+
+                    if not(pooled):
+                        # Update the task state to spawning from networking.
+                        self._instance_update(context, instance_ref['uuid'],
+                                              task_state=task_states.SPAWNING)
+
+                # A launch cannot go on without its block devices, so they
+                # are checked before the networks are set up on this host.
+                block_device_info = block_device_stage.wait()
+
+                # The main goal is to have the nova-compute process take ownership of setting up
+                # the networking for the launched instance. This ensures that later changes to the
+                # iptables can be handled directly by nova-compute. The method "pre_live_migration"
+                # essentially sets up the networking for the instance on the destination host. We
+                # simply send this message to nova-compute running on the same host (self.host)
+                # and pass in block_migration:false and disk:none so that no disk operations are
+                # performed.
+                #
+                # TODO(dscannell): How this behaves with volumes attached is an unknown. We currently
+                # do not support having volumes attached at launch time, so we should be safe in
+                # this regard.
+                #
+                # NOTE(amscanne): This will happen prior to launching in the migration code, so
+                # we don't need to bother with this call in that case.
+                if not(migration_url):
+                    with metrics.phase('pre_live_migration'):
+                        rpc.call(context,
+                            rpc.queue_get_for(context, CONF.compute_topic, self.host),
+                            {"method": "pre_live_migration",
+                             "version": "2.2",
+                             "args": {'instance': instance_ref,
+                                      'block_migration': False,
+                                      'disk': None}},
+                            timeout=CONF.cobalt_compute_timeout)
+
+                # The artifacts fetched by their stage are handed to the
+                # launch so that it does not fetch them again.
+                if artifact_stage is not None:
+                    fetched_refs = artifact_stage.wait()
+
+                vms_policy = self._generate_vms_policy_name(context, instance_ref,
+                                                            source_instance_ref,
+                                                            template=vms_policy_template)
+                with metrics.phase('vms_launch'):
+                    self.vms_conn.launch(context,
+                                         source_instance_ref['name'],
+                                         instance_ref,
+                                         network_info,
+                                         target=target,
+                                         migration_url=migration_url,
+                                         image_refs=image_refs,
+                                         params=params,
+                                         vms_policy=vms_policy,
+                                         block_device_info=block_device_info,
+                                         lvm_info=lvm_info,
+                                         fetched_refs=fetched_refs)
+                launched = True
+
+                if not(migration_url):
+                    self._notify(context, instance_ref, "launch.end", network_info=network_info)
+            except Exception, e:
+                _log_error("launch")
+                self._rollback_launch(context, instance_ref,
+                                      block_device_stage, created_bdms,
+                                      allocate_network)
+                if not(migration_url):
+                    self._instance_update(context,
+                                          instance_uuid,
+                                          vm_state=vm_states.ERROR,
+                                          host=self.host,
+                                          node=self.nodename,
+                                          task_state=None,
+                                          **expected)
+                raise e
+        finally:
+            # Every stage is over by the time the launch is, whether it
+            # failed or not, and the artifacts fetched for it are released
+            # (as backing the instance if it is running).
+            self._finish_stage(block_device_stage)
+            if artifact_stage is not None:
+                fetched_refs = self._finish_stage(artifact_stage)
+                if fetched_refs:
+                    self.vms_conn.release_artifacts(fetched_refs,
+                                                    running=launched)
 
         try:
-            # Perform our database update.
-            power_state = self.compute_manager._get_power_state(context, instance_ref)
-            update_params = {'power_state': power_state,
-                             'vm_state': vm_states.ACTIVE,
-                             'host': self.host,
-                             'node': self.nodename,
-                             'task_state': None}
-            if not(migration_url):
-                update_params['launched_at'] = timeutils.utcnow()
-            self._instance_update(context,
-                                  instance_uuid,
-                                  **update_params)
+            # Perform our database update. A pooled launch is only recorded
+            # once its caller has paused it.
+            if not(pooled):
+                power_state = self.compute_manager._get_power_state(context, instance_ref)
+                update_params = {'power_state': power_state,
+                                 'vm_state': vm_states.ACTIVE,
+                                 'host': self.host,
+                                 'node': self.nodename,
+                                 'task_state': None}
+                if not(migration_url):
+                    update_params['launched_at'] = timeutils.utcnow()
+                with metrics.phase('db_update'):
+                    self._instance_update(context,
+                                          instance_uuid,
+                                          **update_params)
 
         except:
             # NOTE(amscanne): In this case, we do not throw an exception.
@@ -1169,14 +1832,49 @@ class CobaltManager(manager.SchedulerDependentManager):
             # is updated at some point with the correct state.
             _log_error("post launch update")
 
+        if not(migration_url) and CONF.cobalt_use_image_service:
+            try:
+                self._report_cached_artifacts(context, source_instance_ref)
+            except:
+                _log_error("cached artifacts report")
+
+    @_lock_call
+    def claim_pooled_instance(self, context, instance_uuid=None,
+                              instance_ref=None):
+        """
+        Hands a pooled clone over to the launch that claimed it. The clone
+        already runs with its networks set up, so it only has to be unpaused.
+        The claiming launch has already recorded its name in the database.
+        """
+        context = context.elevated()
+        self._notify(context, instance_ref, "launch.start")
+        try:
+            with metrics.phase('vms_unpause'):
+                self.vms_conn.unpause_instance(instance_ref)
+        except:
+            _log_error("claim")
+            self._instance_update(context, instance_uuid,
+                                  vm_state=vm_states.ERROR,
+                                  task_state=None)
+            raise
+
+        self._instance_update(context, instance_uuid,
+                              vm_state=vm_states.ACTIVE,
+                              power_state=self.compute_manager._get_power_state(
+                                                    context, instance_ref),
+                              task_state=None,
+                              launched_at=timeutils.utcnow())
+        self._notify(context, instance_ref, "launch.end")
+
     @_lock_call
     def export_instance(self, context, instance_uuid=None, instance_ref=None, image_id=None):
         """
          Fills in the the image record with the blessed artifacts of the object
         """
         # Basically just make a call out to vmsconn (proper version, etc) to fill in the image
-        self.vms_conn.export_instance(context, instance_ref, image_id,
-                                      self._extract_image_refs(instance_ref))
+        with metrics.phase('vms_export'):
+            self.vms_conn.export_instance(context, instance_ref, image_id,
+                                          self._extract_image_refs(instance_ref))
 
     @_lock_call
     def import_instance(self, context, instance_uuid=None, instance_ref=None, image_id=None):
@@ -1187,19 +1885,26 @@ class CobaltManager(manager.SchedulerDependentManager):
         # Download the image_id, load it into vmsconn (the archive). Vmsconn will spit out the blessed
         # artifacts and we need to then upload them to the image service if that is what we are
         # using.
-        image_ids = self.vms_conn.import_instance(context, instance_ref, image_id)
+        with metrics.phase('vms_import'):
+            image_ids = self.vms_conn.import_instance(context, instance_ref, image_id)
         image_ids_str = ','.join(image_ids)
         system_metadata = self._system_metadata_get(instance_ref)
         system_metadata['images'] = image_ids_str
         self._instance_update(context, instance_uuid, vm_state='blessed',
                               system_metadata=system_metadata)
 
-    def install_policy(self, context, policy_ini_string=None):
+    def install_policy(self, context, policy_ini_string=None, force=False,
+                       policy_hash=None):
         """
-        Install new vmspolicyd policy definitions on the host.
+        Install new vmspolicyd policy definitions on the host, unless the
+        policy with policy_hash (see cobalt.nova.common.policy_hash) already
+        is and force is not set. Returns 'installed' or 'unchanged'.
         """
         try:
-            self.vms_conn.install_policy(policy_ini_string)
+            if self.vms_conn.install_policy(policy_ini_string, force=force,
+                                            policy_hash=policy_hash):
+                return 'installed'
+            return 'unchanged'
         except Exception, ex:
             LOG.error(_("Policy install failed: %s"), ex)
             raise ex
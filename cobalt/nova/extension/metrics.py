@@ -0,0 +1,187 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process latency metrics for the cobalt operations.
+
+Each operation (bless, launch, migrate, ...) is timed by an OperationTimer
+that also records how long each of its named phases took. Timers are kept
+per greenthread, so the code deep inside an operation (e.g. the vms
+connection) can record a phase without having the timer passed to it:
+
+    metrics.start('launch')
+    try:
+        with metrics.phase('network'):
+            ...
+    finally:
+        metrics.finish()
+
+The durations are aggregated in histograms named after the operation
+('launch') and its phases ('launch.network').
+"""
+
+import collections
+import contextlib
+import time
+
+from eventlet import corolocal
+from eventlet import greenthread
+
+# The number of most recent samples kept per histogram for the percentiles.
+MAX_SAMPLES = 1024
+
+class Histogram(object):
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """ Returns the given percentile of the recent samples. """
+        if len(self.samples) == 0:
+            return 0.0
+        samples = sorted(self.samples)
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.count and self.total / self.count or 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+class Metrics(object):
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            self.histograms[name] = histogram
+        histogram.record(seconds)
+
+    def summary(self):
+        """ Returns {name: {count, mean, max, p50, p95, p99}}. """
+        return dict([(name, histogram.summary())
+                     for name, histogram in self.histograms.items()])
+
+    def reset(self):
+        self.histograms = {}
+
+class OperationTimer(object):
+
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+        self.started = time.time()
+        self.phases = []
+
+    def record_phase(self, name, seconds):
+        self.phases.append((name, seconds))
+        self.metrics.record('%s.%s' % (self.operation, name), seconds)
+
+    def timings(self):
+        """ Returns the time spent so far in total and in each phase. """
+        phases = {}
+        for name, seconds in self.phases:
+            phases[name] = phases.get(name, 0.0) + seconds
+        return {'total': time.time() - self.started,
+                'phases': phases}
+
+    def finish(self):
+        timings = self.timings()
+        self.metrics.record(self.operation, timings['total'])
+        return timings
+
+REGISTRY = Metrics()
+
+_local = corolocal.local()
+
+def _timers():
+    timers = getattr(_local, 'timers', None)
+    if timers is None:
+        timers = []
+        _local.timers = timers
+    return timers
+
+def start(operation, metrics=None):
+    """ Starts timing an operation in the current greenthread. """
+    timer = OperationTimer(metrics or REGISTRY, operation)
+    _timers().append(timer)
+    return timer
+
+def finish():
+    """ Finishes the operation started last in the current greenthread. """
+    timers = _timers()
+    if len(timers) == 0:
+        return None
+    return timers.pop().finish()
+
+def current_timings():
+    """ Returns the timings of the current operation, or None. """
+    timers = _timers()
+    if len(timers) == 0:
+        return None
+    return timers[-1].timings()
+
+def spawn(name, fn, *args, **kwargs):
+    """
+    Runs fn in a new greenthread, timed as a phase of the operation of the
+    current greenthread. Returns the new greenthread.
+    """
+    timers = list(_timers())
+
+    def _run():
+        _local.timers = timers
+        with phase(name):
+            return fn(*args, **kwargs)
+
+    return greenthread.spawn(_run)
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Times a phase of the current operation. Outside of an operation the
+    phase is recorded on its own.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        record_phase(name, time.time() - started)
+
+def record_phase(name, seconds):
+    """
+    Records a phase of the current operation that was timed separately, e.g.
+    because it does not match a block of code. Outside of an operation the
+    phase is recorded on its own.
+    """
+    timers = _timers()
+    if len(timers) > 0:
+        timers[-1].record_phase(name, seconds)
+    else:
+        REGISTRY.record(name, seconds)
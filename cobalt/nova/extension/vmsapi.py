@@ -18,18 +18,52 @@ Performs the direct interactions with the vms library.
 """
 import json
 import tempfile
+import time
+
+import eventlet
+from eventlet import queue
+from eventlet.green import subprocess
 
 from nova import exception
 from nova import utils
 from nova.openstack.common import log as logging
+from nova.openstack.common import processutils
 from nova.openstack.common.gettextutils import _
+from oslo.config import cfg
 
 import vms
 from vms import control
 
 from nova.openstack.common.gettextutils import _
 
+from . import vmsworker
+
 LOG = logging.getLogger('nova.cobalt.vmsapi')
+CONF = cfg.CONF
+
+vmsapi_opts = [
+               cfg.IntOpt('cobalt_vmsctl_workers',
+               default=0,
+               help='The number of long-lived privileged vmsctl workers used '
+                    'to execute vms commands. Each worker is started once '
+                    'through rootwrap (cobalt-vmsctl-worker, which needs a '
+                    'rootwrap filter), avoiding the rootwrap and sudo startup '
+                    'cost on every command. When 0, vmsctl is forked through '
+                    'rootwrap for every command.'),
+
+               cfg.IntOpt('cobalt_vmsctl_worker_respawn_delay',
+               default=30,
+               help='The number of seconds to wait before trying to start a '
+                    'vmsctl worker again after it failed to start. Commands '
+                    'fall back to forking vmsctl in the meantime.'),
+
+               cfg.IntOpt('cobalt_vmsctl_worker_start_timeout',
+               default=10,
+               help='The number of seconds a vmsctl worker is given to '
+                    'start. A worker that is not ready by then counts as '
+                    'failing to start.')]
+CONF.register_opts(vmsapi_opts)
+CONF.import_opt('rootwrap_config', 'nova.utils')
 
 class BlessResult(object):
 
@@ -72,18 +106,170 @@ class BlessResult(object):
                              ['%s:%s' %(lv['name'],lv['size_bytes'])
                              for lv in logical_volumes]
 
+class VmsctlWorkerUnavailable(Exception):
+    """
+    The command could not be handed to a worker. It was not executed so it is
+    safe to run it some other way.
+    """
+    pass
+
+class VmsctlWorkerLost(exception.NovaException):
+    """
+    The worker died after the command was handed over. The command may or may
+    not have been executed.
+    """
+    message = _("Lost the vmsctl worker while executing %(cmd)s")
+
+class VmsctlWorker(object):
+    """
+    The client side of a single privileged vmsctl worker process (see
+    cobalt.nova.extension.vmsworker for the protocol).
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Starts the worker and waits for its READY frame. Raises
+        VmsctlWorkerUnavailable if it does not start (e.g. rootwrap rejected
+        it) within cobalt_vmsctl_worker_start_timeout seconds.
+        """
+        LOG.debug(_("Starting vmsctl worker %s"), self.command)
+        timer = eventlet.Timeout(CONF.cobalt_vmsctl_worker_start_timeout)
+        try:
+            try:
+                self.process = subprocess.Popen(self.command,
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                close_fds=True)
+                ready = vmsworker.read_frame(self.process.stdout)
+            finally:
+                timer.cancel()
+        except eventlet.Timeout, t:
+            if t is not timer:
+                raise
+            self.stop()
+            raise VmsctlWorkerUnavailable(
+                    _("worker not ready after %d seconds") %
+                    CONF.cobalt_vmsctl_worker_start_timeout)
+        except (IOError, OSError, ValueError, vmsworker.FrameError), e:
+            self.stop()
+            raise VmsctlWorkerUnavailable(str(e))
+        if ready != vmsworker.READY:
+            self.stop()
+            raise VmsctlWorkerUnavailable(_("worker exited on startup"))
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        self.process = None
+
+    def execute(self, cmd):
+        try:
+            vmsworker.write_frame(self.process.stdin, {'cmd': cmd})
+        except (IOError, OSError), e:
+            raise VmsctlWorkerUnavailable(str(e))
+
+        try:
+            response = vmsworker.read_frame(self.process.stdout)
+        except (IOError, OSError, ValueError, vmsworker.FrameError), e:
+            LOG.warn(_("Failed to read the vmsctl worker response: %s"), e)
+            response = None
+        if response is None:
+            # The command was handed over, it must not be run again.
+            raise VmsctlWorkerLost(cmd=cmd)
+
+        return (response['exit_code'], response['stdout'], response['stderr'])
+
+class VmsctlWorkerPool(object):
+    """
+    A small pool of privileged vmsctl workers. Workers are started lazily and
+    a worker that has died is restarted the next time it is checked out.
+    """
+
+    def __init__(self, command, size):
+        self.command = command
+        self.size = size
+        self.last_start_failure = None
+        self.idle = queue.LightQueue()
+        for i in range(size):
+            self.idle.put(VmsctlWorker(command))
+
+    def _ensure_started(self, worker):
+        if worker.is_alive():
+            return
+        if worker.process is not None:
+            LOG.warn(_("The vmsctl worker exited with code %s, restarting it."),
+                     worker.process.returncode)
+            worker.stop()
+
+        if self.last_start_failure is not None and \
+           time.time() - self.last_start_failure < \
+                CONF.cobalt_vmsctl_worker_respawn_delay:
+            raise VmsctlWorkerUnavailable(_("worker recently failed to start"))
+        try:
+            worker.start()
+            self.last_start_failure = None
+        except VmsctlWorkerUnavailable:
+            # The worker is not started again until the respawn delay has
+            # passed, the commands fall back to forking vmsctl until then.
+            self.last_start_failure = time.time()
+            raise
+
+    def execute(self, cmd):
+        """ Returns (exit_code, stdout, stderr) for the command. """
+        try:
+            worker = self.idle.get_nowait()
+        except queue.Empty:
+            # All of the workers are busy. The command is forked rather than
+            # queued so the pool does not limit the number of vms commands
+            # running at the same time.
+            raise VmsctlWorkerUnavailable(_("no idle worker"))
+        try:
+            self._ensure_started(worker)
+            return worker.execute(cmd)
+        except VmsctlWorkerUnavailable:
+            worker.stop()
+            raise
+        except VmsctlWorkerLost:
+            worker.stop()
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def shutdown(self):
+        for i in range(self.size):
+            self.idle.get().stop()
+
 class VmsDriver(object):
 
     def run_command(self, cmd_list):
         pass
 
+    def config(self):
+        """ Returns the vms configuration (e.g. the SHARED directory). """
+        from vms import config
+        return config
+
 
 class Vmsctl(VmsDriver):
     """
     A simple class that allows executing vmsctl commands.
     """
 
-    def __init__(self, vms_platform=None, management_options=None):
+    def __init__(self, vms_platform=None, management_options=None, workers=0):
         if management_options == None:
             management_options = {}
 
@@ -96,11 +282,38 @@ class Vmsctl(VmsDriver):
         for key, value in management_options.iteritems():
             self.vmsctl_command += ['-m', '%s=%s' %(key, value)]
 
+        self.worker_pool = None
+        if workers > 0:
+            # The worker is started through rootwrap, the same way nova runs
+            # its commands as root.
+            worker_command = ['sudo', 'nova-rootwrap', CONF.rootwrap_config,
+                              'cobalt-vmsctl-worker']
+            self.worker_pool = VmsctlWorkerPool(worker_command, workers)
+
+    def _execute_on_worker(self, cmd):
+        (exit_code, stdout, stderr) = self.worker_pool.execute(cmd)
+        if exit_code != 0:
+            raise processutils.ProcessExecutionError(exit_code=exit_code,
+                                                     stdout=stdout,
+                                                     stderr=stderr,
+                                                     cmd=' '.join(cmd))
+        return (stdout, stderr)
+
     def run_command(self, cmd_list):
         cmd = self.vmsctl_command + cmd_list
         LOG.debug(_('Executing vms command %s'), cmd)
 
-        (stdout, stderr) = utils.execute(*cmd, run_as_root=True)
+        if self.worker_pool is not None:
+            try:
+                (stdout, stderr) = self._execute_on_worker(cmd)
+            except VmsctlWorkerUnavailable, e:
+                # The command never reached a worker so we can safely fall
+                # back to forking vmsctl through rootwrap.
+                LOG.warn(_("No vmsctl worker available (%s), forking vmsctl "
+                           "instead."), e)
+                (stdout, stderr) = utils.execute(*cmd, run_as_root=True)
+        else:
+            (stdout, stderr) = utils.execute(*cmd, run_as_root=True)
         # Returns a tuple of (stdout, stderr). Log the information in
         # stderr and return stdout back to the caller.
         for line in stderr.split('\n'):
@@ -138,6 +351,9 @@ class VmsApi(object):
     def configure(self, vms_driver):
         self.vms_driver = vms_driver
 
+    def config(self):
+        return self.vms_driver.config()
+
     def bless(self, instance_name, new_instance_name, mem_url=None,
               migration=False, path=None, **kwargs):
         result = BlessResult()
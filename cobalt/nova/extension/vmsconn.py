@@ -18,12 +18,17 @@ Interfaces that configure vms and perform hypervisor specific operations.
 """
 
 import hashlib
+import json
 import os
 import pwd
+import sys
 import tempfile
+import time
 import uuid
 import inspect
 
+from eventlet import event
+from eventlet import semaphore
 from glanceclient.exc import HTTPForbidden
 
 import nova
@@ -38,7 +43,10 @@ from nova.compute import utils as compute_utils
 from nova.openstack.common import log as logging
 from oslo.config import cfg
 
+from .. import common as co_common
 from .. import image as co_image
+from . import artifacts as co_artifacts
+from . import metrics
 
 from nova.openstack.common.gettextutils import _
 
@@ -58,11 +66,30 @@ vmsconn_opts = [
                cfg.BoolOpt('cobalt_clean_unused_symlinks',
                default=True,
                help='Cobalt should clean up symlinks that is creates and'
-                    'are discovered to be unused.')]
+                    'are discovered to be unused.'),
+
+               cfg.BoolOpt('cobalt_dedup_uploads',
+               default=True,
+               help='Reuse the disk and memory images already in the image '
+                    'service for the same lineage instead of uploading '
+                    'blessed files with identical contents again.'),
+
+               cfg.IntOpt('cobalt_released_image_grace',
+               default=600,
+               help='The number of seconds a shared image is kept after its '
+                    'last user released it before it is deleted, so that the '
+                    'blesses sharing it at that time can record it.'),
+
+               cfg.StrOpt('cobalt_policy_record',
+               default='$state_path/cobalt-policy.json',
+               help='The file recording the version and hash of the memory '
+                    'policy installed on this host. Installing the same '
+                    'policy again is skipped.')]
 CONF.register_opts(vmsconn_opts)
 
 import vms.utilities as utilities
 from . import vmsapi as vms_api
+from . import vmssim
 
 def run_as(cmd, uid):
     sudo_cmd = ['sudo', '-u', '#%d' % uid]
@@ -78,6 +105,23 @@ def touch_as(path, uid):
 def symlink_as(target, link, uid):
     run_as(['ln', '-s', target, link], uid)
 
+# Glance limits the length of property values.
+MAX_PROPERTY_LENGTH = 255
+
+# The image property set (and never cleared) once a second blessed instance
+# has been added to the users of the image.
+IMAGE_SHARED_KEY = 'cobalt_image_shared'
+
+# The image properties set when the last user of a shared image released it,
+# and when it did. Such an image is deleted by reap_released_images.
+IMAGE_RELEASED_KEY = 'cobalt_image_released'
+IMAGE_RELEASED_AT_KEY = 'cobalt_image_released_at'
+
+def _image_users(image):
+    """ Returns the names of the blessed instances sharing the image. """
+    users = image.get('properties', {}).get('cobalt_image_users', '')
+    return [user for user in users.split(',') if user]
+
 def get_vms_connection(virt_driver):
     # Configure the logger regardless of the type of connection that will be used.
 
@@ -99,7 +143,9 @@ def get_vms_connection(virt_driver):
     elif connection_type == 'libvirt':
         return LibvirtConnection(vmsapi, virt_driver)
     elif connection_type == 'fake':
-        return DummyConnection(vmsapi, virt_driver)
+        # The simulated backend understands the latest vmsctl commands.
+        return DummyConnection(vms_api.get_vmsapi(version=vmssim.VMS_VERSION),
+                               virt_driver)
     else:
         raise exception.NovaException(_('Unsupported connection type "%s"' % connection_type))
 
@@ -118,6 +164,36 @@ def _log_call(fn):
     return wrapped_fn
 
 
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls made with the same key: the first caller runs
+    the function while the others wait for it to finish and share its result
+    (or its exception).
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        waiter = self.in_flight.get(key)
+        if waiter is not None:
+            self.coalesced += 1
+            return waiter.wait()
+
+        waiter = event.Event()
+        self.in_flight[key] = waiter
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            del self.in_flight[key]
+            waiter.send_exception(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        del self.in_flight[key]
+        waiter.send(result)
+        return result
+
 class VmsConnection:
 
     def __init__(self, vmsapi,virt_driver, image_service=None):
@@ -125,6 +201,18 @@ class VmsConnection:
         self.virt_driver = virt_driver
         self.image_service = image_service if image_service is not None \
                                                     else co_image.ImageService()
+        # The local cache of artifacts downloaded from the image service, if
+        # this connection uses one.
+        self.artifact_cache = None
+        # Concurrent launches of the same live-image share a single download
+        # of each of its artifacts.
+        self.artifact_downloads = SingleFlight()
+        # The version and hash of the installed policy (loaded on first use).
+        self.policy_record = None
+        self.policy_lock = semaphore.Semaphore()
+        # Serializes the updates of the users of the shared images made on
+        # this host.
+        self.image_users_lock = semaphore.Semaphore()
 
     def configure(self, virtapi):
         """
@@ -165,12 +253,6 @@ class VmsConnection:
                 if os.path.exists(blessed_file):
                     os.unlink(blessed_file)
 
-    @_log_call
-    def _upload_files(self, context, instance_ref, blessed_files,
-                      image_ids=None, vms_policy_template=None):
-        """ Upload the bless files into nova's image service (e.g. glance). """
-        raise Exception("Uploading files to the image service is not supported.")
-
     @_log_call
     def discard(self, context, instance_name, migration_url=None, image_refs=[]):
         """
@@ -178,44 +260,314 @@ class VmsConnection:
         """
         result =  self.vmsapi.discard(instance_name, mem_url=migration_url)
         if CONF.cobalt_use_image_service:
-            self._delete_images(context, image_refs)
+            self._delete_images(context, image_refs, instance_name=instance_name)
+
+    def _image_lineage(self, instance_ref):
+        """
+        Returns the lineage of the images of a blessed instance: the uuid of
+        the instance that was blessed (or of the instance itself for a
+        migration).
+        """
+        system_metadata = instance_ref.get('system_metadata') or {}
+        return system_metadata.get('blessed_from', instance_ref['uuid'])
+
+    def _update_image_users(self, context, image_id, update):
+        """
+        Replaces the users of the image with update(users), unless that
+        returns None, and returns the resulting users. The updates made on
+        this host are serialized. The image service has no conditional update
+        so the updates made by other hosts at the same time can be lost,
+        which is why a shared image is only deleted once no blessed instance
+        refers to it (see reap_released_images).
+        """
+        with self.image_users_lock:
+            users = _image_users(self.image_service.show(context, image_id))
+            new_users = update(users)
+            if new_users is None or new_users == users:
+                return users
+            self.image_service.update_properties(context, image_id,
+                                    {'cobalt_image_users': ','.join(new_users)})
+            return new_users
+
+    def _find_shared_image(self, context, lineage, checksum, instance_name):
+        """
+        Returns the image of the lineage that already has the given contents
+        and can be shared with instance_name, or None.
+        """
+        def _add_user(users):
+            if len(users) == 0:
+                # Only images that are tracking their users can be shared,
+                # otherwise discarding one instance would delete the image
+                # of the other. A user list that just emptied means the image
+                # is being deleted.
+                return None
+            if instance_name in users or \
+               len(','.join(users + [instance_name])) > MAX_PROPERTY_LENGTH:
+                return None
+            return users + [instance_name]
+
+        images = self.image_service.find(context,
+                                         {'checksum': checksum,
+                                          'property-cobalt_lineage': lineage})
+        for image in images:
+            users = _image_users(image)
+            if image.get('status') != 'active' or len(users) == 0 or \
+               len(','.join(users + [instance_name])) > MAX_PROPERTY_LENGTH:
+                continue
+            if instance_name in self._update_image_users(context, image['id'],
+                                                         _add_user):
+                # From now on the releases of the image leave its deletion
+                # to reap_released_images.
+                self.image_service.update_properties(context, image['id'],
+                                                     {IMAGE_SHARED_KEY: '1'})
+                return image
+        return None
 
     @_log_call
-    def _delete_images(self, context, image_refs):
-        pass
+    def _upload_files(self, context, instance_ref, blessed_files,
+                      image_ids=None, vms_policy_template=None):
+        """ Upload the bless files into nova's image service (e.g. glance). """
+        lineage = self._image_lineage(instance_ref)
+        instance_name = instance_ref['name']
+
+        uploads = []
+        for blessed_file in blessed_files:
+            image_name, image_type = \
+                self._get_glance_displayname_and_type(instance_ref, blessed_file)
+            uploads.append({'file': blessed_file,
+                            'name': image_name,
+                            'descriptor': blessed_file.endswith(".gc"),
+                            'properties': {'image_type': image_type,
+                                           'file_name': os.path.basename(blessed_file),
+                                           'instance_uuid': instance_ref['uuid'],
+                                           'cobalt_lineage': lineage}})
+
+        image_refs = []
+        try:
+            # The disk and memory files of a new bless are often identical
+            # to those of an earlier bless of the same instance. Those are
+            # shared instead of uploaded again. The descriptor is always
+            # specific to the blessed instance.
+            if CONF.cobalt_dedup_uploads:
+                data_uploads = [upload for upload in uploads
+                                if not upload['descriptor']]
+                checksums = co_common.run_concurrently(co_image.file_checksum,
+                                    [(upload['file'],) for upload in data_uploads],
+                                    CONF.cobalt_download_concurrency)
+                for upload, checksum in zip(data_uploads, checksums):
+                    image = self._find_shared_image(context, lineage, checksum,
+                                                    instance_name)
+                    if image is not None:
+                        LOG.debug(_("Sharing image %s for %s") %
+                                  (image['id'], upload['file']))
+                        upload['id'] = image['id']
+                        upload['shared'] = True
+                        image_refs.append(image['id'])
+
+            # Create all of the image records up front so the descriptor can
+            # refer to the other images when it is uploaded.
+            for upload in uploads:
+                if 'id' not in upload:
+                    upload['id'] = self.image_service.create(context,
+                                        upload['name'],
+                                        instance_uuid=instance_ref['uuid'],
+                                        properties=upload['properties'])
+                    image_refs.append(upload['id'])
+
+            descriptor_properties = {'live_image': True,
+                                     'owner_id': instance_ref['project_id'],
+                                     'live_image_source': instance_name,
+                                     'instance_type_id': instance_ref['instance_type_id']}
+            for upload in uploads:
+                if not upload['descriptor']:
+                    descriptor_properties['live_image_data_%s' % (upload['name'])] = \
+                        upload['id']
+            if vms_policy_template != None:
+                descriptor_properties['vms_policy_template'] = vms_policy_template
+
+            def _upload(upload):
+                properties = upload['properties']
+                if upload['descriptor']:
+                    properties.update(descriptor_properties)
+                else:
+                    properties['cobalt_image_users'] = instance_name
+                self.image_service.upload(context, upload['id'], upload['file'],
+                                          properties=properties)
+
+            co_common.run_concurrently(_upload,
+                                       [(upload,) for upload in uploads
+                                        if not upload.get('shared')],
+                                       CONF.cobalt_download_concurrency)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self._delete_images(context, image_refs,
+                                    instance_name=instance_name)
+            except:
+                LOG.exception(_("Failed to remove the images of %s after a "
+                                "failed upload") % (instance_name))
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return [upload['id'] for upload in uploads]
+
+    def _release_shared_image(self, context, image_ref, instance_name):
+        """
+        Removes instance_name from the users of the image. Returns True if
+        the image must not be deleted now: it is still used by other blessed
+        instances, or it was shared and its last user is gone. A user of a
+        shared image may have been lost by concurrent updates on several
+        hosts, so the latter is marked as released and left to
+        reap_released_images.
+        """
+        image = self.image_service.show(context, image_ref)
+        shared = IMAGE_SHARED_KEY in image.get('properties', {})
+        if len(_image_users(image)) == 0 and not shared:
+            return False
+        users = self._update_image_users(context, image_ref,
+                        lambda users: [user for user in users
+                                       if user != instance_name])
+        # The image is kept for as long as anyone else uses it, even if
+        # instance_name was not (or no longer) one of its users.
+        if len(users) > 0:
+            return True
+        if not shared:
+            # The image may have been shared since it was read.
+            image = self.image_service.show(context, image_ref)
+            if IMAGE_SHARED_KEY not in image.get('properties', {}):
+                return False
+        self.image_service.update_properties(context, image_ref,
+                                    {IMAGE_RELEASED_KEY: '1',
+                                     IMAGE_RELEASED_AT_KEY: str(time.time())})
+        return True
+
+    def reap_released_images(self, context, lineage_image_refs):
+        """
+        Deletes the shared images released by their last user more than
+        cobalt_released_image_grace seconds ago. An image is kept while it
+        has users again or while one of the blessed instances of its lineage
+        still refers to it: lineage_image_refs(lineage) returns the image
+        refs recorded by those.
+        """
+        now = time.time()
+        for image in self.image_service.find(context,
+                                    {'property-%s' % IMAGE_RELEASED_KEY: '1'}):
+            properties = image.get('properties', {})
+            try:
+                released_at = float(properties.get(IMAGE_RELEASED_AT_KEY))
+            except (TypeError, ValueError):
+                released_at = 0
+            if now - released_at < CONF.cobalt_released_image_grace or \
+               len(_image_users(image)) > 0:
+                continue
+            if image['id'] in lineage_image_refs(properties.get('cobalt_lineage')):
+                LOG.warn(_("The released image %s is still used, not "
+                           "removing it.") % (image['id']))
+                continue
+            try:
+                self.image_service.delete(context, image['id'])
+            except (exception.ImageNotFound, HTTPForbidden):
+                # Another host removed it first.
+                pass
+
+    @_log_call
+    def _delete_images(self, context, image_refs, instance_name=None):
+        for image_ref in image_refs:
+            try:
+                if instance_name is not None and \
+                   self._release_shared_image(context, image_ref, instance_name):
+                    LOG.debug("The image %s is still shared, not removing it." % (image_ref))
+                    continue
+                self.image_service.delete(context, image_ref)
+            except (exception.ImageNotFound, HTTPForbidden):
+                # Simply ignore this error because the end result
+                # is that the image is no longer there.
+                LOG.debug("The image %s was not found in the image service when removing it." % (image_ref))
 
     @_log_call
     def launch(self, context, instance_name, new_instance_ref,
                network_info, skip_image_service=False, target=0,
                migration_url=None, image_refs=[], params={}, vms_policy='',
-               block_device_info=None,lvm_info={}):
+               block_device_info=None,lvm_info={}, fetched_refs=None):
         """
-        Launch a blessed instance
+        Launch a blessed instance. If the caller already fetched the artifacts
+        (fetched_refs is what fetch_artifacts returned) they are not fetched
+        again, and the caller releases them.
         """
-        new_name, path = self.pre_launch(context, new_instance_ref, network_info,
-                                        migration=(migration_url and True),
-                                        skip_image_service=skip_image_service,
-                                        image_refs=image_refs,
-                                        block_device_info=block_device_info,
-                                        lvm_info=lvm_info)
+        release_refs = []
+        if fetched_refs is None:
+            with metrics.phase('artifact_fetch'):
+                release_refs = self.fetch_artifacts(context, image_refs,
+                                                     migration=(migration_url and True),
+                                                     skip_image_service=skip_image_service)
+        launched = False
+        try:
+            with metrics.phase('pre_launch'):
+                new_name, path = self.pre_launch(context, new_instance_ref, network_info,
+                                                migration=(migration_url and True),
+                                                skip_image_service=skip_image_service,
+                                                image_refs=image_refs,
+                                                block_device_info=block_device_info,
+                                                lvm_info=lvm_info)
+
+            # Launch the new VM.
+            vms_options = {'memory.policy':vms_policy}
+            for vif in network_info:
+                LOG.info("**** Launching instance with VIF address %s ****", vif['address'])
+            if len(network_info) > 0:
+                vms_options['xen_mac_addr'] = network_info[0]['address']
+            with metrics.phase('vmsctl_launch'):
+                result = self.vmsapi.launch(instance_name, new_name, target, path,
+                                            mem_url=migration_url, migration=(migration_url and True),
+                                            guest_params=params.get('guest',{}),
+                                            vms_options=vms_options)
+
+            # Take care of post-launch.
+            with metrics.phase('post_launch'):
+                self.post_launch(context,
+                                 new_instance_ref,
+                                 network_info,
+                                 migration=(migration_url and True))
+            launched = True
+            return result
+        finally:
+            self.release_artifacts(release_refs, running=launched)
 
-        # Launch the new VM.
-        vms_options = {'memory.policy':vms_policy}
-        for vif in network_info:
-            LOG.info("**** Launching instance with VIF address %s ****", vif['address'])
-        if len(network_info) > 0:
-            vms_options['xen_mac_addr'] = network_info[0]['address']
-        result = self.vmsapi.launch(instance_name, new_name, target, path,
-                                    mem_url=migration_url, migration=(migration_url and True),
-                                    guest_params=params.get('guest',{}),
-                                    vms_options=vms_options)
-
-        # Take care of post-launch.
-        self.post_launch(context,
-                         new_instance_ref,
-                         network_info,
-                         migration=(migration_url and True))
-        return result
+    def fetch_artifacts(self, context, image_refs, migration=False,
+                        skip_image_service=False, concurrency=None):
+        """
+        Makes the artifacts of image_refs available locally before a launch
+        (or ahead of a batch of launches). Returns the image refs that were
+        fetched into the artifact cache; they must be given back to
+        release_artifacts once the launch is over. At most concurrency
+        artifacts are downloaded at a time (cobalt_download_concurrency by
+        default).
+        """
+        return []
+
+    def release_artifacts(self, image_refs, running=False):
+        if self.artifact_cache is not None and len(image_refs) > 0:
+            self.artifact_cache.release(image_refs, running=running)
+
+    def cached_image_refs(self):
+        """
+        Returns the image refs of the artifacts in the local cache, or None if
+        this connection does not cache artifacts.
+        """
+        if self.artifact_cache is None:
+            return None
+        return self.artifact_cache.image_ids()
+
+    def update_artifact_usage(self, image_refs):
+        """
+        Tells the artifact cache which images are used by the instances
+        running on this host so that they are never evicted.
+        """
+        if self.artifact_cache is not None:
+            self.artifact_cache.set_in_use(image_refs)
+            self.artifact_cache.evict()
+            LOG.debug(_("Artifact cache statistics: %s (%d coalesced downloads)"),
+                      self.artifact_cache.stats,
+                      self.artifact_downloads.coalesced)
 
     @_log_call
     def pre_launch(self, context,
@@ -257,6 +609,7 @@ class VmsConnection:
         shared = config.SHARED
 
         artifacts = []
+        downloads = []
 
         for image_ref in image_refs:
             if image_ref.startswith(config.SHARED):
@@ -265,9 +618,11 @@ class VmsConnection:
                 image = self.image_service.show(context, image_ref)
                 # old usage of image['name'] included for backwards compatibility
                 target = os.path.join(shared, image['properties'].get('file_name', image['name']))
-                self.image_service.download(context, image_ref, target)
+                downloads.append((image_ref, target, image.get('checksum')))
                 artifacts.append(target)
 
+        self.image_service.download_all(context, downloads)
+
         fd, temp_target = tempfile.mkstemp()
         os.close(fd)
         return temp_target, None, artifacts
@@ -342,22 +697,65 @@ class VmsConnection:
         image_name, image_type = self._get_glance_displayname_and_type(instance_ref, filename)
 
         image_id = self.image_service.create(context, image_name, instance_uuid=instance_ref['uuid'])
-        self.image_service.upload(context, image_id, filename)
-
-        properties = self.image_service.show(context, image_id)['properties']
-        properties.update({'image_type': image_type,
-                           'file_name': os.path.basename(filename)})
-        self.image_service.update(context, image_id, {'properties': properties})
+        self.image_service.upload(context, image_id, filename,
+                                  properties={'image_type': image_type,
+                                              'file_name': os.path.basename(filename)})
 
         return image_name, image_id
 
     @_log_call
-    def install_policy(self, raw_ini_policy):
+    def install_policy(self, raw_ini_policy, force=False, policy_hash=None):
         """
         Install a new set of policy definitions (provided as a string with the
-        contents of an ini file) on the local host.
+        contents of an ini file) on the local host. Nothing is done if the
+        same policy is already installed, unless force is set (e.g. when
+        vmspolicyd lost the policy that the record says is installed). The
+        hash of the policy is computed unless it is given. Returns True if the
+        policy was installed, False if it already was.
         """
-        return self.vmsapi.install_policy(raw_ini_policy)
+        if policy_hash is None:
+            policy_hash = co_common.policy_hash(raw_ini_policy)
+        with self.policy_lock:
+            record = self._load_policy_record()
+            if not force and record.get('hash') == policy_hash:
+                LOG.debug(_("Policy %s (version %s) is already installed."),
+                          policy_hash, record.get('version'))
+                return False
+            self.vmsapi.install_policy(raw_ini_policy)
+            self._save_policy_record({'hash': policy_hash,
+                                      'version': record.get('version', 0) + 1})
+            return True
+
+    def get_policy_hash(self):
+        """ Returns the hash of the installed policy, or None if unknown. """
+        return self._load_policy_record().get('hash')
+
+    def _load_policy_record(self):
+        if self.policy_record is None:
+            try:
+                with open(CONF.cobalt_policy_record) as record_file:
+                    self.policy_record = json.load(record_file)
+            except (IOError, ValueError), e:
+                if os.path.exists(CONF.cobalt_policy_record):
+                    LOG.warn(_("Ignoring the unreadable policy record %s: %s"),
+                             CONF.cobalt_policy_record, e)
+                self.policy_record = {}
+        return self.policy_record
+
+    def _save_policy_record(self, record):
+        self.policy_record = record
+        # Write the new record next to the old one and move it in place so
+        # the record is never partially written.
+        temp_path = CONF.cobalt_policy_record + '.tmp'
+        try:
+            with open(temp_path, 'w') as record_file:
+                json.dump(record, record_file)
+            os.rename(temp_path, CONF.cobalt_policy_record)
+        except (IOError, OSError), e:
+            # The policy is installed, it will only be installed again after
+            # a restart.
+            LOG.warn(_("Failed to save the policy record %s: %s"),
+                     CONF.cobalt_policy_record, e)
 
     def get_hypervisor_hostname(self):
         raise NotImplementedError()
@@ -374,8 +772,38 @@ class VmsConnection:
 
 
 class DummyConnection(VmsConnection):
+    """
+    VMS connection for nova's fake compute driver. The vms commands are run
+    by a simulated vms backend (see cobalt.nova.extension.vmssim).
+    """
+    def __init__(self, vmsapi, virt_driver, image_service=None):
+        VmsConnection.__init__(self, vmsapi, virt_driver,
+                               image_service=image_service)
+        self.simulator = vmssim.SimulatedVms()
+
     def configure(self, virtapi):
-        self.vmsapi.configure('dummy')
+        self.vmsapi.configure(self.simulator)
+
+    def bless(self, context, instance_name, new_instance_ref, migration_url=None):
+        self.simulator.set_memory(instance_name, new_instance_ref.get('memory_mb'))
+        return VmsConnection.bless(self, context, instance_name,
+                                   new_instance_ref, migration_url=migration_url)
+
+    def launch(self, context, instance_name, new_instance_ref,
+               network_info, **kwargs):
+        self.simulator.set_memory(new_instance_ref['name'],
+                                  new_instance_ref.get('memory_mb'))
+        return VmsConnection.launch(self, context, instance_name,
+                                    new_instance_ref, network_info, **kwargs)
+
+    def post_migration(self, context, instance_ref, network_info, migration_url):
+        self.vmsapi.kill_memservers(migration_url)
+
+    def get_hypervisor_hostname(self):
+        return self.virt_driver.get_available_nodes()[0]
+
+    def get_instance_info(self, instance):
+        return self.simulator.get_info(instance['name'])
 
 class XenApiConnection(VmsConnection):
     """
@@ -398,6 +826,10 @@ class XenApiConnection(VmsConnection):
     def get_hypervisor_hostname(self):
         return self.virt_driver._hypervisor_hostname
 
+    def _upload_files(self, context, instance_ref, blessed_files,
+                      image_ids=None, vms_policy_template=None):
+        raise Exception("Uploading files to the image service is not supported.")
+
     @_log_call
     def bless(self, context, instance_name, new_instance_ref,
               migration_url=None):
@@ -416,7 +848,7 @@ class XenApiConnection(VmsConnection):
     def launch(self, context, instance_name, new_instance,
                network_info, skip_image_service=False, target=0,
                migration_url=None, image_refs=[], params={}, vms_policy='',
-               block_device_info=None,lvm_info={}):
+               block_device_info=None,lvm_info={}, fetched_refs=None):
         """
         Launch a blessed instance
         """
@@ -482,7 +914,12 @@ class LibvirtConnection(VmsConnection):
         libvirt_uri = launch_libvirt_conn.uri()
         self.vmsapi.configure(
                 vms_api.Vmsctl(vms_platform='libvirt',
-                            management_options={'connection_url': libvirt_uri}))
+                            management_options={'connection_url': libvirt_uri},
+                            workers=CONF.cobalt_vmsctl_workers))
+
+        self.artifact_cache = co_artifacts.ArtifactCache(
+                os.path.join(CONF.instances_path, CONF.base_dir_name),
+                self.openstack_uid, self.openstack_gid)
 
     @_log_call
     def determine_openstack_user(self):
@@ -600,6 +1037,46 @@ class LibvirtConnection(VmsConnection):
                libvirt_conn._volume_in_mapping(libvirt_conn.default_second_device,
                                                     block_device_info)
 
+    def _ensure_image_base_path(self):
+        image_base_path = os.path.join(CONF.instances_path, CONF.base_dir_name)
+        if not os.path.exists(image_base_path):
+            LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
+            mkdir_as(image_base_path, self.openstack_uid)
+        return image_base_path
+
+    def fetch_artifacts(self, context, image_refs, migration=False,
+                        skip_image_service=False, concurrency=None):
+        if skip_image_service or not(CONF.cobalt_use_image_service):
+            return []
+
+        self._ensure_image_base_path()
+        # We need to first download the descriptor and the disk files
+        # from the image service.
+        LOG.debug("Downloading images %s from the image service." % (image_refs))
+
+        # The artifacts are pinned before the download so they cannot be
+        # evicted while we wait on a download started by another launch.
+        self.artifact_cache.pin(image_refs)
+
+        def _fetch_artifact(image_ref):
+            # NOTE: We always fetch in the case of a migration, as the
+            # descriptor may have changed from its previous state. Migrating
+            # VMs are the only case where a descriptor for an instance will
+            # not be a fixed constant.
+            self.artifact_downloads.do((image_ref, migration),
+                                       self.artifact_cache.fetch,
+                                       context, self.image_service,
+                                       image_ref, force=migration)
+        try:
+            # The artifacts of a live-image are downloaded concurrently.
+            co_common.run_concurrently(_fetch_artifact,
+                                       [(image_ref,) for image_ref in image_refs],
+                                       concurrency)
+        except:
+            self.artifact_cache.release(image_refs)
+            raise
+        return list(image_refs)
+
     @_log_call
     def pre_launch(self, context,
                    new_instance_ref,
@@ -610,44 +1087,13 @@ class LibvirtConnection(VmsConnection):
                    image_refs=[],
                    lvm_info={}):
 
-        image_base_path = os.path.join(CONF.instances_path, CONF.base_dir_name)
-        if not os.path.exists(image_base_path):
-            LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
-            mkdir_as(image_base_path, self.openstack_uid)
+        image_base_path = self._ensure_image_base_path()
 
         artifact_path = None
         if not(skip_image_service) and CONF.cobalt_use_image_service:
+            # The descriptor and the disk files have already been fetched
+            # from the image service by fetch_artifacts.
             artifact_path = image_base_path
-            # We need to first download the descriptor and the disk files
-            # from the image service.
-            LOG.debug("Downloading images %s from the image service." % (image_refs))
-
-            for image_ref in image_refs:
-                image = self.image_service.show(context, image_ref)
-                # In previous versions name was the filename (*.gc, *.disk) so
-                # there was no file_name property. Now that name is more descriptive
-                # when uploaded to glance, file_name property is set; use if possible
-                target = os.path.join(image_base_path,
-                                      image['properties'].get('file_name',image['name']))
-
-                if migration or not os.path.exists(target):
-                    # If the path does not exist fetch the data from the image
-                    # service.  NOTE: We always fetch in the case of a
-                    # migration, as the descriptor may have changed from its
-                    # previous state. Migrating VMs are the only case where a
-                    # descriptor for an instance will not be a fixed constant.
-                    # We download to a temporary location so we can make the
-                    # file appear atomically from the right user.
-                    fd, temp_target = tempfile.mkstemp(dir=image_base_path)
-                    try:
-                        os.close(fd)
-                        self.image_service.download(context, image_ref, temp_target)
-                        os.chown(temp_target, self.openstack_uid, self.openstack_gid)
-                        os.chmod(temp_target, 0644)
-                        os.rename(temp_target, target)
-                    except:
-                        os.unlink(temp_target)
-                        raise
 
         # (dscannell): Determine which libvirt_conn to use. If this is for
         #              migration, and there exists some lvm information, then
@@ -798,56 +1244,6 @@ class LibvirtConnection(VmsConnection):
             except OSError:
                 pass
 
-    def _create_image(self, context, image_service, instance_ref, image_name):
-        # Create the image in the image_service.
-        properties = {'instance_uuid': instance_ref['uuid'],
-                  'user_id': str(context.user_id),
-                  'image_state': 'creating'}
-
-        sent_meta = {'name': image_name, 'is_public': False,
-                     'status': 'creating', 'properties': properties}
-        recv_meta = image_service.create(context, sent_meta)
-        image_id = recv_meta['id']
-        return str(image_id)
-
-    def _upload_files(self, context, instance_ref, blessed_files,
-                      image_ids=None, vms_policy_template=None):
-        blessed_image_refs = []
-        descriptor_ref = None
-        other_images = []
-        for blessed_file in blessed_files:
-            image_name, image_id = self._friendly_upload(context, instance_ref, blessed_file)
-
-            if blessed_file.endswith(".gc"):
-                descriptor_ref = image_id
-            else:
-                other_images.append((image_name, image_id))
-            blessed_image_refs.append(image_id)
-
-        properties = self.image_service.show(context, descriptor_ref)['properties']
-        properties.update({'live_image': True,
-                           'image_state': 'available',
-                           'owner_id': instance_ref['project_id'],
-                           'live_image_source': instance_ref['name'],
-                           'instance_uuid': instance_ref['uuid'],
-                           'instance_type_id': instance_ref['instance_type_id']})
-        for image_name, image_id in other_images:
-            properties['live_image_data_%s' %(image_name)] = image_id
-        if vms_policy_template != None:
-            properties['vms_policy_template'] = vms_policy_template
-        self.image_service.update(context, descriptor_ref, {'properties': properties})
-        return blessed_image_refs
-
-    @_log_call
-    def _delete_images(self, context, image_refs):
-        for image_ref in image_refs:
-            try:
-                self.image_service.delete(context, image_ref)
-            except (exception.ImageNotFound, HTTPForbidden):
-                # Simply ignore this error because the end result
-                # is that the image is no longer there.
-                LOG.debug("The image %s was not found in the image service when removing it." % (image_ref))
-
     def get_hypervisor_hostname(self):
         # (dscannell): Any of the libvirt connection can be used. There is
         #              nothing special about the migration one.
@@ -0,0 +1,363 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A simulated vms backend. It accepts the same commands as vmsctl but only
+keeps track of the domains, blessed artifacts and memory servers it would
+have created, taking about as long as the real thing. Blessed artifacts are
+written as sparse files so that uploads, exports and imports move realistic
+amounts of data without using the disk space.
+
+This lets the cobalt-compute service run on a plain linux host (with nova's
+fake compute driver) for development and load testing.
+"""
+
+import json
+import os
+import random
+import shutil
+import tarfile
+import uuid
+
+from eventlet import greenthread
+
+from nova.compute import power_state
+from nova.openstack.common import log as logging
+from nova.openstack.common import processutils
+from nova.openstack.common.gettextutils import _
+from oslo.config import cfg
+
+from . import vmsapi as vms_api
+
+LOG = logging.getLogger('nova.cobalt.vmssim')
+CONF = cfg.CONF
+
+vmssim_opts = [
+               cfg.StrOpt('cobalt_sim_path',
+               default='$state_path/cobalt-sim',
+               help='The directory where the simulated vms backend writes '
+                    'its blessed artifacts.'),
+
+               cfg.IntOpt('cobalt_sim_memory_mb',
+               default=512,
+               help='The memory size of the simulated domains whose size is '
+                    'not known.'),
+
+               cfg.IntOpt('cobalt_sim_disk_mb',
+               default=1024,
+               help='The size of the (sparse) disk artifact written by each '
+                    'simulated bless.'),
+
+               cfg.FloatOpt('cobalt_sim_command_time',
+               default=0.05,
+               help='The number of seconds taken by every simulated vms '
+                    'command.'),
+
+               cfg.FloatOpt('cobalt_sim_bless_time_per_gb',
+               default=1.0,
+               help='The additional number of seconds a simulated bless '
+                    'takes per GB of memory.'),
+
+               cfg.FloatOpt('cobalt_sim_launch_time',
+               default=0.2,
+               help='The additional number of seconds taken by a simulated '
+                    'launch.'),
+
+               cfg.FloatOpt('cobalt_sim_launch_time_per_gb',
+               default=0.5,
+               help='The additional number of seconds a simulated launch '
+                    'takes per GB of memory.'),
+
+               cfg.FloatOpt('cobalt_sim_failure_rate',
+               default=0.0,
+               help='The probability (between 0 and 1) that a simulated vms '
+                    'command fails.'),
+
+               cfg.ListOpt('cobalt_sim_failing_commands',
+               default=[],
+               help='The vms commands (e.g. bless,launch) that can fail '
+                    'according to cobalt_sim_failure_rate. All of them can '
+                    'fail when empty.')]
+CONF.register_opts(vmssim_opts)
+
+# The simulator implements the commands of this version of vmsctl.
+VMS_VERSION = '2.7'
+
+MB = 1024 * 1024
+
+def _arg(args, index):
+    """ Returns the optional positional argument, or '' if it was not given. """
+    if index < len(args) and args[index] is not None:
+        return args[index]
+    return ''
+
+class SimulatedConfig(object):
+    """ The subset of the vms configuration used by cobalt. """
+
+    def __init__(self, shared):
+        self.SHARED = shared
+
+class SimulatedMemServer(object):
+    """ A memory server serving the memory of a blessed domain. """
+
+    def __init__(self, name, network):
+        self.name = name
+        self.network = network
+        self.pid = random.randint(1000, 65535)
+
+class SimulatedVms(vms_api.VmsDriver):
+    """
+    A VmsDriver that simulates the vmsctl commands instead of running them.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CONF.cobalt_sim_path
+        # Domain name -> power state of the domains started or paused here.
+        # Domains that the simulator knows nothing about (e.g. the ones booted
+        # by the compute driver) are assumed to be running.
+        self.domains = {}
+        # Domain name -> memory size in MB.
+        self.memory = {}
+        # Blessed name -> the paths of its artifacts.
+        self.blessed = {}
+        # Memory servers that have not been killed yet.
+        self.memservers = []
+        # The contents of the last installed policy.
+        self.policy = None
+        # Command -> the number of times it must fail next.
+        self.injected_failures = {}
+
+    def config(self):
+        return SimulatedConfig(self.path)
+
+    def set_memory(self, name, memory_mb):
+        """ Tells the simulator the memory size of a domain. """
+        if memory_mb:
+            self.memory[name] = int(memory_mb)
+
+    def inject_failure(self, command, count=1):
+        """ Makes the next count runs of the vms command fail. """
+        self.injected_failures[command] = \
+            self.injected_failures.get(command, 0) + count
+
+    def get_info(self, name):
+        return {'state': self.domains.get(name, power_state.RUNNING)}
+
+    def run_command(self, cmd_list):
+        LOG.debug(_('Simulating vms command %s'), cmd_list)
+
+        options = {}
+        index = 0
+        while index < len(cmd_list) and cmd_list[index] in ('-v', '-o'):
+            key, _sep, value = cmd_list[index + 1].partition('=')
+            options[key] = value
+            index += 2
+        command = cmd_list[index]
+        args = cmd_list[index + 1:]
+
+        handler = getattr(self, '_do_%s' % command, None)
+        if handler is None:
+            self._fail(cmd_list, _("unknown command %s") % command)
+
+        greenthread.sleep(CONF.cobalt_sim_command_time)
+        if self._should_fail(command):
+            self._fail(cmd_list, _("simulated failure of %s") % command)
+        return handler(cmd_list, args, options)
+
+    def _should_fail(self, command):
+        if self.injected_failures.get(command, 0) > 0:
+            self.injected_failures[command] -= 1
+            return True
+        if len(CONF.cobalt_sim_failing_commands) > 0 and \
+           command not in CONF.cobalt_sim_failing_commands:
+            return False
+        return random.random() < CONF.cobalt_sim_failure_rate
+
+    def _fail(self, cmd_list, message):
+        raise processutils.ProcessExecutionError(exit_code=1,
+                                                 stdout='',
+                                                 stderr=message,
+                                                 cmd=' '.join(
+                                                    [str(arg) for arg in cmd_list]))
+
+    def _memory_mb(self, *names):
+        for name in names:
+            if name in self.memory:
+                return self.memory[name]
+        return CONF.cobalt_sim_memory_mb
+
+    def _write_sparse(self, path, size):
+        with open(path, 'w') as f:
+            f.truncate(size)
+
+    def _write_artifacts(self, name, memory_mb, descriptor=None):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        descriptor_file = os.path.join(self.path, '%s.gc' % name)
+        memory_file = os.path.join(self.path, '%s.mem' % name)
+        disk_file = os.path.join(self.path, '%s.0.disk' % name)
+
+        with open(descriptor_file, 'w') as f:
+            json.dump(descriptor or {'name': name, 'memory_mb': memory_mb}, f)
+        self._write_sparse(memory_file, memory_mb * MB)
+        self._write_sparse(disk_file, CONF.cobalt_sim_disk_mb * MB)
+
+        return [descriptor_file, memory_file, disk_file]
+
+    def _remove_files(self, files):
+        for path in files:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _start_memserver(self, name, network):
+        memserver = SimulatedMemServer(name, network)
+        self.memservers.append(memserver)
+        LOG.debug(_("Started simulated memory server %s for %s at %s"),
+                  memserver.pid, name, network)
+        return memserver
+
+    def _kill_memservers(self, matches):
+        killed = [memserver for memserver in self.memservers
+                  if matches(memserver)]
+        for memserver in killed:
+            LOG.debug(_("Killed simulated memory server %s for %s"),
+                      memserver.pid, memserver.name)
+            self.memservers.remove(memserver)
+        return killed
+
+    def _do_bless(self, cmd_list, args, options):
+        # bless <name> <newname> [path] [disk_url] [mem_url] [migration]
+        name = args[0]
+        newname = args[1]
+        mem_url = _arg(args, 4)
+        migration = _arg(args, 5) == 'True'
+
+        memory_mb = self._memory_mb(newname, name)
+        self.memory[newname] = memory_mb
+        greenthread.sleep(CONF.cobalt_sim_bless_time_per_gb *
+                          memory_mb / 1024.0)
+
+        if migration:
+            # The memory of a migrating domain is served over the network
+            # instead of being written out.
+            network = mem_url or 'sim://%s/%s' % (newname, uuid.uuid4().hex)
+            blessed_files = []
+        else:
+            network = None
+            blessed_files = self._write_artifacts(newname, memory_mb)
+        self.blessed[newname] = blessed_files
+        self._start_memserver(newname, network)
+
+        artifacts = {'files': [{'path': path} for path in blessed_files],
+                     'logical_volumes': []}
+        return ['newname=%s' % newname,
+                'network=%s' % network,
+                'artifacts=%s' % json.dumps(artifacts).replace('"', "'")]
+
+    def _do_launch(self, cmd_list, args, options):
+        # launch <name> <newname> <path> [disk_url] [mem_url] [migration]
+        name = args[0]
+        newname = args[1]
+
+        memory_mb = self._memory_mb(newname, name)
+        self.memory[newname] = memory_mb
+        greenthread.sleep(CONF.cobalt_sim_launch_time +
+                          CONF.cobalt_sim_launch_time_per_gb *
+                          memory_mb / 1024.0)
+        self.domains[newname] = power_state.RUNNING
+        return ['newname=%s' % newname]
+
+    def _do_discard(self, cmd_list, args, options):
+        # discard <name> [path] [disk_url] [mem_url]
+        name = args[0]
+        mem_url = _arg(args, 3)
+
+        self._remove_files(self.blessed.pop(name, []))
+        self.domains.pop(name, None)
+        self._kill_memservers(lambda memserver: memserver.name == name or
+                              (mem_url and memserver.network and
+                               memserver.network in mem_url))
+        return []
+
+    def _do_kill_memservers(self, cmd_list, args, options):
+        # kill_memservers <url>
+        mem_url = args[0]
+        self._kill_memservers(lambda memserver: memserver.network and
+                              memserver.network in mem_url)
+        return []
+
+    def _do_pause(self, cmd_list, args, options):
+        self.domains[args[0]] = power_state.PAUSED
+        return []
+
+    def _do_unpause(self, cmd_list, args, options):
+        self.domains[args[0]] = power_state.RUNNING
+        return []
+
+    def _do_installpolicy(self, cmd_list, args, options):
+        with open(args[0]) as policy_file:
+            self.policy = policy_file.read()
+        return []
+
+    def _do_export(self, cmd_list, args, options):
+        # export <name> <archive> [path]
+        name = args[0]
+        archive = args[1]
+        blessed_files = self.blessed.get(name)
+        if not blessed_files:
+            self._fail(cmd_list, _("%s has no blessed artifacts") % name)
+
+        # TarFile is not a context manager before python 2.7.
+        tar = tarfile.open(archive, 'w')
+        try:
+            for path in blessed_files:
+                tar.add(path, arcname=os.path.basename(path))
+        finally:
+            tar.close()
+        return []
+
+    def _do_import(self, cmd_list, args, options):
+        # import <name> <archive>
+        name = args[0]
+        archive = args[1]
+
+        import_path = os.path.join(self.path, 'import-%s' % uuid.uuid4().hex)
+        os.makedirs(import_path)
+        try:
+            tar = tarfile.open(archive)
+            try:
+                members = [member for member in tar.getmembers()
+                           if member.isfile() and
+                              os.path.basename(member.name) == member.name]
+                tar.extractall(import_path, members)
+            finally:
+                tar.close()
+
+            # The artifacts are renamed after the imported instance.
+            artifacts = []
+            for member in members:
+                suffix = member.name[member.name.index('.'):] \
+                            if '.' in member.name else ''
+                artifact = os.path.join(self.path, name + suffix)
+                os.rename(os.path.join(import_path, member.name), artifact)
+                artifacts.append(artifact)
+                if artifact.endswith('.gc'):
+                    with open(artifact) as f:
+                        self.set_memory(name, json.load(f).get('memory_mb'))
+        finally:
+            shutil.rmtree(import_path)
+
+        self.blessed[name] = artifacts
+        return artifacts
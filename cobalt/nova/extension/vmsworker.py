@@ -0,0 +1,138 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A long-lived privileged worker that executes vmsctl commands on behalf of
+the cobalt-compute service.
+
+The worker is started once (through rootwrap) and then reads requests from
+its stdin and writes responses to its stdout. Each message is a frame made of
+a 4 byte big-endian length followed by that many bytes of JSON. Once started,
+the worker writes the READY frame before reading any request, so that the
+caller knows it is running before handing it a command. A request has the
+form {"cmd": [...]} and the response has the form
+{"exit_code": <int>, "stdout": <str>, "stderr": <str>}.
+
+NOTE: This module is executed as root and must not import anything from nova
+so that the worker starts quickly and does not need the nova configuration.
+"""
+
+import json
+import struct
+import subprocess
+import sys
+
+FRAME_HEADER = struct.Struct('>I')
+
+# Refuse any frame larger than this. It guards against reading garbage from a
+# broken pipe as an enormous length.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# The only executable the worker is allowed to run.
+ALLOWED_COMMAND = 'vmsctl'
+
+# The frame written by the worker once it has started.
+READY = {'ready': True}
+
+
+class FrameError(Exception):
+    pass
+
+
+def _read_exactly(stream, size):
+    data = ''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def write_frame(stream, message):
+    """ Writes the message (any json serializable object) as a frame. """
+    payload = json.dumps(message)
+    stream.write(FRAME_HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+
+def read_frame(stream):
+    """
+    Reads a single frame from the stream and returns the decoded message. None
+    is returned if the stream is closed before a new frame starts.
+    """
+    header = _read_exactly(stream, FRAME_HEADER.size)
+    if len(header) == 0:
+        return None
+    if len(header) != FRAME_HEADER.size:
+        raise FrameError("Truncated frame header")
+
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise FrameError("Frame of %d bytes is too large" % size)
+
+    payload = _read_exactly(stream, size)
+    if len(payload) != size:
+        raise FrameError("Truncated frame (%d of %d bytes)" % (len(payload), size))
+    return json.loads(payload)
+
+
+def handle_request(request):
+    cmd = request.get('cmd')
+    if not isinstance(cmd, list) or len(cmd) == 0 or cmd[0] != ALLOWED_COMMAND:
+        return {'exit_code': -1,
+                'stdout': '',
+                'stderr': 'Refusing to execute %r' % (cmd,)}
+
+    try:
+        process = subprocess.Popen([str(arg) for arg in cmd],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True)
+        (stdout, stderr) = process.communicate()
+    except OSError, e:
+        return {'exit_code': -1, 'stdout': '', 'stderr': str(e)}
+
+    return {'exit_code': process.returncode,
+            'stdout': stdout,
+            'stderr': stderr}
+
+
+def serve(instream, outstream):
+    """ Serves requests until the caller closes the input stream. """
+    write_frame(outstream, READY)
+    while True:
+        request = read_frame(instream)
+        if request is None:
+            return
+        write_frame(outstream, handle_request(request))
+
+
+def main():
+    # NOTE: Anything printed by accident would corrupt the framing on stdout,
+    # so we keep a private handle on it and point sys.stdout at stderr.
+    outstream = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        serve(sys.stdin, outstream)
+    except FrameError, e:
+        sys.stderr.write("cobalt-vmsctl-worker: %s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,14 +14,66 @@
 #    under the License.
 
 import errno
+import hashlib
 import os
 
+from eventlet import tpool
+from nova import exception
 from nova.image import glance
 from nova.openstack.common import log as logging
+from oslo.config import cfg
 
 from nova.openstack.common.gettextutils import _
 
+from . import common
+
 LOG = logging.getLogger('nova.cobalt.image')
+CONF = cfg.CONF
+
+image_opts = [
+               cfg.IntOpt('cobalt_download_concurrency',
+               default=4,
+               help='The number of artifacts that are downloaded from the '
+                    'image service at the same time.')]
+CONF.register_opts(image_opts)
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+class ImageChecksumMismatch(exception.NovaException):
+    message = _("Image %(image_id)s was downloaded with checksum %(actual)s "
+                "but %(expected)s was expected.")
+
+def file_checksum(path):
+    """
+    Returns the md5 hex digest (what glance reports) of the file. The file is
+    read and hashed in a native thread so that checksumming a large artifact
+    does not stall the other greenthreads.
+    """
+    return tpool.execute(_file_checksum, path)
+
+def _file_checksum(path):
+    checksum = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHECKSUM_CHUNK_SIZE)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+class ChecksumWriter(object):
+    """ A file wrapper that computes the checksum of what is written. """
+
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self.checksum = hashlib.md5()
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.image_file.write(data)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
 
 class ImageService(object):
 
@@ -32,10 +84,11 @@ class ImageService(object):
     def show(self, context, image_id):
         return self.image_service.show(context, image_id)
 
-    def create(self, context, name, instance_uuid=None):
+    def create(self, context, name, instance_uuid=None, properties=None):
         """ Creates a new image and returns its id """
-        properties = {'user_id': str(context.user_id),
-                      'image_state': 'creating'}
+        properties = dict(properties or {})
+        properties.update({'user_id': str(context.user_id),
+                           'image_state': 'creating'})
         if instance_uuid is not None:
             properties['instance_uuid'] = instance_uuid
 
@@ -44,17 +97,22 @@ class ImageService(object):
         image_ref = self.image_service.create(context, sent_meta)
         return image_ref['id']
 
-    def upload(self, context, image_id, content_path, is_protected=True):
-        """ Uploads the contents to the image id """
+    def upload(self, context, image_id, content_path, is_protected=True,
+               properties=None):
+        """
+        Uploads the contents to the image id. The image properties are
+        replaced by the given properties (if any) in the same request.
+        """
         # Send up the file data to the newly created image.
+        image_properties = {'image_state': 'available',
+                            'owner_id': context.project_id}
+        image_properties.update(properties or {})
         metadata = {'is_public': False,
                     'protected': is_protected,
                     'status': 'active',
                     'disk_format': 'raw',
                     'container_format': 'bare',
-                    'properties': {
-                        'image_state': 'available',
-                        'owner_id': context.project_id}
+                    'properties': image_properties
         }
 
         # Upload that image to the image service
@@ -78,10 +136,33 @@ class ImageService(object):
         LOG.debug(_("Updating image %s: %s" %(image_id, image)))
         self.image_service.update(context, image_id, image)
 
-    def download(self, context, image_id, location):
+    def update_properties(self, context, image_id, properties):
+        """
+        Sets the given properties of the image. Unlike update(), nothing read
+        earlier is written back, so the other properties cannot be reverted
+        by a concurrent update.
+        """
+        LOG.debug(_("Updating the properties of image %s: %s" %
+                    (image_id, properties)))
+        self.image_service.update(context, image_id,
+                                  {'properties': properties}, purge_props=False)
+
+    def find(self, context, filters):
+        """ Returns the images that match the given glance filters. """
+        return self.image_service.detail(context, filters=filters)
+
+    def download(self, context, image_id, location, checksum=None):
+        """
+        Downloads the image into location. If checksum is given the download
+        is verified against it as it is written.
+        """
         try:
             with open(location, "wb") as image_file:
-                metadata = self.image_service.download(context, image_id, image_file)
+                writer = ChecksumWriter(image_file)
+                metadata = self.image_service.download(context, image_id,
+                                                       writer)
+            if checksum is not None:
+                self._verify_checksum(image_id, checksum, writer.hexdigest())
         except Exception, exc:
             try:
                 os.unlink(location)
@@ -92,6 +173,21 @@ class ImageService(object):
             raise exc
         return metadata
 
+    def _verify_checksum(self, image_id, expected, actual):
+        if expected != actual:
+            raise ImageChecksumMismatch(image_id=image_id, actual=actual,
+                                        expected=expected)
+
+    def download_all(self, context, downloads):
+        """
+        Downloads several images concurrently. downloads is a list of
+        (image_id, location, checksum) tuples.
+        """
+        common.run_concurrently(lambda image_id, location, checksum:
+                                    self.download(context, image_id, location,
+                                                  checksum=checksum),
+                                downloads, CONF.cobalt_download_concurrency)
+
     def delete(self, context, image_id, is_protected=True):
         """ Deletes the image """
 
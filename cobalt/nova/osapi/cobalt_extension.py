@@ -30,12 +30,22 @@ import nova.api.openstack.common as common
 
 from nova.openstack.common.gettextutils import _
 
+import cobalt.nova.api as co_api
 from cobalt.nova.api import API
 
 LOG = logging.getLogger("nova.api.extensions.cobalt")
 
 authorizer = extensions.extension_authorizer('compute', 'cobalt')
 
+# The controllers share a single cobalt API.
+_cobalt_api = None
+
+def _get_cobalt_api():
+    global _cobalt_api
+    if _cobalt_api is None:
+        _cobalt_api = API()
+    return _cobalt_api
+
 def convert_exception(action):
 
     def fn(self, *args, **kwargs):
@@ -59,7 +69,7 @@ def authorize(f):
 class CobaltInfoController(object):
 
     def __init__(self):
-        self.cobalt_api = API()
+        self.cobalt_api = _get_cobalt_api()
 
     @convert_exception
     @authorize
@@ -68,6 +78,21 @@ class CobaltInfoController(object):
         return webob.Response(status_int=200,
             body=json.dumps(self.cobalt_api.get_info()))
 
+class CobaltMetricsController(object):
+
+    def __init__(self):
+        self.cobalt_api = _get_cobalt_api()
+
+    @convert_exception
+    @authorize
+    def index(self, req):
+        context = req.environ['nova.context']
+        if not context.is_admin:
+            raise exc.HTTPForbidden()
+        host = req.GET.get('host')
+        return webob.Response(status_int=200,
+            body=json.dumps(self.cobalt_api.get_metrics(context, host=host)))
+
 class CobaltServerControllerExtension(wsgi.Controller):
     """
     The OpenStack Extension definition for Cobalt capabilities. Currently this includes:
@@ -85,7 +110,7 @@ class CobaltServerControllerExtension(wsgi.Controller):
 
     def __init__(self):
         super(CobaltServerControllerExtension, self).__init__()
-        self.cobalt_api = API()
+        self.cobalt_api = _get_cobalt_api()
         # Add the gridcentric-specific states to the state map
         common._STATE_MAP['blessed'] = {'default': 'BLESSED'}
 
@@ -148,12 +173,39 @@ class CobaltServerControllerExtension(wsgi.Controller):
     def _dep_migrate_instance(self, req, id, body):
         return self._migrate_instance(req=req, id=id, body=body)
 
+    @wsgi.action('co_pool')
+    @convert_exception
+    @authorize
+    def _set_pool_size(self, req, id, body):
+        context = req.environ["nova.context"]
+        if not context.is_admin:
+            raise exc.HTTPForbidden()
+        params = body.get('co_pool', {})
+        self.cobalt_api.set_pool_size(context, id, params.get('size'),
+                                      host=params.get('host'))
+        return webob.Response(status_int=200)
+
+    @wsgi.action('co_lineage')
+    @convert_exception
+    @authorize
+    def _get_lineage(self, req, id, body):
+        context = req.environ["nova.context"]
+        params = body.get('co_lineage') or {}
+        result = self.cobalt_api.get_lineage(context, id,
+                                             depth=self._int_param(params, 'depth'),
+                                             fields=params.get('fields'))
+        return webob.Response(status_int=200, body=json.dumps(result))
+
     @wsgi.action('co_list_launched')
     @convert_exception
     @authorize
     def _list_launched_instances(self, req, id, body):
         context = req.environ["nova.context"]
-        return self._build_instance_list(req, self.cobalt_api.list_launched_instances(context, id))
+        params = body.get('co_list_launched', body.get('gc_list_launched')) or {}
+        return self._build_instance_list(req,
+                    self.cobalt_api.list_launched_instances(context, id,
+                                                limit=self._int_param(params, 'limit'),
+                                                marker=params.get('marker')))
 
     @wsgi.action('gc_list_launched')
     def _dep_list_launched_instances(self, req, id, body):
@@ -164,7 +216,11 @@ class CobaltServerControllerExtension(wsgi.Controller):
     @authorize
     def _list_blessed_instances(self, req, id, body):
         context = req.environ["nova.context"]
-        return self._build_instance_list(req, self.cobalt_api.list_blessed_instances(context, id))
+        params = body.get('co_list_blessed', body.get('gc_list_blessed')) or {}
+        return self._build_instance_list(req,
+                    self.cobalt_api.list_blessed_instances(context, id,
+                                                limit=self._int_param(params, 'limit'),
+                                                marker=params.get('marker')))
 
     @wsgi.action('gc_list_blessed')
     def _dep_list_blessed_instances(self, req, id, body):
@@ -206,6 +262,19 @@ class CobaltServerControllerExtension(wsgi.Controller):
         instances = self._view_builder.detail(req, instances)['servers']
         return webob.Response(status_int=200, body=json.dumps(instances))
 
+    def _int_param(self, params, name):
+        value = params.get(name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+            if value < 0:
+                raise ValueError()
+            return value
+        except (TypeError, ValueError):
+            raise exc.HTTPBadRequest(
+                explanation=_('%s must be a positive integer') % name)
+
     ## Utility methods taken from nova core ##
     def _handle_quota_error(self, error):
         """
@@ -235,7 +304,7 @@ class CobaltTargetBootController(object):
 
     def __init__(self):
         self.nova_servers = servers.Controller()
-        self.nova_servers.compute_api = API()
+        self.nova_servers.compute_api = _get_cobalt_api()
 
     @convert_exception
     def create(self, req, body):
@@ -244,13 +313,19 @@ class CobaltTargetBootController(object):
 class CobaltPolicyController(wsgi.Controller):
     def __init__(self):
         super(CobaltPolicyController, self).__init__()
-        self.gridcentric_api = API()
+        self.gridcentric_api = _get_cobalt_api()
 
     @convert_exception
     def create(self, req, body):
         context = req.environ["nova.context"]
-        self.gridcentric_api.install_policy(context,
-            body.get('policy_ini_string'), body.get('wait'))
+        try:
+            return self.gridcentric_api.install_policy(context,
+                body.get('policy_ini_string'), body.get('wait'),
+                force=body.get('force', False))
+        except co_api.PolicyInstallFailed, e:
+            # The report tells the caller which hosts have the policy.
+            return webob.Response(status_int=400, content_type='application/json',
+                body=json.dumps({'message': unicode(e), 'report': e.report}))
 
 class CobaltImportController(wsgi.Controller):
 
@@ -258,7 +333,7 @@ class CobaltImportController(wsgi.Controller):
 
     def __init__(self):
         super(CobaltImportController, self).__init__()
-        self.cobalt_api = API()
+        self.cobalt_api = _get_cobalt_api()
 
     @convert_exception
     @authorize
@@ -293,16 +368,22 @@ class Cobalt_extension(object):
 
     def __init__(self, ext_mgr):
         ext_mgr.register(self)
+        # The API processes correct the instances left in an invalid state
+        # and keep the pools of the live-images filled, in the background.
+        co_api.start_instance_fixup()
+        co_api.start_pool_refill(_get_cobalt_api())
 
     def get_resources(self):
 
         info_controller = CobaltInfoController()
+        metrics_controller = CobaltMetricsController()
         bootcontroller = CobaltTargetBootController()
         importcontroller = CobaltImportController()
         policycontroller = CobaltPolicyController()
         return [
             extensions.ResourceExtension('cobaltinfo', info_controller),
             extensions.ResourceExtension('gcinfo', info_controller),
+            extensions.ResourceExtension('cobaltmetrics', metrics_controller),
             extensions.ResourceExtension('coservers', bootcontroller),
             extensions.ResourceExtension('gcservers', bootcontroller),
             extensions.ResourceExtension('gc-import-server', importcontroller),
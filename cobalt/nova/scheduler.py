@@ -0,0 +1,54 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Scheduler extensions for cobalt launches.
+
+The cobalt API passes the hosts that already hold all of the artifacts of the
+live-image being launched in the request spec (as cobalt_cached_hosts).
+Launching on one of those hosts skips the artifact downloads. To favour them,
+add the weigher to nova's scheduler configuration:
+
+    scheduler_weight_classes=nova.scheduler.weights.all_weighers,
+                             cobalt.nova.scheduler.CachedArtifactsWeigher
+"""
+
+from nova.scheduler import weights
+from oslo.config import cfg
+
+CONF = cfg.CONF
+
+cobalt_scheduler_opts = [
+               cfg.FloatOpt('cobalt_cached_artifacts_weight_multiplier',
+               default=10240.0,
+               help='The weight given to the hosts that already hold the '
+                    'artifacts of the live-image being launched. The RAM '
+                    'weigher counts free memory in MB so, with the default '
+                    'ram_weight_multiplier, a host holding the artifacts is '
+                    'preferred over hosts with up to 10GB more free memory.')]
+CONF.register_opts(cobalt_scheduler_opts)
+
+class CachedArtifactsWeigher(weights.BaseHostWeigher):
+    """ Favours the hosts that hold the artifacts of the launched live-image. """
+
+    def _weight_multiplier(self):
+        return CONF.cobalt_cached_artifacts_weight_multiplier
+
+    def _weigh_object(self, host_state, weight_properties):
+        request_spec = weight_properties.get('request_spec') or {}
+        cached_hosts = request_spec.get('cobalt_cached_hosts') or []
+        if host_state.host in cached_hosts:
+            return 1.0
+        return 0.0
@@ -0,0 +1,408 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Throughput and latency benchmarks for the cobalt API and manager.
+
+The benchmarks run the real cobalt.nova.api.API and CobaltManager against
+the test database, with the vms connection, image service and rpc replaced
+by the test mocks. Each backend call is delayed by a configurable amount to
+stand in for the real vmsctl, glance, database and message bus. Casts to the
+cobalt topic are handled by the manager in a new greenthread, just like the
+real service would.
+
+    python -m cobalt.tests.benchmark --scale 50 --vms-latency 0.05 \\
+        --output results.json
+
+    python -m cobalt.tests.benchmark --baseline results.json
+
+The results (ops/sec, latency percentiles and the latency of every operation
+phase, including the lock waits, per scenario) are printed as json. When a baseline is
+given, the run fails if any scenario got slower than the baseline by more
+than the tolerance.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import time
+
+from eventlet import corolocal
+from eventlet import greenpool
+from eventlet import greenthread
+
+from nova import context as nova_context
+from nova import db
+from nova.compute import power_state
+from nova.compute import vm_states
+from nova.network import model as network_model
+from nova.openstack.common import rpc
+from oslo.config import cfg
+
+import cobalt.nova.api as co_api
+import cobalt.nova.dbapi as co_dbapi
+import cobalt.nova.extension.manager as co_manager
+import cobalt.nova.extension.metrics as metrics
+import cobalt.tests.utils as utils
+
+CONF = cfg.CONF
+
+DEST_HOST = 'benchmark-dest'
+
+class Latency(object):
+    """ The fake latency (in seconds) of each of the backends. """
+
+    def __init__(self, vms=0.0, glance=0.0, db=0.0, rpc=0.0):
+        self.vms = vms
+        self.glance = glance
+        self.db = db
+        self.rpc = rpc
+
+    def to_dict(self):
+        return {'vms': self.vms, 'glance': self.glance,
+                'db': self.db, 'rpc': self.rpc}
+
+class BenchmarkVmsConn(utils.MockVmsConn):
+    """
+    A MockVmsConn that succeeds every call after the vms latency instead of
+    returning preset values.
+    """
+
+    def __init__(self, latency):
+        super(BenchmarkVmsConn, self).__init__()
+        self.latency = latency
+
+    def pop_return_value(self, method):
+        greenthread.sleep(self.latency.vms)
+        if method == "post_bless":
+            # Uploading the blessed artifacts.
+            greenthread.sleep(self.latency.glance)
+            return ['image-%s' % utils.create_uuid()]
+        if method == "get_instance_info":
+            return {'state': power_state.RUNNING}
+        return None
+
+    def bless(self, *args, **kwargs):
+        self.pop_return_value("bless")
+        return ('blessed', kwargs.get('migration_url'), ['memory'], [])
+
+    def fetch_artifacts(self, context, image_refs, **kwargs):
+        greenthread.sleep(self.latency.glance)
+        return list(image_refs)
+
+class BenchmarkRpc(utils.MockRpc):
+    """
+    A MockRpc that delivers the messages for the cobalt topic to the manager.
+    Calls are handled in the calling greenthread and casts in a new one.
+    """
+
+    def __init__(self, manager, latency):
+        super(BenchmarkRpc, self).__init__()
+        self.manager = manager
+        self.latency = latency
+        self.local = corolocal.local()
+
+    def _dispatch(self, context, queue, params):
+        if queue != CONF.cobalt_topic and \
+           not queue.startswith('%s.' % CONF.cobalt_topic):
+            return None
+        return getattr(self.manager, params['method'])(context,
+                                                       **params['args'])
+
+    def _pending(self):
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            pending = []
+            self.local.pending = pending
+        return pending
+
+    def call(self, context, queue, params, timeout=None):
+        greenthread.sleep(self.latency.rpc)
+        super(BenchmarkRpc, self).call(context, queue, params, timeout=timeout)
+        return self._dispatch(context, queue, params)
+
+    def cast(self, context, queue, kwargs):
+        greenthread.sleep(self.latency.rpc)
+        super(BenchmarkRpc, self).cast(context, queue, kwargs)
+        self._pending().append(greenthread.spawn(self._dispatch, context,
+                                                 queue, kwargs))
+
+    def wait(self):
+        """ Waits for the casts made by this greenthread to be handled. """
+        pending = self._pending()
+        self.local.pending = []
+        for thread in pending:
+            thread.wait()
+
+class FakeNetworkApi(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_instance_nw_info(self, *args, **kwargs):
+        greenthread.sleep(self.latency.rpc)
+        return network_model.NetworkInfo()
+
+    def setup_networks_on_host(self, *args, **kwargs):
+        greenthread.sleep(self.latency.rpc)
+
+def _delayed(fn, latency):
+    def wrapped_fn(*args, **kwargs):
+        greenthread.sleep(latency)
+        return fn(*args, **kwargs)
+
+    wrapped_fn.__name__ = fn.__name__
+    wrapped_fn.__doc__ = fn.__doc__
+
+    return wrapped_fn
+
+class Benchmark(object):
+
+    def __init__(self, latency, concurrency=50):
+        self.latency = latency
+        self.concurrency = concurrency
+        self.context = nova_context.RequestContext('fake', 'fake', True)
+        self.patched = []
+
+    def _patch(self, obj, name, value):
+        self.patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def setUp(self):
+        CONF.compute_driver = 'fake.FakeDriver'
+        CONF.set_override('use_local', True, group='conductor')
+        utils.mock_policy()
+        utils.mock_quota()
+
+        # Every scenario starts with a clean database.
+        shutil.copyfile(os.path.join(CONF.state_path, CONF.sqlite_clean_db),
+                        os.path.join(CONF.state_path, CONF.sqlite_db))
+
+        self.vmsconn = BenchmarkVmsConn(self.latency)
+        self.manager = co_manager.CobaltManager(vmsconn=self.vmsconn)
+        self.manager._instance_network_info = utils.fake_networkinfo
+        self.manager.network_api = FakeNetworkApi(self.latency)
+        # Migrations only need an address to hand to the vms connection, and
+        # the benchmark instances have no volumes or floating ips.
+        self.manager._get_migration_address = lambda dest: '127.0.0.1'
+        self.manager._migrate_floating_ips = \
+            _delayed(utils.do_nothing, self.latency.rpc)
+        self.manager._detach_volumes = utils.do_nothing
+
+        self.rpc = BenchmarkRpc(self.manager, self.latency)
+        self._patch(rpc, 'call', self.rpc.call)
+        self._patch(rpc, 'cast', self.rpc.cast)
+        # The instance objects reach the database through nova.db, the bulk
+        # operations of the cobalt API and manager through cobalt.nova.dbapi.
+        for module, module_name in ((db, 'nova.db.api'),
+                                    (co_dbapi, 'cobalt.nova.dbapi')):
+            for name in dir(module):
+                fn = getattr(module, name)
+                if not name.startswith('_') and callable(fn) and \
+                   getattr(fn, '__module__', None) == module_name:
+                    self._patch(module, name, _delayed(fn, self.latency.db))
+
+        self.api = co_api.API(image_service=utils.mock_image_service())
+        utils.mock_scheduler_rpcapi(self.api.scheduler_rpcapi,
+                                    hosts=[self.manager.host])
+        db.service_create(self.context, {'host': DEST_HOST,
+                                         'binary': 'cobalt',
+                                         'topic': CONF.cobalt_topic})
+        metrics.REGISTRY.reset()
+
+    def tearDown(self):
+        while len(self.patched) > 0:
+            obj, name, value = self.patched.pop()
+            setattr(obj, name, value)
+
+    def _instance_values(self, **kwargs):
+        values = {'vm_state': vm_states.ACTIVE, 'host': self.manager.host}
+        values.update(kwargs)
+        return values
+
+    def run(self, operation, args_list):
+        """
+        Runs operation for each of the arguments concurrently and returns
+        its throughput and latency.
+        """
+        latencies = metrics.Histogram(max_samples=max(1, len(args_list)))
+        errors = [0]
+
+        def _run(args):
+            start = time.time()
+            try:
+                operation(*args)
+                self.rpc.wait()
+            except Exception:
+                errors[0] += 1
+            latencies.record(time.time() - start)
+
+        pool = greenpool.GreenPool(self.concurrency)
+        start = time.time()
+        for args in args_list:
+            pool.spawn_n(_run, args)
+        pool.waitall()
+        elapsed = time.time() - start
+
+        return {'operations': len(args_list),
+                'errors': errors[0],
+                'elapsed': elapsed,
+                'ops_per_sec': elapsed > 0 and len(args_list) / elapsed or 0.0,
+                'latency': latencies.summary(),
+                'phases': metrics.REGISTRY.summary()}
+
+    def concurrent_launch(self, scale):
+        """ Launches scale instances from one live-image, one request each. """
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                            self._instance_values(vm_state='blessed'))
+
+        def _launch():
+            self.api.launch_instance(self.context, blessed_uuid, params={})
+
+        return self.run(_launch, [()] * scale)
+
+    def bless_launch_fanout(self, scale, fanout=10):
+        """
+        Blesses scale instances and launches fanout instances from each of
+        the new live-images.
+        """
+        def _bless_and_launch(instance_uuid):
+            blessed = self.api.bless_instance(self.context, instance_uuid)
+            self.rpc.wait()
+            self.api.launch_instance(self.context, blessed['uuid'],
+                                     params={'num_instances': fanout})
+
+        instance_uuids = [utils.create_instance(self.context,
+                                                self._instance_values())
+                          for i in range(scale)]
+        return self.run(_bless_and_launch,
+                        [(instance_uuid,) for instance_uuid in instance_uuids])
+
+    def bulk_discard(self, scale):
+        """ Discards scale live-images at once. """
+        blessed_uuids = [utils.create_blessed_instance(self.context,
+                                self._instance_values(vm_state='blessed'))
+                         for i in range(scale)]
+
+        def _discard(blessed_uuid):
+            self.api.discard_instance(self.context, blessed_uuid)
+
+        return self.run(_discard, [(uuid,) for uuid in blessed_uuids])
+
+    def migration_storm(self, scale):
+        """ Migrates scale instances off this host at once. """
+        instance_uuids = [utils.create_pre_launched_instance(self.context,
+                                                    self._instance_values())
+                          for i in range(scale)]
+
+        def _migrate(instance_uuid):
+            self.api.migrate_instance(self.context, instance_uuid, DEST_HOST)
+
+        return self.run(_migrate, [(uuid,) for uuid in instance_uuids])
+
+SCENARIOS = ['concurrent_launch', 'bless_launch_fanout', 'bulk_discard',
+             'migration_storm']
+
+def run_scenarios(latency, scale, scenarios=None, concurrency=50):
+    results = {}
+    for scenario in scenarios or SCENARIOS:
+        benchmark = Benchmark(latency, concurrency=concurrency)
+        benchmark.setUp()
+        try:
+            results[scenario] = getattr(benchmark, scenario)(scale)
+        finally:
+            benchmark.tearDown()
+    return {'config': {'scale': scale,
+                       'concurrency': concurrency,
+                       'latency': latency.to_dict()},
+            'scenarios': results}
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Returns a description of every scenario whose throughput or tail latency
+    is worse than in the baseline by more than the tolerance (a fraction).
+    """
+    regressions = []
+    for scenario, result in results['scenarios'].iteritems():
+        base = baseline.get('scenarios', {}).get(scenario)
+        if base is None:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append("%s: %.2f ops/sec, baseline %.2f" %
+                    (scenario, result['ops_per_sec'], base['ops_per_sec']))
+        if result['latency']['p99'] > base['latency']['p99'] * (1 + tolerance):
+            regressions.append("%s: p99 latency %.3fs, baseline %.3fs" %
+                    (scenario, result['latency']['p99'], base['latency']['p99']))
+    return regressions
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] [scenario ...]")
+    parser.add_option('--scale', type='int', default=20,
+                      help='The number of operations per scenario.')
+    parser.add_option('--concurrency', type='int', default=50,
+                      help='The number of operations run at the same time.')
+    parser.add_option('--vms-latency', type='float', default=0.0,
+                      help='The latency (in seconds) of each vms call.')
+    parser.add_option('--glance-latency', type='float', default=0.0,
+                      help='The latency (in seconds) of each image transfer.')
+    parser.add_option('--db-latency', type='float', default=0.0,
+                      help='The latency (in seconds) of each database call.')
+    parser.add_option('--rpc-latency', type='float', default=0.0,
+                      help='The latency (in seconds) of each rpc message.')
+    parser.add_option('--output', default=None,
+                      help='Write the results to this file.')
+    parser.add_option('--baseline', default=None,
+                      help='Compare the results with this earlier output.')
+    parser.add_option('--tolerance', type='float', default=0.1,
+                      help='The slowdown (a fraction) allowed by --baseline.')
+    (options, scenarios) = parser.parse_args(argv)
+
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario %s (one of %s)" %
+                         (scenario, ', '.join(SCENARIOS)))
+
+    latency = Latency(vms=options.vms_latency, glance=options.glance_latency,
+                      db=options.db_latency, rpc=options.rpc_latency)
+
+    import cobalt.tests
+    cobalt.tests.setup()
+    try:
+        results = run_scenarios(latency, options.scale, scenarios=scenarios,
+                                concurrency=options.concurrency)
+    finally:
+        cobalt.tests.teardown()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print output
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, tolerance=options.tolerance)
+        for regression in regressions:
+            sys.stderr.write("REGRESSION %s\n" % regression)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
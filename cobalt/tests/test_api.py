@@ -27,6 +27,7 @@ from nova.db.sqlalchemy import api as sqlalchemy_db
 from oslo.config import cfg
 
 import cobalt.nova.api as gc_api
+from cobalt.nova import dbapi
 from cobalt.nova import image
 import cobalt.tests.utils as utils
 import base64
@@ -56,6 +57,34 @@ class CobaltApiTestCase(unittest.TestCase):
         self.context = nova_context.RequestContext('fake', 'fake', True)
         self.cobalt_service = utils.create_cobalt_service(self.context)
 
+    def test_fixup_instances(self):
+        no_state_uuid = utils.create_instance(self.context,
+                                              {'power_state': None})
+        blessing_uuids = [utils.create_instance(self.context,
+                                                {'task_state': 'blessing',
+                                                 'disable_terminate': True})
+                          for i in range(3)]
+        running_uuid = utils.create_instance(self.context,
+                                             {'power_state': power_state.RUNNING})
+
+        # The rows are updated a batch at a time.
+        self.assertEquals(3, dbapi.instance_update_all_matching(self.context,
+                                        {'vm_state': vm_states.ACTIVE,
+                                         'task_state': 'blessing'},
+                                        {'disable_terminate': False,
+                                         'task_state': None},
+                                        batch_size=2))
+        for instance_uuid in blessing_uuids:
+            instance = db.instance_get_by_uuid(self.context, instance_uuid)
+            self.assertEquals(None, instance['task_state'])
+            self.assertFalse(instance['disable_terminate'])
+
+        gc_api.fixup_instances(self.context)
+        self.assertEquals(power_state.NOSTATE,
+            db.instance_get_by_uuid(self.context, no_state_uuid)['power_state'])
+        self.assertEquals(power_state.RUNNING,
+            db.instance_get_by_uuid(self.context, running_uuid)['power_state'])
+
     def test_copy_instance(self):
         instance_uuid = utils.create_instance(self.context)
         original_instance = db.instance_get_by_uuid(self.context, instance_uuid)
@@ -143,6 +172,37 @@ class CobaltApiTestCase(unittest.TestCase):
 
         _assertSimilarBlockDeviceMapping(original_instance, copy_instance)
 
+    def test_copy_instances(self):
+        instance_uuid = utils.create_instance(self.context)
+        utils.add_block_dev(self.context, instance_uuid, 'vda')
+        utils.add_block_dev(self.context, instance_uuid, 'vdb')
+        original_instance = db.instance_get_by_uuid(self.context, instance_uuid)
+
+        copies = self.cobalt_api._copy_instances(self.context, original_instance,
+                                                 'copy_instance', 3, launch=True,
+                                                 security_groups=['default'])
+
+        self.assertEquals([0, 1, 2], [copy['launch_index'] for copy in copies])
+        self.assertEquals(3, len(set([copy['uuid'] for copy in copies])))
+        for copy in copies:
+            self.assertEquals(original_instance['info_cache']['network_info'],
+                              copy['info_cache']['network_info'])
+            self.assertEquals({'launched_from': instance_uuid},
+                              db.instance_metadata_get(self.context,
+                                                       copy['uuid']))
+            self.assertEquals(instance_uuid,
+                    db.instance_system_metadata_get(self.context,
+                                        copy['uuid'])['launched_from'])
+            self.assertEquals(['default'],
+                              [group['name'] for group in
+                               copy['security_groups']])
+            # The copies have an ec2 id, like any other instance.
+            db.get_ec2_instance_id_by_uuid(self.context, copy['uuid'])
+            bdms = db.block_device_mapping_get_all_by_instance(self.context,
+                                                               copy['uuid'])
+            self.assertEquals(['vda', 'vdb'],
+                              sorted([bdm['device_name'] for bdm in bdms]))
+
     def test_bless_instance(self):
         instance_uuid = utils.create_instance(self.context)
 
@@ -177,6 +237,33 @@ class CobaltApiTestCase(unittest.TestCase):
         self.assertTrue(db_blessed_instance['info_cache'])
         self.assertIsNotNone(db_blessed_instance['info_cache']['network_info'])
 
+    def test_bless_instance_prefetch_hosts(self):
+        hosts = [utils.create_cobalt_service(self.context)['host']
+                 for i in range(3)]
+        az = utils.create_availability_zone(self.context, hosts[:2])
+        try:
+            CONF.set_override('cobalt_prefetch_hosts', 'zone:%s' % az)
+            self.assertEquals(set(hosts[:2]), set(
+                self.cobalt_api._select_prefetch_hosts(self.context, hosts[2])))
+            CONF.set_override('cobalt_prefetch_hosts', 'aggregate:%s' % az)
+            self.assertEquals(set(hosts[1:2]), set(
+                self.cobalt_api._select_prefetch_hosts(self.context, hosts[0])))
+            # A malformed selector is ignored.
+            CONF.set_override('cobalt_prefetch_hosts', 'top:many')
+            self.assertEquals([], self.cobalt_api._select_prefetch_hosts(
+                                                    self.context, hosts[0]))
+
+            # The selected hosts are passed to the bless.
+            CONF.set_override('cobalt_prefetch_hosts', 'zone:%s' % az)
+            instance_uuid = utils.create_instance(self.context)
+            self.mock_rpc.reset()
+            self.cobalt_api.bless_instance(self.context, instance_uuid)
+            casts = self.mock_rpc.cast_log['bless_instance'].values()[0]
+            self.assertEquals(set(hosts[:2]),
+                              set(casts.values()[0][0]['args']['prefetch_hosts']))
+        finally:
+            CONF.clear_override('cobalt_prefetch_hosts')
+
     def test_bless_instance_with_name(self):
         instance_uuid = utils.create_instance(self.context)
         blessed_instance = self.cobalt_api.bless_instance(self.context,
@@ -202,6 +289,23 @@ class CobaltApiTestCase(unittest.TestCase):
         self.assertTrue(len(instances) == num_instance_before + 2,
                         "There should be 2 more instances because we blessed twice.")
 
+    def test_bless_instance_clone_num(self):
+        instance_uuid = utils.create_instance(self.context,
+                                              {'display_name': 'foo'})
+        db.instance_metadata_update(self.context, instance_uuid,
+                                    {'owner': 'bar'}, False)
+        first = self.cobalt_api.bless_instance(self.context, instance_uuid)
+        self.assertEqual('foo-0', first['display_name'])
+
+        self.assertEqual(1, dbapi.instance_metadata_counter_allocate(
+                            self.context, instance_uuid, 'last_clone_num', 3))
+        second = self.cobalt_api.bless_instance(self.context, instance_uuid)
+        self.assertEqual('foo-4', second['display_name'])
+
+        # Only the counter is updated, the rest of the metadata is untouched.
+        metadata = db.instance_metadata_get(self.context, instance_uuid)
+        self.assertEqual({'owner': 'bar', 'last_clone_num': '4'}, metadata)
+
     def test_bless_nonexisting_instance(self):
         try:
             self.cobalt_api.bless_instance(self.context, 1500)
@@ -339,6 +443,27 @@ class CobaltApiTestCase(unittest.TestCase):
         self.assertEqual(pre_usages['cores'].get('in_use',0) - instance['vcpus'],
                          post_usages['cores'].get('in_use',0))
 
+    def test_discard_drains_pool(self):
+        host = self.cobalt_service['host']
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '3',
+                                          gc_api.POOL_HOST_KEY: host}})
+        # The clones still launching and the ones that failed to are
+        # deleted with the pool as well.
+        pooled_uuids = []
+        for task_state in [gc_api.POOLED, gc_api.POOL_SPAWNING, None]:
+            pooled_uuids.append(utils.create_launched_instance(self.context,
+                instance={'task_state': task_state,
+                          'system_metadata': {gc_api.POOL_HOST_KEY: host}},
+                source_uuid=blessed_uuid))
+            db.instance_update(self.context, pooled_uuids[-1], {'host': host})
+
+        self.cobalt_api.discard_instance(self.context, blessed_uuid)
+
+        for pooled_uuid in pooled_uuids:
+            self.assertEquals(task_states.DELETING, db.instance_get_by_uuid(
+                                self.context, pooled_uuid)['task_state'])
+
     def test_discard_a_blessed_instance_with_remaining_launched_ones(self):
 
         instance_uuid = utils.create_instance(self.context)
@@ -380,6 +505,226 @@ class CobaltApiTestCase(unittest.TestCase):
             "The instance should have the 'launched from' system_metadata set to blessed instanced id after being launched. "\
             + "(value=%s)" % (system_metadata['launched_from']))
 
+    def test_launch_instance_cached_hosts(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {'cobalt_cached_on:host1': '1',
+                                          'cobalt_cached_on:host2': '0',
+                                          'cobalt_cached_on:host3': '1'}})
+        request_specs = []
+        select_hosts = self.cobalt_api.scheduler_rpcapi.select_hosts
+        def mock_select_hosts(context, request_spec, filter_properties):
+            request_specs.append(request_spec)
+            return select_hosts(context, request_spec, filter_properties)
+        self.cobalt_api.scheduler_rpcapi.select_hosts = mock_select_hosts
+
+        self.cobalt_api.launch_instance(self.context, blessed_uuid)
+
+        self.assertEquals(['host1', 'host3'],
+                          request_specs[0]['cobalt_cached_hosts'])
+
+    def test_launch_instance_claims_pooled_instance(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '1',
+                                          gc_api.POOL_HOST_KEY: 'host1'}})
+        pooled_uuid = utils.create_launched_instance(self.context,
+            instance={'host': 'host1',
+                      'vm_state': vm_states.PAUSED,
+                      'task_state': gc_api.POOLED,
+                      'system_metadata': {gc_api.POOL_HOST_KEY: 'host1'}},
+            source_uuid=blessed_uuid)
+
+        # Parameters left unset do not keep the launch from using the pool.
+        launched_instance = self.cobalt_api.launch_instance(self.context,
+                                blessed_uuid, params={'name': 'claimed',
+                                                      'user_data': None})
+        self.assertEquals(pooled_uuid, launched_instance['uuid'])
+        self.assertEquals('claimed', launched_instance['display_name'])
+        self.assertEquals(task_states.SPAWNING, launched_instance['task_state'])
+        self.assertFalse(gc_api.POOL_HOST_KEY in
+            db.instance_system_metadata_get(self.context, pooled_uuid))
+        self.assertTrue(pooled_uuid in
+            self.mock_rpc.cast_log['claim_pooled_instance']['cobalt.host1'])
+        # The API creates the replacement clone in the background and the pool
+        # host launches it.
+        gc_api._pool_refills[blessed_uuid].wait()
+        refill_uuids = self.mock_rpc.cast_log['launch_pooled_instance']\
+                                             ['cobalt.host1'].keys()
+        self.assertEquals(1, len(refill_uuids))
+        refill = db.instance_get_by_uuid(self.context, refill_uuids[0])
+        self.assertEquals('host1', refill['host'])
+        self.assertEquals(self.context.user_id, refill['user_id'])
+
+        # Once the pool is empty the instances are launched from scratch.
+        launched_instance = self.cobalt_api.launch_instance(self.context,
+                                                            blessed_uuid)
+        self.assertNotEquals(pooled_uuid, launched_instance['uuid'])
+        self.assertTrue(launched_instance['uuid'] in
+            self.mock_rpc.cast_log['launch_instance'].values()[0])
+
+        # The pool is not used when launching with other parameters.
+        db.instance_update(self.context, pooled_uuid,
+                           {'task_state': gc_api.POOLED})
+        launched_instance = self.cobalt_api.launch_instance(self.context,
+                                blessed_uuid, params={'target': '1G'})
+        self.assertNotEquals(pooled_uuid, launched_instance['uuid'])
+        # The guest of a pooled clone has already booted, so it cannot get
+        # the user data or key of the launch.
+        launched_instance = self.cobalt_api.launch_instance(self.context,
+                                blessed_uuid, params={'user_data': 'data'})
+        self.assertNotEquals(pooled_uuid, launched_instance['uuid'])
+
+    def test_launch_instance_claims_only_own_pooled_instances(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '1',
+                                          gc_api.POOL_HOST_KEY: 'host1'}})
+        pooled_uuid = utils.create_launched_instance(self.context,
+            instance={'host': 'host1',
+                      'user_id': 'other-user',
+                      'vm_state': vm_states.PAUSED,
+                      'task_state': gc_api.POOLED},
+            source_uuid=blessed_uuid)
+
+        # The clone counts against the quota of its owner, so another user of
+        # the project launches from scratch.
+        launched_instance = self.cobalt_api.launch_instance(self.context,
+                                                            blessed_uuid)
+        self.assertNotEquals(pooled_uuid, launched_instance['uuid'])
+        pooled = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(gc_api.POOLED, pooled['task_state'])
+
+    def test_launch_instance_returns_claimed_instances_on_failure(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '1',
+                                          gc_api.POOL_HOST_KEY: 'host1'}})
+        pooled_uuid = utils.create_launched_instance(self.context,
+            instance={'host': 'host1',
+                      'display_name': 'pooled',
+                      'vm_state': vm_states.PAUSED,
+                      'task_state': gc_api.POOLED,
+                      'system_metadata': {gc_api.POOL_HOST_KEY: 'host1'}},
+            source_uuid=blessed_uuid)
+        def over_quota(*args, **kwargs):
+            raise exception.TooManyInstances(overs='instances', req=1,
+                                             used=1, allowed=1,
+                                             resource='instances')
+        self.cobalt_api._acquire_addition_reservation = over_quota
+
+        self.assertRaises(exception.TooManyInstances,
+                          self.cobalt_api.launch_instance, self.context,
+                          blessed_uuid, params={'name': 'claimed',
+                                                'num_instances': 2})
+        # The clone is back in the pool, as it was, and was not handed over.
+        pooled = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(gc_api.POOLED, pooled['task_state'])
+        self.assertEquals('pooled', pooled['display_name'])
+        self.assertEquals('host1', db.instance_system_metadata_get(
+                            self.context, pooled_uuid)[gc_api.POOL_HOST_KEY])
+        self.assertFalse('claim_pooled_instance' in self.mock_rpc.cast_log)
+
+    def test_launch_instance_does_not_copy_pool_keys(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '0',
+                                          gc_api.POOL_HOST_KEY: 'host1',
+                                          gc_api.CACHED_ARTIFACTS_KEY % 'host1': '1'}})
+        launched_uuid = self.cobalt_api.launch_instance(self.context,
+                                                        blessed_uuid)['uuid']
+
+        system_metadata = db.instance_system_metadata_get(self.context,
+                                                          launched_uuid)
+        self.assertEquals(blessed_uuid, system_metadata['launched_from'])
+        for key in (gc_api.POOL_SIZE_KEY, gc_api.POOL_HOST_KEY,
+                    gc_api.CACHED_ARTIFACTS_KEY % 'host1'):
+            self.assertFalse(key in system_metadata)
+
+    def test_set_pool_size(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        host = self.cobalt_service['host']
+        self.cobalt_api.set_pool_size(self.context, blessed_uuid, 2, host=host)
+
+        system_metadata = db.instance_system_metadata_get(self.context,
+                                                          blessed_uuid)
+        self.assertEquals('2', system_metadata[gc_api.POOL_SIZE_KEY])
+        self.assertEquals(host, system_metadata[gc_api.POOL_HOST_KEY])
+        # The clones are created by the API and launched by the pool host.
+        pooled_uuids = self.mock_rpc.cast_log['launch_pooled_instance']\
+                                             ['cobalt.%s' % host].keys()
+        self.assertEquals(2, len(pooled_uuids))
+        for pooled_uuid in pooled_uuids:
+            pooled = db.instance_get_by_uuid(self.context, pooled_uuid)
+            self.assertEquals(host, pooled['host'])
+            self.assertEquals(blessed_uuid, db.instance_system_metadata_get(
+                                self.context, pooled_uuid)['launched_from'])
+
+        # The clones still launching count towards the pool.
+        self.mock_rpc.reset()
+        self.cobalt_api.set_pool_size(self.context, blessed_uuid, 2, host=host)
+        self.assertFalse('launch_pooled_instance' in self.mock_rpc.cast_log)
+
+        # The clones that failed to launch are replaced, the other launches
+        # on the pool host are not part of the pool.
+        db.instance_update(self.context, pooled_uuids[0],
+                           {'vm_state': vm_states.ERROR})
+        utils.create_pre_launched_instance(self.context,
+            instance={'host': host, 'vm_state': vm_states.BUILDING},
+            source_uuid=blessed_uuid)
+        self.cobalt_api.refill_pools(self.context)
+        self.assertEquals(task_states.DELETING, db.instance_get_by_uuid(
+                            self.context, pooled_uuids[0])['task_state'])
+        self.assertEquals(1, len(self.mock_rpc.cast_log['launch_pooled_instance']\
+                                                       ['cobalt.%s' % host]))
+
+        self.assertRaises(exception.NovaException,
+                          self.cobalt_api.set_pool_size, self.context,
+                          blessed_uuid, -1, host=host)
+        self.assertRaises(exception.NovaException,
+                          self.cobalt_api.set_pool_size, self.context,
+                          blessed_uuid, 1, host='not-a-cobalt-host')
+
+    def test_refill_pool_holds_lease(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata': {gc_api.POOL_SIZE_KEY: '2',
+                                          gc_api.POOL_HOST_KEY: 'host1'}})
+
+        # The pool is left to the refill of another process while it holds
+        # the lease.
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                            blessed_uuid, gc_api.POOL_REFILL_KEY, 'other', 60))
+        self.cobalt_api.refill_pools(self.context)
+        self.assertFalse('launch_pooled_instance' in self.mock_rpc.cast_log)
+
+        # Once released (or expired) the lease can be taken again.
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                            blessed_uuid, gc_api.POOL_REFILL_KEY, 'other', 0))
+        self.cobalt_api.refill_pools(self.context)
+        self.assertEquals(2, len(self.mock_rpc.cast_log['launch_pooled_instance']\
+                                                       ['cobalt.host1']))
+        # The refill released its lease, and the lease is not copied to the
+        # clones.
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                            blessed_uuid, gc_api.POOL_REFILL_KEY, 'other', 60))
+        for pooled_uuid in self.mock_rpc.cast_log['launch_pooled_instance']\
+                                                 ['cobalt.host1']:
+            self.assertFalse(gc_api.POOL_REFILL_KEY in
+                db.instance_system_metadata_get(self.context, pooled_uuid))
+
+    def test_instance_system_metadata_lease(self):
+        instance_uuid = utils.create_instance(self.context)
+        key = gc_api.POOL_REFILL_KEY
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'first', 60))
+        # The holder renews its lease, the others cannot take it.
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'first', 60))
+        self.assertFalse(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'second', 60))
+        # An expired lease is taken over.
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'first', -1))
+        self.assertTrue(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'second', 60))
+        self.assertFalse(dbapi.instance_system_metadata_lease(self.context,
+                                            instance_uuid, key, 'first', 60))
+
     def test_launch_instance_with_volume(self):
         instance_uuid = utils.create_instance(self.context)
         utils.add_block_dev(self.context, instance_uuid, 'vbd')
@@ -516,6 +861,126 @@ class CobaltApiTestCase(unittest.TestCase):
         except exception.InstanceNotFound:
             pass
 
+    def test_list_launched_pagination(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuids = [utils.create_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid)
+                          for i in range(5)]
+
+        page = self.cobalt_api.list_launched_instances(self.context,
+                                                       blessed_uuid, limit=2)
+        self.assertEquals(launched_uuids[:2], [i['uuid'] for i in page])
+        page = self.cobalt_api.list_launched_instances(self.context,
+                                    blessed_uuid, limit=2, marker=page[-1]['uuid'])
+        self.assertEquals(launched_uuids[2:4], [i['uuid'] for i in page])
+        page = self.cobalt_api.list_launched_instances(self.context,
+                                    blessed_uuid, marker=page[-1]['uuid'])
+        self.assertEquals(launched_uuids[4:], [i['uuid'] for i in page])
+        self.assertRaises(exception.MarkerNotFound,
+                          self.cobalt_api.list_launched_instances,
+                          self.context, blessed_uuid,
+                          marker=utils.create_uuid())
+
+        # The clones of the pool do not count, whatever their state.
+        db.instance_system_metadata_update(self.context, launched_uuids[0],
+                                           {gc_api.POOL_HOST_KEY: 'host1'},
+                                           False)
+        self.assertEquals(5, self.cobalt_api.count_launched_instances(
+                                                self.context, blessed_uuid))
+        self.assertEquals(4, self.cobalt_api.count_launched_instances(
+                                self.context, blessed_uuid, include_pooled=False))
+        self.assertEquals(0, self.cobalt_api.count_launched_instances(
+                                self.context, utils.create_uuid()))
+
+    def test_ensure_lineage_index(self):
+        dbapi.ensure_lineage_index()
+        # Once the index exists it is found and not created again.
+        self.assertFalse(dbapi.ensure_lineage_index())
+
+    def test_get_lineage(self):
+        source_uuid = utils.create_instance(self.context)
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                                                     source_uuid=source_uuid)
+        launched_uuids = [utils.create_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid)
+                          for i in range(2)]
+        reblessed_uuid = utils.create_blessed_instance(self.context,
+                                                source_uuid=launched_uuids[0])
+
+        lineage = self.cobalt_api.get_lineage(self.context, launched_uuids[0])
+        self.assertEquals([source_uuid, blessed_uuid],
+                          [node['uuid'] for node in lineage['ancestors']])
+        self.assertEquals([None, 'blessed_from'],
+                          [node['relation'] for node in lineage['ancestors']])
+        tree = lineage['instance']
+        self.assertEquals('launched_from', tree['relation'])
+        self.assertEquals([reblessed_uuid],
+                          [node['uuid'] for node in tree['children']])
+        self.assertEquals('blessed', tree['children'][0]['vm_state'])
+
+        lineage = self.cobalt_api.get_lineage(self.context, source_uuid,
+                                              fields=['host'])
+        self.assertEquals([], lineage['ancestors'])
+        blessed = lineage['instance']['children'][0]
+        self.assertEquals(blessed_uuid, blessed['uuid'])
+        self.assertEquals(launched_uuids,
+                          [node['uuid'] for node in blessed['children']])
+        self.assertEquals('TEST_HOST', blessed['children'][0]['host'])
+        self.assertFalse('vm_state' in blessed['children'][0])
+        self.assertEquals(reblessed_uuid,
+                          blessed['children'][0]['children'][0]['uuid'])
+
+        lineage = self.cobalt_api.get_lineage(self.context, source_uuid, depth=1)
+        self.assertFalse('children' in lineage['instance']['children'][0])
+
+        self.assertRaises(exception.NovaException, self.cobalt_api.get_lineage,
+                          self.context, source_uuid, fields=['uuid; drop'])
+        self.assertRaises(exception.NovaException, self.cobalt_api.get_lineage,
+                          self.context, source_uuid, depth=-1)
+
+    def test_get_lineage_long_ancestry(self):
+        # More generations than are read by a single query.
+        uuids = [utils.create_instance(self.context)]
+        relations = [None]
+        for i in range(2 * dbapi.ANCESTOR_LEVELS + 1):
+            if i % 2 == 0:
+                uuids.append(utils.create_blessed_instance(self.context,
+                                                    source_uuid=uuids[-1]))
+                relations.append('blessed_from')
+            else:
+                uuids.append(utils.create_launched_instance(self.context,
+                                                    source_uuid=uuids[-1]))
+                relations.append('launched_from')
+
+        lineage = self.cobalt_api.get_lineage(self.context, uuids[-1])
+        self.assertEquals(uuids[:-1],
+                          [node['uuid'] for node in lineage['ancestors']])
+        self.assertEquals(relations[:-1],
+                          [node['relation'] for node in lineage['ancestors']])
+        self.assertEquals(relations[-1], lineage['instance']['relation'])
+
+    def test_get_lineage_hides_other_projects(self):
+        source_uuid = utils.create_instance(self.context,
+                                            {'project_id': 'other'})
+        blessed_uuid = utils.create_blessed_instance(self.context,
+                            instance={'project_id': 'other'},
+                            source_uuid=source_uuid)
+        launched_uuid = utils.create_launched_instance(self.context,
+                                                       source_uuid=blessed_uuid)
+
+        self.assertEquals([('launched_from', blessed_uuid),
+                           ('blessed_from', source_uuid)],
+                          dbapi.instance_ancestors(self.context, launched_uuid))
+        # The ancestry stops at the live-image of the other project.
+        user_context = nova_context.RequestContext('fake', 'fake')
+        self.assertEquals([], dbapi.instance_ancestors(user_context,
+                                                       launched_uuid))
+
+        # And at a deleted ancestor.
+        db.instance_destroy(self.context, source_uuid)
+        self.assertEquals([('launched_from', blessed_uuid)],
+                          dbapi.instance_ancestors(self.context, launched_uuid))
+
     def test_migrate_instance_with_destination(self):
         instance_uuid = utils.create_instance(self.context, {"vm_state":vm_states.ACTIVE})
         gc_service = utils.create_cobalt_service(self.context)
@@ -583,6 +1048,70 @@ class CobaltApiTestCase(unittest.TestCase):
         except exception.NovaException:
             pass
 
+    def test_instance_class_cache(self):
+        instance_uuid = utils.create_instance(self.context)
+        blessed_uuid = self.cobalt_api.bless_instance(self.context,
+                                                      instance_uuid)['uuid']
+        launched_uuid = self.cobalt_api.launch_instance(self.context,
+                                                        blessed_uuid)['uuid']
+
+        classes = gc_api._instance_classes
+        self.assertEquals(gc_api.ROLE_INSTANCE,
+                          classes.get(self.context, instance_uuid).role)
+        blessed_class = classes.get(self.context, blessed_uuid)
+        self.assertEquals(gc_api.ROLE_BLESSED, blessed_class.role)
+        self.assertEquals(instance_uuid, blessed_class.parent_uuid)
+        launched_class = classes.get(self.context, launched_uuid)
+        self.assertEquals(gc_api.ROLE_LAUNCHED, launched_class.role)
+        self.assertEquals(blessed_uuid, launched_class.parent_uuid)
+
+        # The classes are not served to the other projects.
+        other_context = nova_context.RequestContext('other_user',
+                                                    'other_project')
+        self.assertEquals(None, classes.get(other_context, blessed_uuid))
+
+        db.instance_destroy(self.context, launched_uuid)
+        self.cobalt_api.discard_instance(self.context, blessed_uuid)
+        self.assertEquals(None, classes.get(self.context, blessed_uuid))
+
+        CONF.set_override('cobalt_instance_class_cache_size', 1)
+        try:
+            classes.put(launched_uuid, launched_class)
+            self.assertEquals(None, classes.get(self.context, instance_uuid))
+            self.assertEquals(launched_class,
+                              classes.get(self.context, launched_uuid))
+        finally:
+            CONF.clear_override('cobalt_instance_class_cache_size')
+
+    def test_instance_class_not_queried(self):
+        classified = []
+        orig_classify = dbapi.instance_classify
+        def instance_classify(context, instance_uuid):
+            classified.append(instance_uuid)
+            return orig_classify(context, instance_uuid)
+        dbapi.instance_classify = instance_classify
+        try:
+            # The classes come from the loaded instances or the cache.
+            instance_uuid = utils.create_instance(self.context)
+            blessed_uuid = self.cobalt_api.bless_instance(self.context,
+                                                          instance_uuid)['uuid']
+            launched_uuid = self.cobalt_api.launch_instance(self.context,
+                                                            blessed_uuid)['uuid']
+            self.cobalt_api.check_delete(self.context, launched_uuid)
+            self.assertRaises(exception.NovaException,
+                              self.cobalt_api.check_delete,
+                              self.context, blessed_uuid)
+            db.instance_destroy(self.context, launched_uuid)
+            self.cobalt_api.discard_instance(self.context, blessed_uuid)
+            self.assertEquals([], classified)
+
+            # Only an instance whose class is not cached is classified.
+            gc_api._instance_classes.invalidate(instance_uuid)
+            self.cobalt_api.check_delete(self.context, instance_uuid)
+            self.assertEquals([instance_uuid], classified)
+        finally:
+            dbapi.instance_classify = orig_classify
+
     def test_check_delete_already_deleted(self):
         instance_uuid = utils.create_instance(self.context, {'deleted': True})
 
@@ -591,6 +1120,18 @@ class CobaltApiTestCase(unittest.TestCase):
         # before nova-api call this part of the extension.
         self.cobalt_api.check_delete(self.context, instance_uuid)
 
+    def test_check_delete_discarded_live_image(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        self.assertRaises(exception.NovaException, self.cobalt_api.check_delete,
+                          self.context, blessed_uuid)
+
+        # The live-image is discarded by another API process, so its class
+        # is still cached here.
+        db.instance_destroy(self.context, blessed_uuid)
+        self.cobalt_api.check_delete(self.context, blessed_uuid)
+        self.assertEquals(None, gc_api._instance_classes.get(self.context,
+                                                             blessed_uuid))
+
     def test_launch_with_security_groups(self):
         instance_uuid = utils.create_instance(self.context)
         blessed_instance = self.cobalt_api.bless_instance(self.context,
@@ -669,6 +1210,25 @@ class CobaltApiTestCase(unittest.TestCase):
             for i in range(num):
                 self.assertEqual(launched[i]['launch_index'], i)
 
+    def test_launch_multiple_batched_per_host(self):
+        utils.mock_scheduler_rpcapi(self.cobalt_api.scheduler_rpcapi,
+                                    hosts=['host1', 'host2', 'host3'])
+        self.mock_rpc.reset()
+        blessed_instance_uuid = utils.create_blessed_instance(self.context)
+        self.cobalt_api.launch_instance(self.context,
+                                        blessed_instance_uuid,
+                                        params={'num_instances': 5})
+
+        # host1 and host2 are assigned two instances each and get a single
+        # batched message. host3 only gets one instance.
+        launches = self.mock_rpc.cast_log['launch_instances']
+        self.assertEquals(set(['cobalt.host1', 'cobalt.host2']), set(launches.keys()))
+        for queue in launches:
+            self.assertEquals(1, len(launches[queue]['unknown']))
+            self.assertEquals(2, len(launches[queue]['unknown'][0]['args']['instance_uuids']))
+        self.assertEquals(['cobalt.host3'],
+                          self.mock_rpc.cast_log['launch_instance'].keys())
+
     def test_launch_multiple_scheduling(self):
         blessed_instance_uuid = utils.create_blessed_instance(self.context)
         params = {
@@ -741,3 +1301,91 @@ class CobaltApiTestCase(unittest.TestCase):
         self.assertEquals(6, len(self.mock_rpc.call_log['install_policy']))
 
         self.assertFalse('install_policy' in self.mock_rpc.cast_log)
+
+    def test_install_policy_skips_unchanged_hosts(self):
+        policy = "[*;blessed=1]\nmemory_limit_mb=256\n"
+        up_to_date = set([utils.create_cobalt_service(self.context)['host']
+                          for i in range(3)])
+        failing = utils.create_cobalt_service(self.context)['host']
+
+        def call(context, queue, params, timeout=None):
+            host = queue.split('.', 1)[1]
+            if host == failing:
+                raise utils.TestInducedException()
+            self.mock_rpc.call(context, queue, params, timeout=timeout)
+            # The hosts compare the hash sent with the policy to theirs.
+            if host in up_to_date and \
+               params['args']['policy_hash'] == gc_api.policy_hash(policy):
+                return 'unchanged'
+            return 'installed'
+
+        gc_api.rpc.call = call
+        try:
+            try:
+                self.cobalt_api.install_policy(self.context, policy, True)
+                self.fail("The policy install should have failed")
+            except gc_api.PolicyInstallFailed, e:
+                # The report shows where the policy made it.
+                self.assertEquals('failed', e.report[failing]['status'])
+                self.assertEquals(5, len([result for result in e.report.values()
+                                          if result['status'] != 'failed']))
+            utils.create_cobalt_service(self.context)
+            failing = None
+            self.mock_rpc.reset()
+            report = self.cobalt_api.install_policy(self.context, policy, True)
+        finally:
+            gc_api.rpc.call = self.mock_rpc.call
+
+        statuses = dict((host, result['status'])
+                        for host, result in report.iteritems())
+        self.assertEquals(6, len(statuses))
+        # Every host is called once, with the hash of the policy.
+        self.assertEquals(['install_policy'], self.mock_rpc.call_log.keys())
+        for host in statuses:
+            calls = self.mock_rpc.call_log['install_policy'][
+                                '%s.%s' % (CONF.cobalt_topic, host)]['unknown']
+            self.assertEquals(1, len(calls))
+        for host, status in statuses.iteritems():
+            if host in up_to_date:
+                self.assertEquals('unchanged', status)
+            else:
+                self.assertEquals('installed', status)
+
+    def test_install_policy_force(self):
+        # create five cobalt hosts
+        for i in range(5):
+            utils.create_cobalt_service(self.context)
+
+        self.cobalt_api.install_policy(self.context, "", True, force=True)
+
+        calls = self.mock_rpc.call_log['install_policy']
+        self.assertEquals(6, len(calls))
+        for queue_calls in calls.values():
+            for call in queue_calls['unknown']:
+                self.assertTrue(call['args']['force'])
+
+    def test_get_metrics_reports_failed_hosts(self):
+        failing = utils.create_cobalt_service(self.context)['host']
+        hung = utils.create_cobalt_service(self.context)['host']
+
+        def call(context, queue, params, timeout=None):
+            host = queue.split('.', 1)[1]
+            self.assertEquals(CONF.cobalt_metrics_timeout, timeout)
+            if host == failing:
+                raise utils.TestInducedException()
+            if host == hung:
+                raise gc_api.Timeout()
+            return {'operations': {}}
+
+        gc_api.rpc.call = call
+        try:
+            metrics = self.cobalt_api.get_metrics(self.context)
+        finally:
+            gc_api.rpc.call = self.mock_rpc.call
+
+        self.assertEquals(3, len(metrics))
+        self.assertEquals('failed', metrics[failing]['status'])
+        self.assertEquals('timeout', metrics[hung]['status'])
+        for host, result in metrics.iteritems():
+            if host not in (failing, hung):
+                self.assertEquals({'operations': {}}, result)
@@ -0,0 +1,154 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cobalt.nova import image
+from cobalt.nova.extension import artifacts
+import cobalt.tests.utils as utils
+
+class CobaltArtifactCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.glance = utils.LocalImageService()
+        self.image_service = image.ImageService(image_service=self.glance)
+        self.cache = artifacts.ArtifactCache(self.base_path,
+                                             os.getuid(), os.getgid(),
+                                             lock_path=os.path.join(self.base_path, 'locks'),
+                                             max_bytes=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def _add_image(self, image_id, file_name, data):
+        self.glance.add_image(image_id, data, name=file_name,
+                              properties={'file_name': file_name})
+
+    def test_fetch_downloads_once(self):
+        self._add_image('image-1', 'instance-1.gc', 'descriptor')
+
+        path = self.cache.fetch(None, self.image_service, 'image-1')
+        self.cache.fetch(None, self.image_service, 'image-1')
+
+        self.assertEquals(os.path.join(self.base_path, 'instance-1.gc'), path)
+        self.assertEquals('descriptor', open(path).read())
+        self.assertEquals(1, len(self.glance.downloads))
+        self.assertEquals(1, self.cache.stats['hits'])
+        self.assertEquals(1, self.cache.stats['misses'])
+
+    def test_fetch_hit_does_not_rewrite_index(self):
+        self.cache.max_bytes = 100
+        self.cache.set_in_use([])
+        self._add_image('image-1', 'instance-1.gc', 'descriptor')
+        self.cache.fetch(None, self.image_service, 'image-1')
+        writes = []
+        write_index = self.cache._write_index
+        def counting_write(index):
+            writes.append(index)
+            write_index(index)
+        self.cache._write_index = counting_write
+
+        # A recent hit and an eviction with no victims leave the index be.
+        self.cache.fetch(None, self.image_service, 'image-1')
+        self.assertEquals([], writes)
+
+        # A stale last use is recorded.
+        index = self.cache._read_index()
+        index['instance-1.gc']['last_used'] -= artifacts.LAST_USED_RESOLUTION
+        write_index(index)
+        self.cache.fetch(None, self.image_service, 'image-1')
+        self.assertEquals(1, len(writes))
+
+    def test_fetch_refreshes_changed_image(self):
+        self._add_image('image-1', 'instance-1.gc', 'old')
+        self.cache.fetch(None, self.image_service, 'image-1')
+
+        # A new image with the same file name replaces the cached artifact.
+        self._add_image('image-2', 'instance-1.gc', 'new')
+        path = self.cache.fetch(None, self.image_service, 'image-2')
+
+        self.assertEquals('new', open(path).read())
+        self.assertEquals(2, len(self.glance.downloads))
+
+    def test_fetch_adopts_existing_file(self):
+        self._add_image('image-1', 'instance-1.gc', 'descriptor')
+        with open(os.path.join(self.base_path, 'instance-1.gc'), 'w') as f:
+            f.write('descriptor')
+
+        self.cache.fetch(None, self.image_service, 'image-1')
+
+        self.assertEquals(0, len(self.glance.downloads))
+
+    def test_fetch_bad_checksum(self):
+        self._add_image('image-1', 'instance-1.gc', 'descriptor')
+        self.glance.images['image-1']['checksum'] = 'bad'
+
+        self.assertRaises(image.ImageChecksumMismatch, self.cache.fetch,
+                          None, self.image_service, 'image-1')
+        self.assertFalse(os.path.exists(os.path.join(self.base_path,
+                                                     'instance-1.gc')))
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_bytes = 10
+        self.cache.set_in_use([])
+        for i in range(3):
+            self._add_image('image-%d' % i, 'instance-%d.disk' % i, 'x' * 5)
+            self.cache.pin(['image-%d' % i])
+            self.cache.fetch(None, self.image_service, 'image-%d' % i)
+            self.cache.release(['image-%d' % i])
+
+        self.assertFalse(os.path.exists(os.path.join(self.base_path,
+                                                     'instance-0.disk')))
+        self.assertTrue(os.path.exists(os.path.join(self.base_path,
+                                                    'instance-2.disk')))
+        self.assertEquals(1, self.cache.stats['evictions'])
+
+    def test_evict_waits_for_in_use(self):
+        self.cache.max_bytes = 5
+        for i in range(2):
+            self._add_image('image-%d' % i, 'instance-%d.disk' % i, 'x' * 5)
+            self.cache.fetch(None, self.image_service, 'image-%d' % i)
+
+        # The artifacts of the running instances are not known yet.
+        self.assertEquals([], self.cache.evict())
+        self.cache.set_in_use(['image-1'])
+        self.assertEquals(['instance-0.disk'], self.cache.evict())
+
+    def test_evict_skips_in_use(self):
+        self.cache.max_bytes = 10
+        self.cache.set_in_use([])
+        self._add_image('image-0', 'instance-0.disk', 'x' * 5)
+        self.cache.pin(['image-0'])
+        self.cache.fetch(None, self.image_service, 'image-0')
+        self.cache.release(['image-0'], running=True)
+        for i in range(1, 3):
+            self._add_image('image-%d' % i, 'instance-%d.disk' % i, 'x' * 5)
+            self.cache.pin(['image-%d' % i])
+            self.cache.fetch(None, self.image_service, 'image-%d' % i)
+            self.cache.release(['image-%d' % i])
+
+        self.assertTrue(os.path.exists(os.path.join(self.base_path,
+                                                    'instance-0.disk')))
+        self.assertFalse(os.path.exists(os.path.join(self.base_path,
+                                                     'instance-1.disk')))
+
+        # Once nothing runs from image-0 it can be evicted.
+        self.cache.max_bytes = 5
+        self.cache.set_in_use([])
+        self.assertEquals(['instance-0.disk'], self.cache.evict())
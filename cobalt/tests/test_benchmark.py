@@ -0,0 +1,60 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from nova.openstack.common import rpc
+
+import cobalt.tests.benchmark as benchmark
+import cobalt.tests.utils as utils
+
+class CobaltBenchmarkTestCase(unittest.TestCase):
+    """ Runs every scenario at a small scale to make sure they still work. """
+
+    @classmethod
+    def setUpClass(cls):
+        # The scenarios are only run once for all of the tests.
+        cls.results = benchmark.run_scenarios(benchmark.Latency(), 3,
+                                              concurrency=2)
+
+    def test_scenarios_succeed(self):
+        self.assertEquals(set(benchmark.SCENARIOS),
+                          set(self.results['scenarios'].keys()))
+        for scenario, result in self.results['scenarios'].iteritems():
+            self.assertEquals(3, result['operations'], scenario)
+            self.assertEquals(0, result['errors'], scenario)
+            self.assertEquals(3, result['latency']['count'], scenario)
+
+        phases = self.results['scenarios']['migration_storm']['phases']
+        self.assertEquals(3, phases['migrate_instance.lock_wait']['count'])
+
+    def test_mocks_restored(self):
+        self.assertEquals(utils.mock_rpc.call, rpc.call)
+        self.assertEquals(utils.mock_rpc.cast, rpc.cast)
+
+    def test_compare(self):
+        baseline = {'scenarios': {
+                        'bulk_discard': {'ops_per_sec': 100.0,
+                                         'latency': {'p99': 1.0}}}}
+        results = {'scenarios': {
+                        'bulk_discard': {'ops_per_sec': 95.0,
+                                         'latency': {'p99': 1.05}},
+                        'migration_storm': {'ops_per_sec': 1.0,
+                                            'latency': {'p99': 1.0}}}}
+        self.assertEquals([], benchmark.compare(results, baseline))
+
+        results['scenarios']['bulk_discard'] = {'ops_per_sec': 50.0,
+                                                'latency': {'p99': 2.0}}
+        self.assertEquals(2, len(benchmark.compare(results, baseline)))
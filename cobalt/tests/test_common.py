@@ -0,0 +1,37 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from cobalt.nova import common
+
+class CobaltCommonTestCase(unittest.TestCase):
+
+    def test_run_concurrently(self):
+        self.assertEquals([0, 2, 4, 6],
+                          common.run_concurrently(lambda i: i * 2,
+                                                  [(i,) for i in range(4)], 2))
+
+    def test_run_concurrently_raises_after_all_calls(self):
+        calls = []
+        def fn(i):
+            calls.append(i)
+            if i == 1:
+                raise IOError("failed")
+            return i
+
+        self.assertRaises(IOError, common.run_concurrently, fn,
+                          [(i,) for i in range(4)], 2)
+        self.assertEquals([0, 1, 2, 3], sorted(calls))
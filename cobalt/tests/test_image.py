@@ -0,0 +1,61 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from cobalt.nova import image
+import cobalt.tests.utils as utils
+
+class CobaltImageDownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.glance = utils.LocalImageService(chunk_size=7)
+        self.image_service = image.ImageService(image_service=self.glance)
+        self.data = ''.join([chr(i % 256) for i in range(1000)])
+        self.glance.add_image('image', self.data)
+        self.checksum = self.glance.show(None, 'image')['checksum']
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_download(self):
+        target = os.path.join(self.path, 'image')
+
+        self.image_service.download(None, 'image', target, checksum=self.checksum)
+
+        self.assertEquals(self.data, open(target).read())
+        self.assertEquals(['image'], self.glance.downloads)
+
+    def test_download_bad_checksum(self):
+        target = os.path.join(self.path, 'image')
+
+        self.assertRaises(image.ImageChecksumMismatch,
+                          self.image_service.download,
+                          None, 'image', target, checksum='bad')
+        self.assertFalse(os.path.exists(target))
+
+    def test_download_all(self):
+        self.glance.add_image('other', 'other data')
+        downloads = [('image', os.path.join(self.path, 'image'), self.checksum),
+                     ('other', os.path.join(self.path, 'other'), None)]
+
+        self.image_service.download_all(None, downloads)
+
+        self.assertEquals(self.data, open(downloads[0][1]).read())
+        self.assertEquals('other data', open(downloads[1][1]).read())
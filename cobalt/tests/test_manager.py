@@ -14,11 +14,14 @@
 #    under the License.
 
 import unittest
+import time
 import os
 import shutil
 
 from datetime import datetime
 
+from eventlet import greenthread
+
 from nova import db
 from nova import context as nova_context
 from nova import exception
@@ -29,7 +32,9 @@ from nova.compute import power_state
 
 from oslo.config import cfg
 
+import cobalt.nova.common as co_common
 import cobalt.nova.extension.manager as co_manager
+import cobalt.nova.extension.metrics as metrics
 import cobalt.tests.utils as utils
 import cobalt.nova.extension.vmsconn as vmsconn
 
@@ -217,6 +222,205 @@ class CobaltManagerTestCase(unittest.TestCase):
                              % (blessed_uuid, launched_uuid),
             self.vmsconn.params_passed[0]['kwargs']['vms_policy'])
 
+    def test_launch_instances(self):
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata':{'images':'image1'}})
+        fetches = []
+        fetch_artifacts = self.vmsconn.fetch_artifacts
+        def counting_fetch(context, image_refs, **kwargs):
+            fetches.append(image_refs)
+            return fetch_artifacts(context, image_refs, **kwargs)
+        self.vmsconn.fetch_artifacts = counting_fetch
+        launched_uuids = []
+        for i in range(3):
+            self.vmsconn.set_return_val("launch", None)
+            launched_uuids.append(utils.create_pre_launched_instance(self.context,
+                                                        source_uuid=blessed_uuid))
+        # A failing launch does not stop the rest of the batch.
+        self.vmsconn.set_return_val("launch", utils.TestInducedException())
+        launched_uuids.append(utils.create_pre_launched_instance(self.context,
+                                                        source_uuid=blessed_uuid))
+
+        self.cobalt.launch_instances(self.context, instance_uuids=launched_uuids)
+
+        states = [db.instance_get_by_uuid(self.context, uuid)['vm_state']
+                  for uuid in launched_uuids]
+        self.assertEquals(['active', 'active', 'active', 'error'], sorted(states))
+
+        # Every launch got its own policy from the shared template.
+        policies = [params['kwargs']['vms_policy']
+                    for params in self.vmsconn.params_passed]
+        for launched_uuid in launched_uuids:
+            self.assertTrue(';blessed=%s;;flavor=m1.tiny;;tenant=fake;;uuid=%s;'
+                            % (blessed_uuid, launched_uuid) in policies)
+        # The artifacts are fetched once for the whole batch.
+        self.assertEquals([['image1']], fetches)
+        for params in self.vmsconn.params_passed:
+            self.assertEquals(['image1'], params['kwargs']['fetched_refs'])
+
+    def test_launch_instances_fetch_failure(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        launched_uuids = [utils.create_pre_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid)
+                          for i in range(2)]
+        def failing_fetch(*args, **kwargs):
+            raise utils.TestInducedException()
+        self.vmsconn.fetch_artifacts = failing_fetch
+
+        self.assertRaises(utils.TestInducedException,
+                          self.cobalt.launch_instances, self.context,
+                          instance_uuids=launched_uuids)
+        # The whole batch is put in the error state instead of building forever.
+        for launched_uuid in launched_uuids:
+            instance = db.instance_get_by_uuid(self.context, launched_uuid)
+            self.assertEquals(vm_states.ERROR, instance['vm_state'])
+            self.assertEquals(None, instance['task_state'])
+
+    def test_report_cached_artifacts(self):
+        CONF.set_override('cobalt_use_image_service', True)
+        try:
+            blessed_uuid = utils.create_blessed_instance(self.context,
+                instance={'system_metadata': {'images': 'image1,image2'}})
+            key = 'cobalt_cached_on:%s' % self.cobalt.host
+
+            # Nothing is recorded until all of the artifacts are cached.
+            self.vmsconn.cached_image_ids = set(['image1'])
+            self.vmsconn.set_return_val("launch", None)
+            self.cobalt.launch_instance(self.context,
+                instance_uuid=utils.create_pre_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid))
+            system_metadata = db.instance_system_metadata_get(self.context,
+                                                              blessed_uuid)
+            self.assertFalse(key in system_metadata)
+
+            self.vmsconn.cached_image_ids = set(['image1', 'image2'])
+            self.vmsconn.set_return_val("launch", None)
+            self.cobalt.launch_instance(self.context,
+                instance_uuid=utils.create_pre_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid))
+            system_metadata = db.instance_system_metadata_get(self.context,
+                                                              blessed_uuid)
+            self.assertEquals('1', system_metadata[key])
+
+            # Only the mark of this host is written, a stale copy of the
+            # live-image does not revert what the other hosts recorded.
+            db.instance_system_metadata_update(self.context, blessed_uuid,
+                                               {key: '0'}, False)
+            stale_ref = co_manager.instance_obj.Instance.get_by_uuid(
+                            self.context, blessed_uuid,
+                            expected_attrs=['system_metadata'])
+            db.instance_system_metadata_update(self.context, blessed_uuid,
+                            {'cobalt_cached_on:other-host': '1'}, False)
+            self.cobalt._report_cached_artifacts(self.context, stale_ref)
+            system_metadata = db.instance_system_metadata_get(self.context,
+                                                              blessed_uuid)
+            self.assertEquals('1', system_metadata[key])
+            self.assertEquals('1', system_metadata['cobalt_cached_on:other-host'])
+
+            # The mark is cleared once an artifact is evicted.
+            self.vmsconn.cached_image_ids = set(['image2'])
+            self.cobalt._refresh_cached_artifacts(self.context)
+            system_metadata = db.instance_system_metadata_get(self.context,
+                                                              blessed_uuid)
+            self.assertEquals('0', system_metadata[key])
+        finally:
+            CONF.clear_override('cobalt_use_image_service')
+
+    def test_bless_instance_prefetch(self):
+        hosts = [utils.create_cobalt_service(self.context)['host']
+                 for i in range(3)]
+        CONF.set_override('cobalt_use_image_service', True)
+        try:
+            self.mock_rpc.reset()
+            self.vmsconn.set_return_val("bless",
+                                        ("newname", None, ["file1"], []))
+            self.vmsconn.set_return_val("post_bless", ["file1_ref"])
+            self.vmsconn.set_return_val("bless_cleanup", None)
+            blessed_uuid = utils.create_pre_blessed_instance(self.context)
+            self.cobalt.bless_instance(self.context, instance_uuid=blessed_uuid,
+                                       migration_url=None,
+                                       prefetch_hosts=hosts[:2])
+
+            prefetches = self.mock_rpc.cast_log['prefetch_live_image']
+            self.assertEquals(set(['cobalt.%s' % host for host in hosts[:2]]),
+                              set(prefetches.keys()))
+
+            # The prefetching host records that it holds the artifacts.
+            self.vmsconn.cached_image_ids = set(['file1_ref'])
+            self.cobalt.prefetch_live_image(self.context,
+                                            instance_uuid=blessed_uuid)
+            system_metadata = db.instance_system_metadata_get(self.context,
+                                                              blessed_uuid)
+            self.assertEquals('1', system_metadata['cobalt_cached_on:%s' %
+                                                   self.cobalt.host])
+        finally:
+            CONF.clear_override('cobalt_use_image_service')
+
+    def test_claim_pooled_instance(self):
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        instance_uuid = utils.create_launched_instance(self.context,
+                            instance={'host': self.cobalt.host,
+                                      'vm_state': vm_states.PAUSED,
+                                      'task_state': task_states.SPAWNING},
+                            source_uuid=blessed_uuid)
+        self.mock_rpc.reset()
+        self.vmsconn.set_return_val("unpause_instance", None)
+
+        self.cobalt.claim_pooled_instance(self.context,
+                                          instance_uuid=instance_uuid)
+
+        instance = db.instance_get_by_uuid(self.context, instance_uuid)
+        self.assertEquals(vm_states.ACTIVE, instance['vm_state'])
+        self.assertEquals(None, instance['task_state'])
+        self.assertTrue(instance['launched_at'] is not None)
+
+    def test_launch_pooled_instance(self):
+        self.vmsconn.set_return_val("launch", None)
+        self.vmsconn.set_return_val("pause_instance", None)
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pre_launched_instance(self.context,
+                            instance={'task_state': co_common.POOL_SPAWNING},
+                            source_uuid=blessed_uuid)
+        launch_task_states = []
+        def launch(*args, **kwargs):
+            launch_task_states.append(db.instance_get_by_uuid(self.context,
+                                                    pooled_uuid)['task_state'])
+        self.vmsconn.launch = launch
+
+        self.cobalt.launch_pooled_instance(self.context,
+                                           instance_uuid=pooled_uuid)
+
+        # The clone is kept out of the launches until it is paused.
+        self.assertEquals([co_common.POOL_SPAWNING], launch_task_states)
+        pooled = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(vm_states.PAUSED, pooled['vm_state'])
+        self.assertEquals(co_common.POOLED, pooled['task_state'])
+        self.assertEquals(self.cobalt.host, pooled['host'])
+
+    def test_launch_pooled_instance_deleted(self):
+        self.vmsconn.set_return_val("pause_instance", None)
+        blessed_uuid = utils.create_blessed_instance(self.context)
+        pooled_uuid = utils.create_pre_launched_instance(self.context,
+                            instance={'task_state': co_common.POOL_SPAWNING},
+                            source_uuid=blessed_uuid)
+        def launch(*args, **kwargs):
+            # The pool is drained while the clone is launched.
+            db.instance_update(self.context, pooled_uuid,
+                               {'task_state': task_states.DELETING})
+        self.vmsconn.launch = launch
+        deallocated = []
+        self.cobalt.network_api.deallocate_for_instance = \
+            lambda context, instance: deallocated.append(instance['uuid'])
+
+        self.cobalt.launch_pooled_instance(self.context,
+                                           instance_uuid=pooled_uuid)
+
+        # The delete is not overwritten and what the launch set up is undone.
+        pooled = db.instance_get_by_uuid(self.context, pooled_uuid)
+        self.assertEquals(task_states.DELETING, pooled['task_state'])
+        self.assertNotEquals(vm_states.PAUSED, pooled['vm_state'])
+        self.assertEquals([pooled_uuid], deallocated)
+
     def test_launch_instance_images(self):
         self.vmsconn.set_return_val("launch", None)
         blessed_uuid = utils.create_blessed_instance(self.context,
@@ -233,6 +437,24 @@ class CobaltManagerTestCase(unittest.TestCase):
         # Ensure that image1 was passed to vmsconn.launch
         self.assertEquals(['image1'], self.vmsconn.params_passed[0]['kwargs']['image_refs'])
 
+    def test_launch_instance_fetches_artifacts_once(self):
+        self.vmsconn.set_return_val("launch", None)
+        released = []
+        self.vmsconn.release_artifacts = lambda image_refs, running=False: \
+                                            released.append((image_refs, running))
+        blessed_uuid = utils.create_blessed_instance(self.context,
+            instance={'system_metadata':{'images':'image1'}})
+        launched_uuid = utils.create_pre_launched_instance(self.context,
+                                                    source_uuid=blessed_uuid)
+
+        self.cobalt.launch_instance(self.context, instance_uuid=launched_uuid)
+
+        # The launch is given the artifacts fetched by their stage, which
+        # are released once the instance runs.
+        self.assertEquals(['image1'],
+                          self.vmsconn.params_passed[0]['kwargs']['fetched_refs'])
+        self.assertEquals([(['image1'], True)], released)
+
     def test_launch_instance_exception(self):
 
         self.vmsconn.set_return_val("launch", utils.TestInducedException())
@@ -312,6 +534,451 @@ class CobaltManagerTestCase(unittest.TestCase):
             self.assertTrue(pre_discard_time <= discarded_instance['terminated_at'])
             self.assertEquals(vm_states.DELETED, discarded_instance['vm_state'])
 
+    def test_lock_instance_reentrant(self):
+        instance_uuid = utils.create_uuid()
+        self.cobalt._lock_instance(instance_uuid)
+        self.cobalt._lock_instance(instance_uuid)
+        self.cobalt._unlock_instance(instance_uuid)
+        self.assertTrue(instance_uuid in self.cobalt.locked_instances)
+        self.cobalt._unlock_instance(instance_uuid)
+        self.assertFalse(instance_uuid in self.cobalt.locked_instances)
+
+    def test_lock_instance_waits_for_other_thread(self):
+        instance_uuid = utils.create_uuid()
+        other_uuid = utils.create_uuid()
+        acquired = []
+
+        def lock_and_release(uuid):
+            self.cobalt._lock_instance(uuid)
+            acquired.append(uuid)
+            self.cobalt._unlock_instance(uuid)
+
+        self.cobalt._lock_instance(instance_uuid)
+        self.cobalt._lock_instance(other_uuid)
+        waiter = greenthread.spawn(lock_and_release, instance_uuid)
+        other_waiter = greenthread.spawn(lock_and_release, other_uuid)
+        greenthread.sleep(0)
+        self.assertEquals([], acquired)
+        self.assertEquals(1, self.cobalt.instance_waiters[instance_uuid][1])
+
+        # Releasing one instance only lets its own waiter through.
+        self.cobalt._unlock_instance(instance_uuid)
+        waiter.wait()
+        self.assertEquals([instance_uuid], acquired)
+        self.assertFalse(instance_uuid in self.cobalt.instance_waiters)
+        self.assertTrue(other_uuid in self.cobalt.instance_waiters)
+
+        self.cobalt._unlock_instance(other_uuid)
+        other_waiter.wait()
+        self.assertEquals({}, self.cobalt.instance_waiters)
+
+    def test_lock_instance_killed_waiter(self):
+        instance_uuid = utils.create_uuid()
+        acquired = []
+
+        def lock_and_release():
+            self.cobalt._lock_instance(instance_uuid)
+            acquired.append(instance_uuid)
+            self.cobalt._unlock_instance(instance_uuid)
+
+        self.cobalt._lock_instance(instance_uuid)
+        killed_waiter = greenthread.spawn(lock_and_release)
+        waiter = greenthread.spawn(lock_and_release)
+        greenthread.sleep(0)
+        self.assertEquals(2, self.cobalt.instance_waiters[instance_uuid][1])
+        killed_waiter.kill()
+
+        # The waiter killed first does not keep the other one waiting.
+        self.cobalt._unlock_instance(instance_uuid)
+        greenthread.sleep(0.1)
+        self.assertEquals([instance_uuid], acquired)
+        self.assertTrue(waiter.dead)
+        self.assertEquals({}, self.cobalt.instance_waiters)
+
+    def test_launch_instance_metrics(self):
+        self.vmsconn.set_return_val("launch", None)
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        metrics.REGISTRY.reset()
+
+        self.cobalt.launch_instance(self.context, instance_uuid=launched_uuid)
+
+        operations = self.cobalt.get_metrics(self.context)['operations']
+        self.assertEquals(1, operations['launch_instance']['count'])
+        for phase in ('lock_wait', 'block_device', 'network', 'vms_launch'):
+            self.assertEquals(1, operations['launch_instance.%s' % phase]['count'])
+
+    def test_launch_instance_overlaps_stages(self):
+        events = []
+        def slow_block_device(*args, **kwargs):
+            events.append('block_device start')
+            greenthread.sleep(0.2)
+            events.append('block_device end')
+            return {}
+        def slow_networkinfo(*args, **kwargs):
+            events.append('network start')
+            greenthread.sleep(0.2)
+            events.append('network end')
+            return utils.fake_networkinfo()
+        self.cobalt.compute_manager._prep_block_device = slow_block_device
+        self.cobalt._instance_network_info = slow_networkinfo
+        self.vmsconn.set_return_val("launch", None)
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+
+        self.cobalt.launch_instance(self.context, instance_uuid=launched_uuid)
+        # Both stages started before either one was over.
+        self.assertEquals(set(['block_device start', 'network start']),
+                          set(events[:2]))
+        self.assertEquals(vm_states.ACTIVE,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+
+    def test_launch_instance_block_device_failure(self):
+        def failing_block_device(*args, **kwargs):
+            raise exception.NovaException()
+        self.cobalt.compute_manager._prep_block_device = failing_block_device
+        deallocated = []
+        def deallocate_for_instance(context, instance):
+            deallocated.append(instance['uuid'])
+        self.cobalt.network_api.deallocate_for_instance = deallocate_for_instance
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        self.mock_rpc.reset()
+
+        self.assertRaises(exception.NovaException, self.cobalt.launch_instance,
+                          self.context, instance_uuid=launched_uuid)
+        self.assertEquals(vm_states.ERROR,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+        # The networks are not set up on the host and are released.
+        self.assertFalse('pre_live_migration' in self.mock_rpc.call_log)
+        self.assertEquals([launched_uuid], deallocated)
+
+    def test_launch_instance_snapshot_volumes(self):
+        class SlowVolumes(object):
+            def __init__(self):
+                self.polls = {}
+                self.events = []
+            def get_snapshot(self, context, snapshot_id):
+                return {'id': snapshot_id, 'volume_id': 'from-vol'}
+            def get(self, context, volume_id):
+                if volume_id == 'from-vol':
+                    return {'id': volume_id, 'display_name': 'from',
+                            'status': 'available'}
+                self.polls[volume_id] = self.polls.get(volume_id, 0) + 1
+                # The first volume is created at once, the others after
+                # their second poll.
+                created = volume_id == 'vol-snap-vdb' or \
+                          self.polls[volume_id] > 2
+                return {'id': volume_id,
+                        'status': created and 'available' or 'creating'}
+            def create(self, context, size, name, description, snapshot):
+                self.events.append('start')
+                greenthread.sleep(0.2)
+                self.events.append('end')
+                return {'id': 'vol-%s' % snapshot['id']}
+        self.cobalt.volume_api = SlowVolumes()
+        prepared_bdms = []
+        def prep_block_device(context, instance, bdms):
+            prepared_bdms.extend(bdms)
+            return {}
+        self.cobalt.compute_manager._prep_block_device = prep_block_device
+        self.vmsconn.set_return_val("launch", None)
+
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        for device in ('vdb', 'vdc', 'vdd', 'vde'):
+            db.block_device_mapping_create(self.context,
+                        {'instance_uuid': launched_uuid,
+                         'device_name': device,
+                         'source_type': 'snapshot',
+                         'destination_type': 'volume',
+                         'snapshot_id': 'snap-%s' % device,
+                         'volume_id': None,
+                         'volume_size': 1,
+                         'delete_on_termination': True}, legacy=False)
+
+        orig_interval = co_manager.VOLUME_POLL_MIN_INTERVAL
+        co_manager.VOLUME_POLL_MIN_INTERVAL = 0.01
+        try:
+            self.cobalt.launch_instance(self.context,
+                                        instance_uuid=launched_uuid)
+        finally:
+            co_manager.VOLUME_POLL_MIN_INTERVAL = orig_interval
+        # The volumes are created concurrently (every create starts before
+        # any of them returns) and only the ones still being created are
+        # checked again.
+        self.assertEquals(['start'] * 4 + ['end'] * 4,
+                          self.cobalt.volume_api.events)
+        self.assertEquals({'vol-snap-vdb': 1, 'vol-snap-vdc': 3,
+                           'vol-snap-vdd': 3, 'vol-snap-vde': 3},
+                          self.cobalt.volume_api.polls)
+        self.assertEquals(vm_states.ACTIVE,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+
+        # nova is handed the mappings with their volumes, it only attaches them.
+        self.assertEquals(4, len(prepared_bdms))
+        for bdm in prepared_bdms:
+            self.assertEquals('vol-%s' % bdm['snapshot_id'], bdm['volume_id'])
+        for bdm in db.block_device_mapping_get_all_by_instance(self.context,
+                                                               launched_uuid):
+            self.assertEquals('vol-%s' % bdm['snapshot_id'], bdm['volume_id'])
+
+    def test_launch_instance_snapshot_volumes_timeout(self):
+        class CreatingVolumes(object):
+            def __init__(self):
+                self.deleted = []
+            def delete(self, context, volume):
+                self.deleted.append(volume['id'])
+            def get_snapshot(self, context, snapshot_id):
+                return {'id': snapshot_id, 'volume_id': 'from-vol'}
+            def get(self, context, volume_id):
+                return {'id': volume_id, 'display_name': 'from',
+                        'status': 'creating'}
+            def create(self, context, size, name, description, snapshot):
+                return {'id': 'vol-%s' % snapshot['id']}
+        self.cobalt.volume_api = CreatingVolumes()
+        self.vmsconn.set_return_val("launch", None)
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        db.block_device_mapping_create(self.context,
+                    {'instance_uuid': launched_uuid,
+                     'device_name': 'vdb',
+                     'source_type': 'snapshot',
+                     'destination_type': 'volume',
+                     'snapshot_id': 'snap-vdb',
+                     'volume_id': None,
+                     'volume_size': 1}, legacy=False)
+
+        CONF.set_override('cobalt_volume_create_timeout', 0)
+        try:
+            self.assertRaises(exception.NovaException,
+                              self.cobalt.launch_instance, self.context,
+                              instance_uuid=launched_uuid)
+        finally:
+            CONF.clear_override('cobalt_volume_create_timeout')
+        self.assertEquals(vm_states.ERROR,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+        # The volume that was never used is deleted.
+        self.assertEquals(['vol-snap-vdb'], self.cobalt.volume_api.deleted)
+
+    def test_launch_instance_snapshot_volumes_create_failure(self):
+        class FailingVolumes(object):
+            def __init__(self):
+                self.deleted = []
+            def get_snapshot(self, context, snapshot_id):
+                return {'id': snapshot_id, 'volume_id': 'from-vol'}
+            def get(self, context, volume_id):
+                return {'id': volume_id, 'display_name': 'from'}
+            def create(self, context, size, name, description, snapshot):
+                if snapshot['id'] == 'snap-vdc':
+                    raise exception.NovaException()
+                greenthread.sleep(0.1)
+                return {'id': 'vol-%s' % snapshot['id']}
+            def delete(self, context, volume):
+                self.deleted.append(volume['id'])
+        self.cobalt.volume_api = FailingVolumes()
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        for device in ('vdb', 'vdc', 'vdd'):
+            db.block_device_mapping_create(self.context,
+                        {'instance_uuid': launched_uuid,
+                         'device_name': device,
+                         'source_type': 'snapshot',
+                         'destination_type': 'volume',
+                         'snapshot_id': 'snap-%s' % device,
+                         'volume_id': None,
+                         'volume_size': 1}, legacy=False)
+
+        self.assertRaises(exception.NovaException,
+                          self.cobalt.launch_instance, self.context,
+                          instance_uuid=launched_uuid)
+        # The volumes created next to the failed one are deleted, and no
+        # mapping points at them.
+        self.assertEquals(['vol-snap-vdb', 'vol-snap-vdd'],
+                          sorted(self.cobalt.volume_api.deleted))
+        for bdm in db.block_device_mapping_get_all_by_instance(self.context,
+                                                               launched_uuid):
+            self.assertEquals(None, bdm['volume_id'])
+
+    def _create_snapshot_bdms(self, instance_uuid, devices):
+        for device in devices:
+            db.block_device_mapping_create(self.context,
+                        {'instance_uuid': instance_uuid,
+                         'device_name': device,
+                         'source_type': 'snapshot',
+                         'destination_type': 'volume',
+                         'snapshot_id': 'snap-%s' % device,
+                         'volume_id': None,
+                         'volume_size': 1}, legacy=False)
+
+    class AttachedVolumes(object):
+        """ Volumes that are attached to the instance they are created for. """
+        def __init__(self, instance_uuid, create_delay=0):
+            self.instance_uuid = instance_uuid
+            self.create_delay = create_delay
+            self.detached = []
+            self.deleted = []
+        def get_snapshot(self, context, snapshot_id):
+            return {'id': snapshot_id, 'volume_id': 'from-vol'}
+        def get(self, context, volume_id):
+            return {'id': volume_id, 'display_name': 'from',
+                    'status': 'in-use', 'instance_uuid': self.instance_uuid}
+        def create(self, context, size, name, description, snapshot):
+            greenthread.sleep(self.create_delay)
+            return {'id': 'vol-%s' % snapshot['id']}
+        def terminate_connection(self, context, volume_id, connector):
+            pass
+        def detach(self, context, volume_id):
+            self.detached.append(volume_id)
+        def delete(self, context, volume):
+            self.deleted.append(volume['id'])
+
+    def test_launch_instance_failure_undoes_stages(self):
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        self._create_snapshot_bdms(launched_uuid, ('vdb', 'vdc'))
+        self.cobalt.volume_api = self.AttachedVolumes(launched_uuid)
+        self.cobalt.compute_manager._prep_block_device = \
+            lambda context, instance, bdms: {}
+        deallocated = []
+        def deallocate_for_instance(context, instance):
+            deallocated.append(instance['uuid'])
+        self.cobalt.network_api.deallocate_for_instance = deallocate_for_instance
+        self.vmsconn.set_return_val("launch", utils.TestInducedException())
+
+        self.assertRaises(utils.TestInducedException,
+                          self.cobalt.launch_instance, self.context,
+                          instance_uuid=launched_uuid)
+        # The volumes created for the launch are detached and deleted, and
+        # the networks allocated for it are released.
+        self.assertEquals(['vol-snap-vdb', 'vol-snap-vdc'],
+                          sorted(self.cobalt.volume_api.detached))
+        self.assertEquals(['vol-snap-vdb', 'vol-snap-vdc'],
+                          sorted(self.cobalt.volume_api.deleted))
+        for bdm in db.block_device_mapping_get_all_by_instance(self.context,
+                                                               launched_uuid):
+            self.assertEquals(None, bdm['volume_id'])
+        self.assertEquals([launched_uuid], deallocated)
+
+    def test_launch_instance_network_failure_joins_block_device_stage(self):
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        self._create_snapshot_bdms(launched_uuid, ('vdb', 'vdc'))
+        self.cobalt.volume_api = self.AttachedVolumes(launched_uuid,
+                                                      create_delay=0.2)
+        def failing_networkinfo(*args, **kwargs):
+            greenthread.sleep(0.1)
+            return None
+        self.cobalt._instance_network_info = failing_networkinfo
+
+        self.cobalt.launch_instance(self.context, instance_uuid=launched_uuid)
+        # The volumes still being created when the networks failed are
+        # deleted before the launch returns.
+        self.assertEquals(['vol-snap-vdb', 'vol-snap-vdc'],
+                          sorted(self.cobalt.volume_api.deleted))
+        self.assertEquals(vm_states.ERROR,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+
+    def test_launch_instance_spawning_update_failure_undoes_stages(self):
+        launched_uuid = utils.create_pre_launched_instance(self.context)
+        self._create_snapshot_bdms(launched_uuid, ('vdb',))
+        self.cobalt.volume_api = self.AttachedVolumes(launched_uuid)
+        self.cobalt.compute_manager._prep_block_device = \
+            lambda context, instance, bdms: {}
+        deallocated = []
+        def deallocate_for_instance(context, instance):
+            deallocated.append(instance['uuid'])
+        self.cobalt.network_api.deallocate_for_instance = deallocate_for_instance
+        instance_update = self.cobalt._instance_update
+        def failing_spawning_update(context, instance_uuid, **kwargs):
+            if kwargs.get('task_state') == task_states.SPAWNING:
+                # The block device stage has created its volume by then.
+                greenthread.sleep(0.1)
+                raise utils.TestInducedException()
+            return instance_update(context, instance_uuid, **kwargs)
+        self.cobalt._instance_update = failing_spawning_update
+
+        # A failure right after the networks are allocated is undone like
+        # the failures of the later steps.
+        self.assertRaises(utils.TestInducedException,
+                          self.cobalt.launch_instance, self.context,
+                          instance_uuid=launched_uuid)
+        self.assertEquals(['vol-snap-vdb'], self.cobalt.volume_api.deleted)
+        self.assertEquals([launched_uuid], deallocated)
+        self.assertEquals(vm_states.ERROR,
+                db.instance_get_by_uuid(self.context, launched_uuid)['vm_state'])
+
+    def test_snapshot_attached_volumes(self):
+        class SlowSnapshots(object):
+            def __init__(self):
+                self.events = []
+            def get(self, context, volume_id):
+                return {'id': volume_id, 'display_description': ''}
+            def create_snapshot_force(self, context, volume, name, description):
+                self.events.append('start')
+                greenthread.sleep(0.2)
+                self.events.append('end')
+                return {'id': 'snapshot-%s' % volume['id']}
+        self.cobalt.volume_api = SlowSnapshots()
+        self.vmsconn.set_return_val("pause_instance", None)
+
+        source_uuid = utils.create_instance(self.context)
+        blessed_uuid = utils.create_pre_blessed_instance(self.context,
+                                                         source_uuid=source_uuid)
+        for device in ('vdb', 'vdc', 'vdd'):
+            utils.add_block_dev(self.context, blessed_uuid, device)
+        get_instance = lambda uuid: co_manager.instance_obj.Instance.\
+                                        get_by_uuid(self.context, uuid)
+
+        start = time.time()
+        paused_at = self.cobalt._snapshot_attached_volumes(self.context,
+                                                get_instance(source_uuid),
+                                                get_instance(blessed_uuid))
+        # The snapshots are requested concurrently (every request starts
+        # before any of them returns) while the source is paused.
+        self.assertEquals(['start'] * 3 + ['end'] * 3,
+                          self.cobalt.volume_api.events)
+        self.assertTrue(paused_at >= start)
+
+        bdms = [bdm for bdm in db.block_device_mapping_get_all_by_instance(
+                                                    self.context, blessed_uuid)
+                if bdm['device_name'] in ('vdb', 'vdc', 'vdd')]
+        self.assertEquals(3, len(bdms))
+        for bdm in bdms:
+            self.assertTrue(bdm['snapshot_id'].startswith('snapshot-'))
+            self.assertEquals(None, bdm['volume_id'])
+
+    def test_snapshot_attached_volumes_failure(self):
+        class FailingSnapshots(object):
+            def __init__(self):
+                self.deleted = []
+            def get(self, context, volume_id):
+                return {'id': volume_id, 'display_description': ''}
+            def create_snapshot_force(self, context, volume, name, description):
+                if volume['id'] == 'vol-vdc':
+                    raise exception.NovaException()
+                greenthread.sleep(0.1)
+                return {'id': 'snapshot-%s' % volume['id']}
+            def delete_snapshot(self, context, snapshot):
+                self.deleted.append(snapshot['id'])
+        self.cobalt.volume_api = FailingSnapshots()
+        self.vmsconn.set_return_val("pause_instance", None)
+        self.vmsconn.set_return_val("unpause_instance", None)
+
+        source_uuid = utils.create_instance(self.context)
+        blessed_uuid = utils.create_pre_blessed_instance(self.context,
+                                                         source_uuid=source_uuid)
+        for device in ('vdb', 'vdc', 'vdd'):
+            db.block_device_mapping_create(self.context,
+                        {'instance_uuid': blessed_uuid,
+                         'device_name': device,
+                         'source_type': 'volume',
+                         'destination_type': 'volume',
+                         'volume_id': 'vol-%s' % device}, legacy=False)
+        get_instance = lambda uuid: co_manager.instance_obj.Instance.\
+                                        get_by_uuid(self.context, uuid)
+
+        self.assertRaises(exception.NovaException,
+                          self.cobalt._snapshot_attached_volumes, self.context,
+                          get_instance(source_uuid), get_instance(blessed_uuid))
+        # The snapshots taken next to the failed one are deleted and the
+        # source instance is unpaused.
+        self.assertEquals(['snapshot-vol-vdb', 'snapshot-vol-vdd'],
+                          sorted(self.cobalt.volume_api.deleted))
+        self.assertEquals([], self.vmsconn.return_vals['unpause_instance'])
+
     def test_reset_host_different_host_instance(self):
 
         host = "test-host"
@@ -0,0 +1,87 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+import cobalt.nova.extension.metrics as metrics
+
+class CobaltMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def test_histogram_percentiles(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 101):
+            histogram.record(float(value))
+
+        summary = histogram.summary()
+        self.assertEquals(100, summary['count'])
+        self.assertEquals(50.5, summary['mean'])
+        self.assertEquals(100.0, summary['max'])
+        self.assertEquals(51.0, summary['p50'])
+        self.assertEquals(95.0, summary['p95'])
+        self.assertEquals(99.0, summary['p99'])
+
+    def test_histogram_keeps_recent_samples(self):
+        histogram = metrics.Histogram(max_samples=10)
+        for value in range(100):
+            histogram.record(float(value))
+
+        self.assertEquals(100, histogram.count)
+        self.assertEquals(90.0, histogram.percentile(0))
+
+    def test_empty_histogram(self):
+        summary = metrics.Histogram().summary()
+        self.assertEquals(0, summary['count'])
+        self.assertEquals(0.0, summary['p99'])
+
+    def test_operation_phases(self):
+        metrics.start('bless', metrics=self.metrics)
+        try:
+            with metrics.phase('upload'):
+                pass
+            with metrics.phase('upload'):
+                pass
+            timings = metrics.current_timings()
+        finally:
+            result = metrics.finish()
+
+        self.assertEquals(['upload'], timings['phases'].keys())
+        self.assertEquals(['upload'], result['phases'].keys())
+        summary = self.metrics.summary()
+        self.assertEquals(1, summary['bless']['count'])
+        self.assertEquals(2, summary['bless.upload']['count'])
+        self.assertEquals(None, metrics.current_timings())
+
+    def test_nested_operations(self):
+        metrics.start('migrate', metrics=self.metrics)
+        try:
+            metrics.start('bless', metrics=self.metrics)
+            try:
+                with metrics.phase('upload'):
+                    pass
+            finally:
+                metrics.finish()
+            with metrics.phase('launch'):
+                pass
+        finally:
+            metrics.finish()
+
+        self.assertEquals(['bless', 'bless.upload', 'migrate', 'migrate.launch'],
+                          sorted(self.metrics.summary().keys()))
+
+    def test_finish_without_start(self):
+        self.assertEquals(None, metrics.finish())
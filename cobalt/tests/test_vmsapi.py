@@ -15,9 +15,17 @@
 
 
 
+import StringIO
+import sys
+import time
 import unittest
+
+from oslo.config import cfg
+
 import cobalt.nova.extension.vmsapi as vms_api
+from cobalt.nova.extension import vmsworker
 
+CONF = cfg.CONF
 
 class CapturedVmsCtl(object):
     """
@@ -216,4 +224,149 @@ class CobaltVmsApiTestCase(unittest.TestCase):
                            '--use.names',
                            '-p', 'dummy',
                            'unpause', 'testunpause'],
-            self.capture.captured_command)
\ No newline at end of file
+            self.capture.captured_command)
+
+
+class CobaltVmsctlWorkerTestCase(unittest.TestCase):
+
+    def test_frame_roundtrip(self):
+        stream = StringIO.StringIO()
+        vmsworker.write_frame(stream, {'cmd': ['vmsctl', 'pause', 'test']})
+        vmsworker.write_frame(stream, {'cmd': ['vmsctl', 'unpause', 'test']})
+        stream.seek(0)
+
+        self.assertEquals({'cmd': ['vmsctl', 'pause', 'test']},
+                          vmsworker.read_frame(stream))
+        self.assertEquals({'cmd': ['vmsctl', 'unpause', 'test']},
+                          vmsworker.read_frame(stream))
+        self.assertEquals(None, vmsworker.read_frame(stream))
+
+    def test_truncated_frame(self):
+        stream = StringIO.StringIO()
+        vmsworker.write_frame(stream, {'cmd': ['vmsctl', 'pause', 'test']})
+        stream = StringIO.StringIO(stream.getvalue()[:-2])
+
+        self.assertRaises(vmsworker.FrameError, vmsworker.read_frame, stream)
+
+    def test_worker_is_ready_before_requests(self):
+        instream = StringIO.StringIO()
+        outstream = StringIO.StringIO()
+        vmsworker.serve(instream, outstream)
+        outstream.seek(0)
+
+        self.assertEquals(vmsworker.READY, vmsworker.read_frame(outstream))
+        self.assertEquals(None, vmsworker.read_frame(outstream))
+
+    def test_worker_refuses_other_commands(self):
+        response = vmsworker.handle_request({'cmd': ['rm', '-rf', '/']})
+        self.assertEquals(-1, response['exit_code'])
+
+    def test_fallback_when_worker_unavailable(self):
+        executed = []
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return ('newname = fallback', '')
+
+        vmsctl = vms_api.Vmsctl(vms_platform='dummy', workers=1)
+        vmsctl.worker_pool = vms_api.VmsctlWorkerPool(
+                                    ['/nonexistent/cobalt-vmsctl-worker'], 1)
+        orig_execute = vms_api.utils.execute
+        vms_api.utils.execute = fake_execute
+        try:
+            stdout = vmsctl.run_command(['pause', 'test'])
+        finally:
+            vms_api.utils.execute = orig_execute
+
+        self.assertEquals(['newname = fallback'], stdout)
+        self.assertEquals([('vmsctl', '--use.names', '-p', 'dummy',
+                            'pause', 'test')], executed)
+
+    def test_fallback_when_worker_exits_on_startup(self):
+        executed = []
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return ('newname = fallback', '')
+
+        vmsctl = vms_api.Vmsctl(vms_platform='dummy', workers=1)
+        # The worker exits without answering, as when rootwrap rejects it.
+        vmsctl.worker_pool = vms_api.VmsctlWorkerPool(['true'], 1)
+        orig_execute = vms_api.utils.execute
+        vms_api.utils.execute = fake_execute
+        try:
+            self.assertEquals(['newname = fallback'],
+                              vmsctl.run_command(['pause', 'test']))
+            self.assertTrue(vmsctl.worker_pool.last_start_failure is not None)
+            # The worker is not started again before the respawn delay.
+            self.assertEquals(['newname = fallback'],
+                              vmsctl.run_command(['unpause', 'test']))
+        finally:
+            vms_api.utils.execute = orig_execute
+        self.assertEquals(2, len(executed))
+
+    def test_fallback_when_worker_hangs_on_startup(self):
+        executed = []
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return ('newname = fallback', '')
+
+        vmsctl = vms_api.Vmsctl(vms_platform='dummy', workers=1)
+        # The worker never writes its READY frame.
+        vmsctl.worker_pool = vms_api.VmsctlWorkerPool(['sleep', '60'], 1)
+        orig_execute = vms_api.utils.execute
+        vms_api.utils.execute = fake_execute
+        CONF.set_override('cobalt_vmsctl_worker_start_timeout', 1)
+        try:
+            start = time.time()
+            self.assertEquals(['newname = fallback'],
+                              vmsctl.run_command(['pause', 'test']))
+            self.assertTrue(time.time() - start < 5)
+            self.assertTrue(vmsctl.worker_pool.last_start_failure is not None)
+        finally:
+            CONF.clear_override('cobalt_vmsctl_worker_start_timeout')
+            vms_api.utils.execute = orig_execute
+        self.assertEquals(1, len(executed))
+
+    def test_worker_command_uses_rootwrap(self):
+        vmsctl = vms_api.Vmsctl(workers=1)
+        self.assertEquals(['sudo', 'nova-rootwrap', CONF.rootwrap_config,
+                           'cobalt-vmsctl-worker'],
+                          vmsctl.worker_pool.command)
+
+    def test_lost_worker_does_not_fall_back(self):
+        executed = []
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return ('', '')
+
+        # The worker is ready but exits with the command in hand.
+        vmsctl = vms_api.Vmsctl(vms_platform='dummy', workers=1)
+        vmsctl.worker_pool = vms_api.VmsctlWorkerPool(
+            [sys.executable, '-c', 'import sys; '
+             'from cobalt.nova.extension import vmsworker; '
+             'vmsworker.write_frame(sys.stdout, vmsworker.READY); '
+             'vmsworker.read_frame(sys.stdin)'], 1)
+        orig_execute = vms_api.utils.execute
+        vms_api.utils.execute = fake_execute
+        try:
+            self.assertRaises(vms_api.VmsctlWorkerLost, vmsctl.run_command,
+                              ['launch', 'test'])
+        finally:
+            vms_api.utils.execute = orig_execute
+        self.assertEquals([], executed)
+
+    def test_fallback_when_all_workers_busy(self):
+        executed = []
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return ('', '')
+
+        vmsctl = vms_api.Vmsctl(vms_platform='dummy', workers=1)
+        # The only worker is checked out by another command.
+        vmsctl.worker_pool.idle.get()
+        orig_execute = vms_api.utils.execute
+        vms_api.utils.execute = fake_execute
+        try:
+            vmsctl.run_command(['pause', 'test'])
+        finally:
+            vms_api.utils.execute = orig_execute
+        self.assertEquals(1, len(executed))
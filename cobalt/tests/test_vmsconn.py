@@ -13,9 +13,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
+from eventlet import greenthread
+from nova import context as nova_context
 from nova.virt import fake
+from cobalt.nova import image
+from oslo.config import cfg
+import cobalt.nova.common as co_common
+import cobalt.nova.extension.vmsapi as vms_api
 import cobalt.nova.extension.vmsconn as vms_conn
+import cobalt.tests.utils as utils
+
+CONF = cfg.CONF
 
 class CobaltVmsConnTestCase(unittest.TestCase):
 
@@ -49,3 +61,195 @@ class CobaltVmsConnTestCase(unittest.TestCase):
             self.assertEqual(image_name, expected_name)
             self.assertEqual(image_type, expected_type)
 
+    def test_single_flight_coalesces_calls(self):
+        single_flight = vms_conn.SingleFlight()
+        calls = []
+        def download(image_ref):
+            calls.append(image_ref)
+            greenthread.sleep(0.01)
+            return image_ref + '.gc'
+
+        threads = [greenthread.spawn(single_flight.do, 'image', download, 'image')
+                   for i in range(5)]
+        results = [thread.wait() for thread in threads]
+
+        self.assertEquals(['image'], calls)
+        self.assertEquals(['image.gc'] * 5, results)
+        self.assertEquals(4, single_flight.coalesced)
+        self.assertEquals({}, single_flight.in_flight)
+
+    def test_single_flight_shares_exception(self):
+        single_flight = vms_conn.SingleFlight()
+        def download():
+            greenthread.sleep(0.01)
+            raise IOError("download failed")
+
+        threads = [greenthread.spawn(single_flight.do, 'image', download)
+                   for i in range(3)]
+        for thread in threads:
+            self.assertRaises(IOError, thread.wait)
+
+        # A later call is not affected by the failed one.
+        self.assertEquals('ok', single_flight.do('image', lambda: 'ok'))
+
+class CobaltUploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = nova_context.RequestContext('fake', 'fake', True)
+        self.path = tempfile.mkdtemp()
+        self.glance = utils.LocalImageService()
+        self.vmsconn = vms_conn.LibvirtConnection(vms_api.get_vmsapi(),
+                                    fake.FakeDriver(None),
+                                    image_service=image.ImageService(self.glance))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _bless(self, name, disk_data):
+        instance_ref = {'uuid': utils.create_uuid(),
+                        'name': name,
+                        'display_name': name,
+                        'project_id': 'fake',
+                        'instance_type_id': 1,
+                        'system_metadata': {'blessed_from': 'source-uuid'}}
+        blessed_files = []
+        for file_name, data in (('%s.gc' % name, 'descriptor of %s' % name),
+                                ('%s.0.disk' % name, disk_data)):
+            blessed_file = os.path.join(self.path, file_name)
+            with open(blessed_file, 'w') as f:
+                f.write(data)
+            blessed_files.append(blessed_file)
+        return self.vmsconn._upload_files(self.context, instance_ref, blessed_files)
+
+    def test_upload_files(self):
+        descriptor_ref, disk_ref = self._bless('instance-1', 'disk')
+
+        descriptor = self.glance.show(self.context, descriptor_ref)
+        self.assertEquals('active', descriptor['status'])
+        self.assertTrue(descriptor['properties']['live_image'])
+        self.assertEquals(disk_ref,
+                          descriptor['properties']['live_image_data_instance-1.0.disk'])
+        disk = self.glance.show(self.context, disk_ref)
+        self.assertEquals('instance-1.0.disk', disk['properties']['file_name'])
+        self.assertEquals('disk', self.glance.image_data[disk_ref])
+
+    def test_upload_shares_identical_files(self):
+        _, first_disk_ref = self._bless('instance-1', 'disk')
+        _, second_disk_ref = self._bless('instance-2', 'disk')
+        _, other_disk_ref = self._bless('instance-3', 'other disk')
+
+        self.assertEquals(first_disk_ref, second_disk_ref)
+        self.assertNotEquals(first_disk_ref, other_disk_ref)
+
+        # A shared image outlives its last user until it is reaped.
+        self.vmsconn._delete_images(self.context, [first_disk_ref],
+                                    instance_name='instance-1')
+        self.assertTrue(first_disk_ref in self.glance.images)
+        self.vmsconn._delete_images(self.context, [first_disk_ref],
+                                    instance_name='instance-2')
+        self.assertTrue(first_disk_ref in self.glance.images)
+        properties = self.glance.show(self.context, first_disk_ref)['properties']
+        self.assertEquals('', properties['cobalt_image_users'])
+        self.assertEquals('1', properties[vms_conn.IMAGE_RELEASED_KEY])
+
+        # It is only reaped after the grace period, when no blessed instance
+        # of its lineage refers to it.
+        self.vmsconn.reap_released_images(self.context,
+                                          lambda lineage: set())
+        self.assertTrue(first_disk_ref in self.glance.images)
+        CONF.set_override('cobalt_released_image_grace', 0)
+        try:
+            self.vmsconn.reap_released_images(self.context,
+                                    lambda lineage: set([first_disk_ref]))
+            self.assertTrue(first_disk_ref in self.glance.images)
+            self.vmsconn.reap_released_images(self.context,
+                                    lambda lineage: set())
+            self.assertFalse(first_disk_ref in self.glance.images)
+        finally:
+            CONF.clear_override('cobalt_released_image_grace')
+
+        # An image that was never shared is removed with its user.
+        self.vmsconn._delete_images(self.context, [other_disk_ref],
+                                    instance_name='instance-3')
+        self.assertFalse(other_disk_ref in self.glance.images)
+
+    def test_shared_image_concurrent_users(self):
+        _, disk_ref = self._bless('instance-1', 'disk')
+        orig_update = self.glance.update
+        def slow_update(*args, **kwargs):
+            greenthread.sleep(0.01)
+            return orig_update(*args, **kwargs)
+        self.glance.update = slow_update
+
+        threads = [greenthread.spawn(self._bless, name, 'disk')
+                   for name in ('instance-2', 'instance-3')]
+        for thread in threads:
+            self.assertEquals(disk_ref, thread.wait()[1])
+        # No user is lost by the concurrent blesses.
+        users = self.glance.show(self.context, disk_ref)['properties']\
+                                                    ['cobalt_image_users']
+        self.assertEquals(set(['instance-1', 'instance-2', 'instance-3']),
+                          set(users.split(',')))
+
+        # The image is not deleted while it has users, nor right after they
+        # are all gone.
+        self.vmsconn._delete_images(self.context, [disk_ref],
+                                    instance_name='instance-4')
+        self.assertTrue(disk_ref in self.glance.images)
+        for name in ('instance-1', 'instance-2', 'instance-3'):
+            self.vmsconn._delete_images(self.context, [disk_ref],
+                                        instance_name=name)
+        self.assertTrue(disk_ref in self.glance.images)
+
+class CobaltPolicyRecordTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        CONF.set_override('cobalt_policy_record',
+                          os.path.join(self.path, 'policy.json'))
+        CONF.set_override('cobalt_sim_command_time', 0)
+        self.vmsconn = vms_conn.get_vms_connection(fake.FakeDriver(None))
+        self.vmsconn.configure(None)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        CONF.clear_override('cobalt_policy_record')
+        CONF.clear_override('cobalt_sim_command_time')
+
+    def test_install_policy_once(self):
+        policy = "[*;blessed=1]\nmemory_limit_mb=256\n"
+        self.assertEquals(None, self.vmsconn.get_policy_hash())
+        self.assertTrue(self.vmsconn.install_policy(policy))
+        self.assertEquals(co_common.policy_hash(policy),
+                          self.vmsconn.get_policy_hash())
+
+        # The same policy is not installed again, even after a restart.
+        self.vmsconn.simulator.inject_failure('installpolicy')
+        self.assertFalse(self.vmsconn.install_policy(policy,
+                            policy_hash=co_common.policy_hash(policy)))
+        restarted = vms_conn.get_vms_connection(fake.FakeDriver(None))
+        self.assertEquals(co_common.policy_hash(policy),
+                          restarted.get_policy_hash())
+        self.assertEquals(1, restarted._load_policy_record()['version'])
+
+        # A different policy is.
+        self.assertRaises(Exception, self.vmsconn.install_policy, "[*]\n")
+        self.assertEquals(co_common.policy_hash(policy),
+                          self.vmsconn.get_policy_hash())
+        self.vmsconn.install_policy("[*]\n")
+        self.assertEquals(co_common.policy_hash("[*]\n"),
+                          self.vmsconn.get_policy_hash())
+        self.assertEquals(2, self.vmsconn._load_policy_record()['version'])
+
+    def test_install_policy_force(self):
+        policy = "[*;blessed=1]\nmemory_limit_mb=256\n"
+        self.vmsconn.install_policy(policy)
+
+        # A forced install does not trust the record.
+        self.vmsconn.simulator.inject_failure('installpolicy')
+        self.assertRaises(Exception, self.vmsconn.install_policy, policy,
+                          force=True)
+        self.vmsconn.install_policy(policy, force=True)
+        self.assertEquals(co_common.policy_hash(policy),
+                          self.vmsconn.get_policy_hash())
+        self.assertEquals(2, self.vmsconn._load_policy_record()['version'])
@@ -0,0 +1,143 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from nova.compute import power_state
+from nova.openstack.common import processutils
+from nova.virt import fake
+from oslo.config import cfg
+
+import cobalt.nova.extension.vmsapi as vms_api
+import cobalt.nova.extension.vmsconn as vms_conn
+import cobalt.nova.extension.vmssim as vmssim
+
+CONF = cfg.CONF
+
+class CobaltVmsSimTestCase(unittest.TestCase):
+
+    def setUp(self):
+        for opt in ('cobalt_sim_command_time', 'cobalt_sim_bless_time_per_gb',
+                    'cobalt_sim_launch_time', 'cobalt_sim_launch_time_per_gb'):
+            CONF.set_override(opt, 0)
+        CONF.set_override('cobalt_sim_disk_mb', 64)
+        self.path = tempfile.mkdtemp()
+        self.simulator = vmssim.SimulatedVms(path=self.path)
+        self.vmsapi = vms_api.get_vmsapi(version=vmssim.VMS_VERSION)
+        self.vmsapi.configure(self.simulator)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        CONF.clear_override('cobalt_sim_command_time')
+        CONF.clear_override('cobalt_sim_bless_time_per_gb')
+        CONF.clear_override('cobalt_sim_launch_time')
+        CONF.clear_override('cobalt_sim_launch_time_per_gb')
+        CONF.clear_override('cobalt_sim_disk_mb')
+
+    def test_bless_writes_sparse_artifacts(self):
+        self.simulator.set_memory('instance-1', 256)
+        result = self.vmsapi.bless('instance-1', 'instance-2')
+
+        self.assertEquals('instance-2', result.newname)
+        self.assertEquals(None, result.network)
+        self.assertEquals(3, len(result.blessed_files))
+        sizes = dict([(os.path.basename(path), os.path.getsize(path))
+                      for path in result.blessed_files])
+        self.assertEquals(256 * vmssim.MB, sizes['instance-2.mem'])
+        self.assertEquals(64 * vmssim.MB, sizes['instance-2.0.disk'])
+        # The artifacts do not use the disk space.
+        disk = os.stat(os.path.join(self.path, 'instance-2.0.disk'))
+        self.assertTrue(disk.st_blocks * 512 < disk.st_size)
+
+        self.vmsapi.discard('instance-2')
+        for path in result.blessed_files:
+            self.assertFalse(os.path.exists(path))
+        self.assertEquals([], self.simulator.memservers)
+
+    def test_launch_time_scales_with_memory(self):
+        CONF.set_override('cobalt_sim_launch_time_per_gb', 0.2)
+        self.vmsapi.bless('instance-1', 'instance-2')
+
+        self.simulator.set_memory('instance-3', 128)
+        start = time.time()
+        self.vmsapi.launch('instance-2', 'instance-3', 0, None)
+        small = time.time() - start
+
+        self.simulator.set_memory('instance-4', 1024)
+        start = time.time()
+        self.vmsapi.launch('instance-2', 'instance-4', 0, None)
+        large = time.time() - start
+
+        self.assertTrue(large > small)
+        self.assertTrue(large >= 0.2)
+        self.assertEquals(power_state.RUNNING,
+                          self.simulator.get_info('instance-4')['state'])
+        self.vmsapi.pause('instance-4')
+        self.assertEquals(power_state.PAUSED,
+                          self.simulator.get_info('instance-4')['state'])
+
+    def test_kill_memservers(self):
+        result = self.vmsapi.bless('instance-1', 'instance-1',
+                                   mem_url='sim://migration', migration=True)
+        self.assertEquals('sim://migration', result.network)
+        self.assertEquals([], result.blessed_files)
+        self.assertEquals(1, len(self.simulator.memservers))
+
+        self.vmsapi.kill_memservers('sim://migration')
+        self.assertEquals([], self.simulator.memservers)
+
+    def test_injected_failure(self):
+        self.simulator.inject_failure('bless')
+        self.assertRaises(processutils.ProcessExecutionError,
+                          self.vmsapi.bless, 'instance-1', 'instance-2')
+        self.vmsapi.bless('instance-1', 'instance-2')
+
+    def test_failure_rate(self):
+        CONF.set_override('cobalt_sim_failure_rate', 1.0)
+        CONF.set_override('cobalt_sim_failing_commands', ['launch'])
+        try:
+            self.vmsapi.pause('instance-1')
+            self.assertRaises(processutils.ProcessExecutionError,
+                              self.vmsapi.launch, 'instance-1', 'instance-2',
+                              0, None)
+        finally:
+            CONF.clear_override('cobalt_sim_failure_rate')
+            CONF.clear_override('cobalt_sim_failing_commands')
+
+    def test_export_import(self):
+        self.simulator.set_memory('instance-1', 32)
+        self.vmsapi.bless('instance-1', 'instance-2')
+        archive = os.path.join(self.path, 'archive')
+        self.vmsapi.export({'name': 'instance-2'}, archive, None)
+
+        artifacts = self.vmsapi.import_({'name': 'instance-3'}, archive)
+        self.assertEquals(set(['instance-3.gc', 'instance-3.mem',
+                               'instance-3.0.disk']),
+                          set([os.path.basename(path) for path in artifacts]))
+        self.assertEquals(32, self.simulator.memory['instance-3'])
+
+class CobaltDummyConnectionTestCase(unittest.TestCase):
+
+    def test_fake_driver_uses_simulator(self):
+        vmsconn = vms_conn.get_vms_connection(fake.FakeDriver(None))
+        vmsconn.configure(None)
+        self.assertTrue(isinstance(vmsconn.simulator, vmssim.SimulatedVms))
+        self.assertEquals(vmsconn.simulator, vmsconn.vmsapi.vms_driver)
+        self.assertEquals(power_state.RUNNING,
+                vmsconn.get_instance_info({'name': 'instance-1'})['state'])
@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import hashlib
 import json
 import uuid
 
@@ -100,6 +102,77 @@ class MockImageService(object):
         if image_id in self.images:
             del self.images[image_id]
 
+class LocalImageService(object):
+    """
+    A stand-in for the glance image service that keeps image data in memory.
+    """
+    def __init__(self, chunk_size=4096):
+        self.images = {}
+        self.image_data = {}
+        self.chunk_size = chunk_size
+        self.downloads = []
+
+    def add_image(self, image_id, data, name=None, properties={}):
+        self.images[image_id] = {'id': image_id,
+                                 'name': name or image_id,
+                                 'size': len(data),
+                                 'checksum': hashlib.md5(data).hexdigest(),
+                                 'properties': dict(properties)}
+        self.image_data[image_id] = data
+
+    def show(self, context, image_id):
+        return copy.deepcopy(self.images[image_id])
+
+    def create(self, context, metadata, data=None):
+        image_id = create_uuid()
+        self.images[image_id] = {'id': image_id,
+                                 'size': 0,
+                                 'checksum': None,
+                                 'properties': {}}
+        return self.update(context, image_id, metadata, data)
+
+    def update(self, context, image_id, metadata, data=None, purge_props=True):
+        image = self.images[image_id]
+        metadata = copy.deepcopy(metadata)
+        properties = metadata.pop('properties', {})
+        image.update(metadata)
+        if purge_props:
+            image['properties'] = properties
+        else:
+            image['properties'].update(properties)
+        if data is not None:
+            self.image_data[image_id] = data.read()
+            image['size'] = len(self.image_data[image_id])
+            image['checksum'] = hashlib.md5(self.image_data[image_id]).hexdigest()
+        return copy.deepcopy(image)
+
+    def detail(self, context, filters={}):
+        images = []
+        for image in self.images.values():
+            matches = True
+            for key, value in filters.items():
+                if key.startswith('property-'):
+                    actual = image['properties'].get(key[len('property-'):])
+                else:
+                    actual = image.get(key)
+                matches = matches and actual == value
+            if matches:
+                images.append(copy.deepcopy(image))
+        return images
+
+    def _chunks(self, data):
+        for offset in xrange(0, len(data), self.chunk_size):
+            yield data[offset:offset + self.chunk_size]
+
+    def download(self, context, image_id, data=None):
+        self.downloads.append(image_id)
+        for chunk in self._chunks(self.image_data[image_id]):
+            data.write(chunk)
+
+    def delete(self, context, image_id):
+        del self.images[image_id]
+        del self.image_data[image_id]
+
 def mock_image_service():
     return image.ImageService(image_service=MockImageService())
 
@@ -179,6 +252,8 @@ class MockVmsConn(object):
     def __init__(self):
         self.return_vals = {}
         self.params_passed = []
+        # The image refs in the artifact cache (None means no cache).
+        self.cached_image_ids = None
 
     def set_return_val(self, method, value):
         values = self.return_vals.get(method, [])
@@ -217,6 +292,15 @@ class MockVmsConn(object):
         self.params_passed.append({'args': args, 'kwargs': kwargs})
         return self.pop_return_value("launch")
 
+    def fetch_artifacts(self, context, image_refs, **kwargs):
+        return list(image_refs)
+
+    def release_artifacts(self, image_refs, **kwargs):
+        pass
+
+    def cached_image_refs(self):
+        return self.cached_image_ids
+
     def replug(self, *args, **kwargs):
         self.params_passed.append({'args': args, 'kwargs': kwargs})
         return self.pop_return_value("replug")
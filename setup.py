@@ -123,13 +123,15 @@ if PACKAGE == 'all' or PACKAGE == 'cobalt-compute':
     setup(name='cobalt-compute',
           description='Cobalt extension for OpenStack Compute.',
           install_requires = INSTALL_REQUIRES + ['cobalt'],
-          scripts=['bin/cobalt-compute'],
+          scripts=['bin/cobalt-compute',
+                   'bin/cobalt-vmsctl-worker'],
           **COMMON)
 
 if PACKAGE == 'all' or PACKAGE == 'cobalt-api':
     setup(name='cobalt-api',
           description='Cobalt API extension.',
           install_requires = INSTALL_REQUIRES + ['cobalt'],
+          scripts=['bin/cobalt-lineage-index'],
           **COMMON)
 
 if PACKAGE == 'all' or PACKAGE == 'cobalt-horizon':